@@ -1,5 +1,6 @@
-from flask import Flask, render_template, request, send_file, redirect, url_for, flash, session
-from flask_wtf.csrf import CSRFProtect
+from flask import Flask, Request, render_template, request, send_file, redirect, url_for, flash, session, jsonify, Response, g, abort, has_app_context, stream_with_context
+from flask_wtf.csrf import CSRFProtect, generate_csrf
+from werkzeug.utils import secure_filename
 import pandas as pd
 try:
     from fpdf import FPDF, XPos, YPos
@@ -8,13 +9,51 @@ except (ImportError, AttributeError):
     print("ERREUR : La bibliothèque 'fpdf2' est mal installée ou entre en conflit avec l'ancienne 'fpdf'.", file=sys.stderr)
     print("Veuillez exécuter : pip uninstall -y fpdf fpdf2 && pip install fpdf2", file=sys.stderr)
     raise
+try:
+    import pyarrow as pa # Optionnel : exports Parquet / Arrow
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+try:
+    import resource # Unix uniquement : mesure du pic mémoire des imports
+except ImportError:
+    resource = None
+try:
+    import brotli # Optionnel : compression Brotli des pages
+except ImportError:
+    brotli = None
+try:
+    import fcntl # Unix uniquement : verrou des mises à jour entre processus
+except ImportError:
+    fcntl = None
 import json
+import csv
 import os
 import numpy as np
 import uuid
+import glob
+import tempfile
+import time
+import zipfile
+import posixpath
+import shutil
+import xml.etree.ElementTree as ET
+import gzip
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import re
+import bisect
+import unicodedata
 from datetime import datetime, timedelta, date
-from io import BytesIO
+from io import BytesIO, StringIO
+from urllib.parse import urlsplit, urlunsplit, urlencode, parse_qsl
+from dataclasses import dataclass
 from functools import lru_cache
+from contextlib import contextmanager
 import jours_feries_france
 
 app = Flask(__name__)
@@ -28,51 +67,607 @@ csrf = CSRFProtect(app)
 JSON_FILE = "equipe.json"
 MARCHE_FILE = "marche.json"
 CONSO_FILE = "consommation.json"
+CONSO_DAYS_FILE = "consommation_jours.json"
+SNAPSHOTS_DIR = "instantanes"
+ROLLUPS_FILE = "agregats.json"
 UPLOAD_FOLDER = '/tmp'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Imports : fichiers gardés en mémoire jusqu'à ce seuil, au-delà dans un fichier temporaire anonyme
+UPLOAD_SPOOL_MAX_SIZE = int(os.environ.get('UPLOAD_SPOOL_MAX_SIZE', 2 * 1024 * 1024))
+# Taille décompressée maximale d'un classeur (.xlsx = archive zip), bornant la mémoire de l'analyse
+UPLOAD_MAX_UNCOMPRESSED = 10 * app.config['MAX_CONTENT_LENGTH']
+# Hausse maximale de la mémoire résidente pendant l'analyse d'un import (Mo, 0 : sans limite)
+UPLOAD_MAX_MEMORY_MB = int(os.environ.get('UPLOAD_MAX_MEMORY_MB', 512))
+# Anciennes copies d'imports (planning_*.xlsx) supprimées du dossier d'upload après ce délai
+UPLOAD_RETENTION_HOURS = int(os.environ.get('UPLOAD_RETENTION_HOURS', 24))
+# Multi-équipes : un sous-dossier par équipe (equipe.json, marche.json, consommation.json)
+TENANTS_DIR = os.environ.get('TENANTS_DIR', 'equipes')
+MAX_CACHED_TENANTS = int(os.environ.get('MAX_CACHED_TENANTS', 16))
+TENANT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+class SpooledUploadRequest(Request):
+    """Requête dont les fichiers reçus restent en mémoire jusqu'à UPLOAD_SPOOL_MAX_SIZE."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE, mode='rb+')
+
+app.request_class = SpooledUploadRequest
+
+# --- ÉQUIPES (MULTI-MARCHÉS) ---
+
+def list_tenants():
+    """Équipes disponibles (sous-dossiers de TENANTS_DIR), triées par nom."""
+    if not os.path.isdir(TENANTS_DIR): return []
+    return sorted(name for name in os.listdir(TENANTS_DIR)
+                  if TENANT_ID_PATTERN.match(name) and os.path.isdir(os.path.join(TENANTS_DIR, name)))
+
+def is_valid_tenant(tenant):
+    return bool(tenant) and bool(TENANT_ID_PATTERN.match(tenant)) and os.path.isdir(os.path.join(TENANTS_DIR, tenant))
+
+def current_tenant():
+    """
+    Équipe de la requête en cours, ou du contexte d'application ouvert par les traitements
+    par lots (None : fichiers du dossier courant, mode mono-équipe).
+    """
+    if has_app_context():
+        return g.get('tenant')
+    return None
+
+def tenant_path(filename):
+    """Chemin d'un fichier de données pour l'équipe courante."""
+    tenant = current_tenant()
+    return os.path.join(TENANTS_DIR, tenant, filename) if tenant else filename
+
+_tenant_caches = OrderedDict()
+_tenant_caches_lock = threading.Lock()
+
+def tenant_cache():
+    """
+    Cache (modèle, index de recherche) de l'équipe courante. Seules les MAX_CACHED_TENANTS
+    équipes les plus récemment utilisées restent en mémoire : limite en nombre d'équipes,
+    pas en octets (seul le cache des fragments est borné en octets, FRAGMENT_CACHE_MAX_BYTES).
+    """
+    tenant = current_tenant()
+    with _tenant_caches_lock:
+        cache = _tenant_caches.get(tenant)
+        if cache is None:
+            cache = _tenant_caches[tenant] = {}
+        _tenant_caches.move_to_end(tenant)
+        while len(_tenant_caches) > MAX_CACHED_TENANTS:
+            _tenant_caches.popitem(last=False)
+    return cache
+
+@app.before_request
+def select_tenant():
+    """
+    Sélection de l'équipe : paramètre ?equipe=, champ `equipe` des formulaires, en-tête X-Equipe
+    (API) ou choix mémorisé en session par le sélecteur. Une équipe inconnue est refusée (404) :
+    les données ne sont jamais mélangées. Seul le sélecteur modifie la session : chaque onglet
+    garde l'équipe de sa page (formulaires, liens générés et flux de mises à jour la transmettent).
+    """
+    tenant = request.args.get('equipe') or request.headers.get('X-Equipe')
+    if not tenant and request.endpoint != 'equipe_selection': # Son champ `equipe` est le nouveau choix
+        tenant = request.form.get('equipe')
+    tenant = tenant or session.get('tenant')
+    if tenant and not is_valid_tenant(tenant):
+        if session.get('tenant') == tenant:
+            session.pop('tenant', None)
+        abort(404)
+    g.tenant = tenant or None
+
+@app.url_defaults
+def add_tenant_to_urls(endpoint, values):
+    """Les URL générées (liens, redirections après un formulaire) restent sur l'équipe de la requête."""
+    tenant = current_tenant()
+    if tenant and endpoint != 'static' and 'equipe' not in values:
+        values['equipe'] = tenant
+
+@app.context_processor
+def inject_tenants():
+    return {"tenants": list_tenants(), "current_tenant": current_tenant()}
 
 # --- FONCTIONS UTILITAIRES ---
 
-def load_team():
+JSON_CACHE_SIZE = 64
+_json_cache = OrderedDict()
+_json_cache_lock = threading.Lock()
+
+class FrozenDict(dict):
+    """dict en lecture seule (cache de read_json) : toute modification lève TypeError."""
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Donnée partagée du cache de lecture : utiliser read_json(..., readonly=False) pour la modifier")
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+class FrozenList(list):
+    """list en lecture seule (cache de read_json) : toute modification lève TypeError."""
+    _readonly = FrozenDict._readonly
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = remove = pop = clear = sort = reverse = _readonly
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+def freeze(data):
+    """Copie en lecture seule d'une structure JSON (dict et list imbriqués), sérialisable par json."""
+    if isinstance(data, dict):
+        return FrozenDict((k, freeze(v)) for k, v in data.items())
+    if isinstance(data, list):
+        return FrozenList(freeze(v) for v in data)
+    return data
+
+def read_json(path, default, readonly=False):
     """
-    Charge la liste des membres de l'équipe depuis le fichier JSON.
-    Retourne une liste vide si le fichier n'existe pas ou est invalide.
+    Lit un fichier JSON (`default()` s'il est absent ou invalide).
+    - readonly=True : cache de lecture par processus. La structure déjà analysée est partagée
+      tant que le fichier est inchangé (inode, mtime, taille) ; ce simple stat suffit à détecter
+      les écritures des autres workers. Elle est en lecture seule (FrozenDict / FrozenList) :
+      une modification lève TypeError au lieu d'altérer le cache des requêtes suivantes.
+    - readonly=False : nouvelle copie modifiable, à enregistrer avec write_json.
     """
-    if not os.path.exists(JSON_FILE): return []
-    with open(JSON_FILE, 'r') as f:
+    version = file_version(path)
+    if version is None:
+        return default()
+    if readonly:
+        with _json_cache_lock:
+            entry = _json_cache.get(path)
+            if entry and entry[0] == version:
+                _json_cache.move_to_end(path)
+                return entry[1]
+
+    with open(path, 'r') as f:
         try:
             data = json.load(f)
-        except:
-            return []
+        except ValueError:
+            return default()
+    if readonly:
+        data = freeze(data)
+        cache_json(path, version, data)
     return data
 
-def load_marche():
+def cache_json(path, version, data):
+    """Met en cache une structure déjà en lecture seule (cf. freeze)."""
+    with _json_cache_lock:
+        _json_cache[path] = (version, data)
+        _json_cache.move_to_end(path)
+        while len(_json_cache) > JSON_CACHE_SIZE:
+            _json_cache.popitem(last=False)
+
+def write_json(path, data, indent=None):
+    """
+    Écriture atomique (fichier temporaire puis remplacement) ; le cache de lecture est mis à jour
+    avec une copie en lecture seule de `data`.
+    """
+    tmp_file = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_file, 'w') as f:
+        # json.dumps utilise l'encodeur C (json.dump passe par l'encodeur Python, bien plus lent)
+        f.write(json.dumps(data, indent=indent))
+    os.replace(tmp_file, path)
+    cache_json(path, file_version(path), freeze(data))
+
+_file_lock_guard = threading.Lock()
+
+@contextmanager
+def file_lock(path):
+    """
+    Section exclusive sur un fichier de données (lecture-modification-écriture) : entre les threads
+    du processus et, si fcntl est disponible, entre les processus (verrou sur `path`.lock).
+    """
+    with _file_lock_guard:
+        if fcntl is None:
+            yield
+            return
+        with open(f"{path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def load_team(readonly=False):
+    """
+    Charge la liste des membres de l'équipe depuis le fichier JSON.
+    Retourne une liste vide si le fichier n'existe pas ou est invalide.
+    """
+    return read_json(tenant_path(JSON_FILE), list, readonly)
+
+def load_marche(readonly=False):
     """Charge le catalogue des UOs depuis marche.json."""
-    if not os.path.exists(MARCHE_FILE): return {}
-    with open(MARCHE_FILE, 'r') as f:
-        try:
-            return json.load(f)
-        except:
-            return {}
+    return read_json(tenant_path(MARCHE_FILE), dict, readonly)
 
-def save_team_json(data):
-    """Sauvegarde la liste des membres de l'équipe dans le fichier JSON."""
-    with open(JSON_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+PAID_TOTALS_KEY = "totaux_payes"
 
-def load_consumption():
+def rebuild_paid_totals(bc):
+    """
+    Recalcule les totaux payés d'un BC brut à partir de son historique de paiements :
+    nombre de paiements, quantités payées par code UO, somme des pourcentages et
+    nombre de paiements sans ID service fait.
+    """
+    totals = {"nb": 0, "uos": {}, "percentage": 0, "sans_sf": 0}
+    for p in bc.get('paiements', []):
+        totals["nb"] += 1
+        if p['type'] == 'uo':
+            for up in p.get('uos', []):
+                totals["uos"][up['code']] = totals["uos"].get(up['code'], 0) + up['quantite']
+        elif p['type'] == 'percentage':
+            totals["percentage"] += p['percentage']
+        if not p.get('service_fait_id'):
+            totals["sans_sf"] += 1
+    return totals
+
+def bc_paid_totals(bc):
+    """
+    Totaux payés d'un BC brut (cf. rebuild_paid_totals). Les agrégats enregistrés dans le BC
+    sont maintenus à chaque paiement : ils sont lus directement, et recalculés seulement
+    s'ils sont absents ou ne couvrent pas tout l'historique (fichier modifié à la main).
+    """
+    totals = bc.get(PAID_TOTALS_KEY)
+    if isinstance(totals, dict) and totals.get("nb") == len(bc.get('paiements', [])):
+        return totals
+    return rebuild_paid_totals(bc)
+
+def apply_payment(bc, payment, totals):
+    """Ajoute un paiement (déjà validé) au BC brut et met à jour ses totaux payés."""
+    bc.setdefault('paiements', []).append(payment)
+    totals["nb"] += 1
+    if payment['type'] == 'uo':
+        for up in payment['uos']:
+            totals["uos"][up['code']] = totals["uos"].get(up['code'], 0) + up['quantite']
+    elif payment['type'] == 'percentage':
+        totals["percentage"] += payment['percentage']
+    if not payment.get('service_fait_id'):
+        totals["sans_sf"] += 1
+    bc[PAID_TOTALS_KEY] = totals
+
+def bc_sort_key(bc):
+    """Clé de tri des BCs d'un membre : date de début (les BCs sans date en dernier)."""
+    return bc.get('date_debut') or '9999-99-99'
+
+def save_team_json(data):
+    """
+    Sauvegarde la liste des membres de l'équipe dans le fichier JSON.
+    Les BCs de chaque membre sont stockés triés par date de début.
+    Les agrégats budgétaires sont mis à jour (cf. refresh_budget_rollups).
+    """
+    for member in data:
+        if member.get('bons_commande'):
+            member['bons_commande'].sort(key=bc_sort_key)
+            for bc in member['bons_commande']:
+                if bc.get('paiements') or PAID_TOTALS_KEY in bc:
+                    bc[PAID_TOTALS_KEY] = bc_paid_totals(bc)
+    write_json(tenant_path(JSON_FILE), data, indent=4)
+    tenant_cache().clear()
+    refresh_budget_rollups()
+
+def load_consumption(readonly=False):
     """Charge l'historique de consommation depuis le fichier JSON."""
-    if not os.path.exists(CONSO_FILE): return {}
-    with open(CONSO_FILE, 'r') as f:
-        try:
-            return json.load(f)
-        except:
-            return {}
+    return read_json(tenant_path(CONSO_FILE), dict, readonly)
 
 def save_consumption(data):
-    """Sauvegarde l'historique de consommation dans le fichier JSON."""
-    with open(CONSO_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+    """Sauvegarde l'historique de consommation dans le fichier JSON (et met à jour les agrégats)."""
+    write_json(tenant_path(CONSO_FILE), data, indent=4)
+    refresh_budget_rollups()
+
+# --- MODÈLE DE DONNÉES ---
+
+def fingerprint(data):
+    """Empreinte courte d'une structure JSON (identifie une version de son contenu)."""
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+def to_float(value, default=0.0):
+    """Convertit une valeur numérique saisie (nombre, chaîne, vide) en float."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def to_number(value, default=0):
+    """Comme to_float, mais conserve les nombres JSON tels quels (20 reste affiché "20")."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return to_float(value, default)
+
+def to_date(value):
+    """Convertit une chaîne "YYYY-MM-DD" en date (None si vide ou invalide)."""
+    try:
+        return datetime.strptime(str(value), "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+@dataclass(slots=True)
+class UoLine:
+    """Ligne d'Unité d'Oeuvre (commandée ou payée) valorisée au prix du catalogue."""
+    code: str
+    quantite: float
+    prix_unitaire_ht: float
+
+    @property
+    def montant_ht(self):
+        return self.quantite * self.prix_unitaire_ht
+
+@dataclass(slots=True)
+class Payment:
+    """Paiement (demande de service fait) d'un BC, par UO ou par pourcentage."""
+    index: int
+    type: str
+    date_demande: str
+    service_fait_id: str
+    uos: tuple
+    percentage: float
+
+@dataclass(slots=True)
+class BonCommande:
+    """
+    Bon de commande d'un prestataire.
+    `index` est la position du BC dans equipe.json, `source` le dictionnaire d'origine.
+    `key` est l'identifiant stable du BC (N° CHORUS, à défaut N° IBIS),
+    `version` l'empreinte de son contenu (cache des fragments HTML).
+    `total_ht` est calculé à partir du catalogue UO du marché, `paid_uos` / `paid_percentage` /
+    `paid_ht` à partir des totaux payés maintenus dans le BC (cf. bc_paid_totals).
+    """
+    index: int
+    key: str
+    chorus_id: str
+    ibis_id: str
+    jours_commandes: float
+    date_debut: str
+    date_debut_dt: object
+    moment_debut: str
+    tjm_ht: float
+    uos: tuple
+    paiements: tuple
+    total_ht: float
+    paid_uos: dict
+    paid_percentage: float
+    paid_ht: float
+    version: str
+    source: dict
+
+@dataclass(slots=True)
+class Member:
+    """Membre de l'équipe (interne ou prestataire) et ses bons de commande triés par date de début."""
+    id: int
+    type: str
+    nom: str
+    prenom: str
+    societe: str
+    presence_pct: float
+    bons_commande: tuple
+    version: str
+    source: dict
+
+    @property
+    def nom_complet(self):
+        """Format "Prénom Nom" (clé de l'historique de consommation)."""
+        return f"{self.prenom} {self.nom}"
+
+    @property
+    def nom_affichage(self):
+        """Format "NOM Prénom" des rapports."""
+        return f"{self.nom.upper()} {self.prenom}"
+
+@dataclass(slots=True)
+class TeamModel:
+    """
+    Équipe et marché analysés une fois pour toutes pour une version donnée des fichiers.
+    `bc_by_id` indexe chaque BC par N° CHORUS et par N° IBIS :
+    { identifiant: (position du membre, membre, BC) }.
+    """
+    version: tuple
+    members: tuple
+    by_id: dict
+    bc_by_id: dict
+    uo_catalog: dict
+    tva_rate: float
+
+    @property
+    def prestataires(self):
+        return [m for m in self.members if m.type == 'prestataire']
+
+def build_uo_lines(uos, uo_catalog):
+    return tuple(UoLine(str(uo.get('code', '')), to_number(uo.get('quantite')), to_float(uo_catalog.get(uo.get('code'), 0)))
+                 for uo in uos or [])
+
+def build_bon_commande(data, index, uo_catalog):
+    """Construit un BonCommande typé à partir de son dictionnaire JSON."""
+    uos = build_uo_lines(data.get('uos'), uo_catalog)
+    date_debut = data.get('date_debut', date.today().strftime("%Y-%m-%d"))
+    paiements = tuple(Payment(
+        index=i,
+        type=pay.get('type', ''),
+        date_demande=pay.get('date_demande', ''),
+        service_fait_id=pay.get('service_fait_id', ''),
+        uos=build_uo_lines(pay.get('uos'), uo_catalog),
+        percentage=to_float(pay.get('percentage'))
+    ) for i, pay in enumerate(data.get('paiements', [])))
+    total_ht = sum(uo.montant_ht for uo in uos)
+    paid = bc_paid_totals(data)
+    paid_uos = {code: to_number(qty) for code, qty in paid["uos"].items()}
+    paid_percentage = to_float(paid["percentage"])
+    return BonCommande(
+        index=index,
+        key=data.get('chorus_id') or data.get('ibis_id') or '',
+        chorus_id=data.get('chorus_id', '-'),
+        ibis_id=data.get('ibis_id', '-'),
+        jours_commandes=to_float(data.get('jours_commandes')),
+        date_debut=date_debut,
+        date_debut_dt=to_date(date_debut),
+        moment_debut=data.get('moment_debut', 'Matin'),
+        tjm_ht=to_float(data.get('tjm_ht')),
+        uos=uos,
+        paiements=paiements,
+        total_ht=total_ht,
+        paid_uos=paid_uos,
+        paid_percentage=paid_percentage,
+        paid_ht=sum(qty * to_float(uo_catalog.get(code, 0)) for code, qty in paid_uos.items())
+                + (paid_percentage / 100.0) * total_ht,
+        version=fingerprint(data),
+        source=data
+    )
+
+def build_member(data, uo_catalog):
+    """Construit un Member typé (et ses BCs) à partir de son dictionnaire JSON."""
+    return Member(
+        id=data.get('id'),
+        type=data.get('type'),
+        nom=data.get('nom') or '',
+        prenom=data.get('prenom') or '',
+        societe=data.get('societe', '-'),
+        presence_pct=to_float(data.get('presence_pct', 100), 100.0),
+        bons_commande=tuple(sorted((build_bon_commande(bc, i, uo_catalog) for i, bc in enumerate(data.get('bons_commande', []))),
+                                   key=lambda bc: bc_sort_key(bc.source))),
+        version=fingerprint(data),
+        source=data
+    )
+
+def build_team_model(team, marche, version=None):
+    uo_catalog = build_uo_catalog(marche)
+    members = tuple(build_member(m, uo_catalog) for m in team)
+    bc_by_id = {}
+    for position, member in enumerate(members):
+        for bc in member.bons_commande:
+            for bc_id in (bc.chorus_id, bc.ibis_id):
+                if bc_id and bc_id != '-':
+                    bc_by_id[bc_id] = (position, member, bc)
+    return TeamModel(
+        version=version,
+        members=members,
+        by_id={m.id: m for m in members},
+        bc_by_id=bc_by_id,
+        uo_catalog=uo_catalog,
+        tva_rate=to_float(marche.get('annexe_financiere', {}).get('tva_taux_percent', 20), 20.0)
+    )
+
+def file_version(path):
+    """Identifiant de version d'un fichier (inode, mtime, taille) ; None s'il n'existe pas."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def get_team_model():
+    """
+    Retourne le modèle typé de l'équipe, reconstruit uniquement lorsque equipe.json
+    ou marche.json ont changé depuis la dernière construction.
+    """
+    cache = tenant_cache()
+    version = (file_version(tenant_path(JSON_FILE)), file_version(tenant_path(MARCHE_FILE)))
+    model = cache.get('model')
+    if model is None or model.version != version:
+        model = build_team_model(load_team(readonly=True), load_marche(readonly=True), version)
+        cache['model'] = model
+    return model
+
+# --- RECHERCHE ---
+
+def normalize_search_text(text):
+    """Minuscules sans accents, pour une recherche insensible à la casse et aux accents."""
+    text = unicodedata.normalize('NFKD', str(text or '')).encode('ascii', 'ignore').decode('ascii')
+    return text.lower().strip()
+
+def search_tokens(text):
+    """Termes indexés d'un champ : la valeur complète et chacun de ses mots (ex. "ej-2026-001", "2026", "001")."""
+    normalized = normalize_search_text(text)
+    if not normalized:
+        return set()
+    return {normalized} | {t for t in re.split(r'[^a-z0-9]+', normalized) if t}
+
+class SearchIndex:
+    """
+    Index inversé des membres, BCs et paiements de l'équipe sur : N° CHORUS, N° IBIS,
+    ID service fait, code UO, société et nom du membre.
+    Les termes sont triés pour une recherche par préfixe (bisect) ; une requête de plusieurs
+    mots retourne les documents contenant un terme commençant par chacun des mots.
+    """
+    def __init__(self, model):
+        self.version = model.version
+        self.documents = []
+        postings = {}
+
+        def add(document, *fields):
+            doc_id = len(self.documents)
+            self.documents.append(document)
+            for field in fields:
+                for token in search_tokens(field):
+                    postings.setdefault(token, set()).add(doc_id)
+
+        for member in model.members:
+            identity = (member.nom, member.prenom, member.societe)
+            add({"type": "membre", "member_id": member.id, "member_name": member.nom_complet,
+                 "societe": member.societe}, *identity)
+            for bc in member.bons_commande:
+                bc_doc = {"type": "bc", "member_id": member.id, "member_name": member.nom_complet,
+                          "societe": member.societe, "bc_id": bc.key, "chorus_id": bc.chorus_id,
+                          "ibis_id": bc.ibis_id, "date_debut": bc.date_debut}
+                add(bc_doc, bc.chorus_id, bc.ibis_id, *identity, *(uo.code for uo in bc.uos))
+                for pay in bc.paiements:
+                    add({**bc_doc, "type": "paiement", "pay_index": pay.index, "pay_type": pay.type,
+                         "service_fait_id": pay.service_fait_id, "date_demande": pay.date_demande},
+                        pay.service_fait_id, bc.chorus_id, bc.ibis_id, *identity, *(uo.code for uo in pay.uos))
+
+        self.terms = sorted(postings)
+        self.postings = [postings[t] for t in self.terms]
+
+    def prefix_matches(self, prefix):
+        """Ensemble des documents ayant un terme commençant par `prefix`."""
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + '\uffff', lo=start)
+        if end - start == 1:
+            return self.postings[start]
+        return set().union(*self.postings[start:end])
+
+    def search(self, query, limit=50, doc_type=None):
+        words = [w for w in re.split(r'\s+', normalize_search_text(query)) if w]
+        if not words:
+            return []
+        # On commence par le mot le plus sélectif
+        matches = sorted((self.prefix_matches(w) for w in words), key=len)
+        doc_ids = set(matches[0])
+        for other in matches[1:]:
+            doc_ids &= other
+        results = [self.documents[i] for i in sorted(doc_ids)]
+        if doc_type:
+            results = [d for d in results if d["type"] == doc_type]
+        return results[:limit]
+
+def get_search_index():
+    """Index de recherche de la version courante de l'équipe (reconstruit après chaque écriture)."""
+    model = get_team_model()
+    cache = tenant_cache()
+    index = cache.get('search')
+    if index is None or index.version != model.version:
+        index = SearchIndex(model)
+        cache['search'] = index
+    return index
+
+def locate_bc(team, bc_id=None, member_id=None, bc_index=None):
+    """
+    Retrouve un BC dans la liste brute `team` (issue de load_team) en vue de sa modification :
+    par identifiant CHORUS/IBIS via l'index du modèle, ou à défaut par position (membre, index).
+    Retourne (membre, BC) en dictionnaires, ou (None, None) si introuvable.
+    """
+    if bc_id:
+        entry = get_team_model().bc_by_id.get(bc_id)
+        if entry is None:
+            return None, None
+        position, member, bc = entry
+        if position < len(team) and team[position].get('id') == member.id:
+            raw_bcs = team[position].get('bons_commande', [])
+            if bc.index < len(raw_bcs) and bc_id in (raw_bcs[bc.index].get('chorus_id'), raw_bcs[bc.index].get('ibis_id')):
+                return team[position], raw_bcs[bc.index]
+        return None, None
+
+    member = next((m for m in team if m.get('id') == member_id), None)
+    if not member or bc_index is None or not 0 <= bc_index < len(member.get('bons_commande', [])):
+        return None, None
+    return member, member['bons_commande'][bc_index]
+
+def as_members(team):
+    """Accepte une liste de Member ou de dictionnaires JSON (convertis avec le catalogue courant)."""
+    if team and isinstance(team[0], dict):
+        return build_team_model(team, load_marche(readonly=True)).members
+    return team
 
 @lru_cache(maxsize=32)
 def get_holidays(year):
@@ -97,197 +692,926 @@ def calculate_end_date(start_date_str, start_moment, days_to_consume, presence_p
     - Des jours ouvrés (hors week-ends et jours fériés)
     Retourne une chaîne formatée "JJ/MM/AAAA (Moment)"
     """
-    if days_to_consume <= 0: return "Terminé"
-    # Burn par demi-journée
-    half_day_burn = (presence_pct / 100.0) / 2.0
-    if half_day_burn <= 0: return "Jamais"
+    return project_end_dates([start_date_str], [start_moment], [days_to_consume], [presence_pct])[0]
+
+# --- PROJECTION VECTORISÉE ---
+
+MOMENTS = ["Matin", "Après-midi"]
+MAX_PROJECTION_HALF_DAYS = 365 * 10 # Sécurité 5 ans en demi-journées
 
+class BusinessCalendar:
+    """
+    Index des demi-journées du calendrier entre le 1er janvier de first_year
+    et le 31 décembre de last_year.
+    La demi-journée n°k correspond au jour k // 2, le matin si k est pair.
+    `cum_open[k]` est le nombre de demi-journées ouvrées dans [0, k].
+    """
+    def __init__(self, first_year, last_year):
+        self.first_year = first_year
+        self.last_year = last_year
+        self.origin = np.datetime64(f"{first_year}-01-01", 'D')
+        self.days = np.arange(self.origin, np.datetime64(f"{last_year + 1}-01-01", 'D'))
+
+        holidays = []
+        for year in range(first_year, last_year + 1):
+            holidays.extend(get_holidays(year))
+        holidays = np.array(sorted(holidays), dtype='datetime64[D]')
+
+        # 1970-01-01 était un jeudi (weekday() == 3)
+        weekdays = (self.days.astype(np.int64) + 3) % 7
+        self.open_days = (weekdays < 5) & ~np.isin(self.days, holidays)
+        self.open_half = np.repeat(self.open_days, 2)
+        self.cum_open = np.cumsum(self.open_half, dtype=np.int64)
+        # Version décalée : cum_before[k] = demi-journées ouvrées strictement avant k
+        self.cum_before = np.concatenate(([0], self.cum_open))
+
+        # Bornes des mois en demi-journées : le mois i couvre [month_bounds[i], month_bounds[i + 1])
+        months = np.arange(self.origin.astype('datetime64[M]'), np.datetime64(f"{last_year + 1}-01", 'M'))
+        self.month_keys = [str(m) for m in months] # 'YYYY-MM'
+        self.month_bounds = np.append((months.astype('datetime64[D]') - self.origin).astype(np.int64) * 2, len(self.open_half))
+        # Nombre de demi-journées ouvrées par mois
+        self.month_open_half = np.diff(self.cum_before[self.month_bounds])
+
+    def slots_of(self, dates, moments):
+        """Convertit des tableaux (datetime64[D], moment) en indices de demi-journées."""
+        offsets = (np.asarray(dates, dtype='datetime64[D]') - self.origin).astype(np.int64)
+        pm = np.array([m == "Après-midi" for m in moments], dtype=np.int64)
+        return offsets * 2 + pm
+
+    def slot_label(self, slot):
+        """Formate une demi-journée au format "JJ/MM/AAAA (Moment)"."""
+        day = self.days[slot // 2].astype(date)
+        return f"{day.strftime('%d/%m/%Y')} ({MOMENTS[slot % 2]})"
+
+@lru_cache(maxsize=8)
+def get_business_calendar(first_year, last_year):
+    """Cache les calendriers de demi-journées ouvrées par plage d'années."""
+    return BusinessCalendar(first_year, last_year)
+
+def calendar_for_dates(dates):
+    """Retourne un calendrier couvrant les dates données et l'horizon maximal de projection."""
+    years = np.asarray(dates, dtype='datetime64[Y]').astype(np.int64) + 1970
+    first_year = int(years.min()) if len(years) else date.today().year
+    last_year = int(years.max()) if len(years) else date.today().year
+    # On aligne les bornes pour mutualiser le cache entre appels proches
+    return get_business_calendar(first_year - first_year % 5, last_year - last_year % 5 + 10)
+
+def parse_dates(values, default=None):
+    """Convertit une liste de chaînes "YYYY-MM-DD" en datetime64[D] (défaut : aujourd'hui)."""
+    default = np.datetime64(default or date.today(), 'D')
+    parsed = pd.to_datetime(pd.Series([str(v) for v in values], dtype=object), format="%Y-%m-%d", errors='coerce')
+    return np.where(parsed.isna().values, default, parsed.values.astype('datetime64[D]'))
+
+def project_end_slots(cal, start_slots, remaining_days, presence_pcts, chain_keys=None):
+    """
+    Projette en une passe vectorisée la demi-journée de fin de chaque BC.
+    - start_slots : demi-journée de début de consommation de chaque BC
+    - remaining_days : jours restant à consommer
+    - presence_pcts : pourcentage de présence du prestataire
+    - chain_keys : identifiant du prestataire ; les BCs d'une même clé sont chaînés
+      dans l'ordre du tableau (un BC ne démarre pas avant la fin du précédent).
+    Retourne (demi-journées de début effectives après chaînage, demi-journées de fin),
+    la fin valant -1 s'il n'y a rien à consommer et -2 si le BC ne se termine jamais.
+    """
+    start_slots = np.asarray(start_slots, dtype=np.int64).copy()
+    remaining = np.asarray(remaining_days, dtype=float)
+    burn = np.asarray(presence_pcts, dtype=float) / 100.0 / 2.0
+    n = len(start_slots)
+    ends = np.full(n, -1, dtype=np.int64)
+    ends[(remaining > 0) & (burn <= 0)] = -2
+    active = (remaining > 0) & (burn > 0)
+    if not active.any():
+        return start_slots, ends
+
+    # Nombre de demi-journées ouvrées nécessaires pour épuiser le reste
+    with np.errstate(divide='ignore', invalid='ignore'):
+        needed = np.ceil((remaining - 0.0001) / np.where(burn > 0, burn, 1) - 1e-9).astype(np.int64)
+    needed = np.maximum(needed, 1)
+
+    if chain_keys is None:
+        ranks = np.zeros(n, dtype=np.int64)
+        keys = np.arange(n)
+    else:
+        keys = pd.factorize(pd.Series(chain_keys, dtype=object))[0]
+        ranks = pd.Series(keys).groupby(keys).cumcount().values
+
+    prev_end = np.full(keys.max() + 1 if n else 0, -1, dtype=np.int64)
+    for r in range(int(ranks.max()) + 1):
+        level = np.nonzero(active & (ranks == r))[0]
+        if not len(level):
+            continue
+        level_keys = keys[level]
+        # Chaînage : démarrage au plus tôt à la demi-journée suivant la fin du BC précédent
+        starts = np.maximum(start_slots[level], np.where(prev_end[level_keys] >= 0, prev_end[level_keys] + 1, 0))
+        starts = np.minimum(starts, len(cal.cum_open) - 1)
+        targets = cal.cum_before[starts] + needed[level]
+        found = np.searchsorted(cal.cum_open, targets, side='left')
+        level_ends = np.minimum(np.minimum(found, starts + MAX_PROJECTION_HALF_DAYS), len(cal.cum_open) - 1)
+        start_slots[level] = starts
+        ends[level] = level_ends
+        prev_end[level_keys] = level_ends
+    return start_slots, ends
+
+def project_end_dates(start_dates, start_moments, remaining_days, presence_pcts, chain_keys=None):
+    """
+    Version "chaînes de caractères" de project_end_slots : prend les dates de début
+    au format "YYYY-MM-DD" et retourne les fins estimées formatées comme calculate_end_date.
+    """
+    if not len(start_dates):
+        return []
+    cal, _, ends = project_slots(start_dates, start_moments, remaining_days, presence_pcts, chain_keys)
+    return format_end_slots(cal, ends)
+
+def project_slots(start_dates, start_moments, remaining_days, presence_pcts, chain_keys=None):
+    """
+    Comme project_end_slots, à partir de dates de début "YYYY-MM-DD".
+    Retourne (calendrier utilisé, demi-journées de début effectives, demi-journées de fin).
+    """
+    dates = parse_dates(start_dates)
+    moments = [m if m in MOMENTS else "Matin" for m in start_moments]
+    cal = calendar_for_dates(dates)
+    starts, ends = project_end_slots(cal, cal.slots_of(dates, moments), remaining_days, presence_pcts, chain_keys)
+    return cal, starts, ends
+
+def format_end_slots(cal, ends):
+    """Formate des demi-journées de fin comme calculate_end_date."""
+    # Formatage une seule fois par demi-journée distincte
+    unique_ends, inverse = np.unique(ends, return_inverse=True)
+    unique_labels = []
+    for end in unique_ends.tolist():
+        if end == -1: unique_labels.append("Terminé")
+        elif end == -2: unique_labels.append("Jamais")
+        else: unique_labels.append(cal.slot_label(end))
+    return [unique_labels[i] for i in inverse.ravel().tolist()]
+
+PLANNING_IGNORED_SHEETS = ["Paramètres_Equipe", "Parametres", "Config"]
+PLANNING_SHEET_CACHE_SIZE = 48 # Onglets préparés conservés (quatre plannings annuels)
+XLSX_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+XLSX_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_planning_sheet_cache = OrderedDict()
+_planning_sheet_cache_lock = threading.Lock()
+
+def planning_sheet_digests(source):
+    """
+    Empreintes des onglets d'un classeur .xlsx (chemin ou flux binaire), dans l'ordre du classeur :
+    { nom_onglet: empreinte }. L'empreinte porte sur la partie xl/worksheets/sheetN.xml de l'onglet,
+    les chaînes partagées et les styles (formats de date). Retourne None si la structure n'est pas reconnue.
+    """
     try:
-        current_date = datetime.strptime(str(start_date_str), "%Y-%m-%d").date()
-    except:
-        current_date = date.today()
-
-    current_moment = start_moment if start_moment in ["Matin", "Après-midi"] else "Matin"
-    remaining_days = float(days_to_consume)
-
-    max_iter = 365 * 10 # Sécurité 5 ans en demi-journées
-    i = 0
-    while remaining_days > 0.0001 and i < max_iter:
-        if not is_holiday_or_weekend(current_date):
-            remaining_days -= half_day_burn
-            if remaining_days <= 0.0001:
-                break
+        with zipfile.ZipFile(source) as archive:
+            parts = set(archive.namelist())
+            common = hashlib.sha1()
+            for part in ("xl/sharedStrings.xml", "xl/styles.xml"):
+                if part in parts:
+                    common.update(archive.read(part))
+            rels = ET.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+            targets = {rel.get("Id"): rel.get("Target") for rel in rels}
+            workbook = ET.fromstring(archive.read("xl/workbook.xml"))
+
+            digests = {}
+            for sheet in workbook.iter(f"{{{XLSX_MAIN_NS}}}sheet"):
+                target = targets[sheet.get(f"{{{XLSX_REL_NS}}}id")]
+                part = target.lstrip("/") if target.startswith("/") else posixpath.normpath("xl/" + target)
+                digest = common.copy()
+                with archive.open(part) as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+                digests[sheet.get("name")] = digest.hexdigest()
+            return digests
+    except (KeyError, zipfile.BadZipFile, ET.ParseError):
+        return None
+    finally:
+        if hasattr(source, "seek"):
+            source.seek(0)
+
+def prepare_planning_sheet(df):
+    """
+    Mise en forme d'un onglet lu par pandas, indépendante de la date limite et de l'équipe :
+    dates propagées, colonnes membres, cellules normalisées et marques 'X'.
+    Retourne None si l'onglet n'est pas un onglet de planning.
+    """
+    df.columns = df.columns.astype(str).str.strip()
+    if "Date" not in df.columns: return None
+    if df['Date'].isnull().all(): return None
 
-        # Passage à la demi-journée suivante
-        if current_moment == "Matin":
-            current_moment = "Après-midi"
-        else:
-            current_moment = "Matin"
-            current_date += timedelta(days=1)
-        i += 1
-           
-    return f"{current_date.strftime('%d/%m/%Y')} ({current_moment})"
+    if pd.isna(df['Date'].iloc[0]):
+        first_valid_idx = df['Date'].first_valid_index()
+        if first_valid_idx is not None:
+            df.loc[0:first_valid_idx, 'Date'] = df['Date'].loc[first_valid_idx]
+
+    df['Date'] = df['Date'].ffill()
+    df['Date_dt'] = pd.to_datetime(df['Date']).dt.date
+    df['Month'] = df['Date_dt'].apply(lambda x: x.strftime('%Y-%m'))
 
-def process_excel(filepath, limit_date=None):
+    cols = [c for c in df.columns if c not in ["Date", "Période", "Date_dt", "Month"] and "Unnamed" not in c]
+    # Cellules normalisées et marques 'X' calculées une fois pour tout l'onglet
+    cells = df[cols].apply(lambda col: col.astype(str).str.upper().str.strip())
+    return {"df": df, "cols": cols, "cells": cells, "is_x": cells == 'X'}
+
+def read_planning_sheets(source):
+    """
+    Onglets de planning préparés du classeur, dans l'ordre : [(nom, onglet)] (cf. prepare_planning_sheet).
+    Seuls les onglets dont le contenu a changé depuis un import précédent sont relus : les autres
+    proviennent du cache, indexé par empreinte (cf. planning_sheet_digests). Un nouvel import du
+    planning annuel ne relit donc en général que l'onglet du mois en cours.
+    """
+    digests = planning_sheet_digests(source)
+    if digests is None:
+        xls = pd.read_excel(source, sheet_name=None, engine='openpyxl')
+        sheets = [(name, prepare_planning_sheet(df)) for name, df in xls.items()
+                  if not any(x in name for x in PLANNING_IGNORED_SHEETS)]
+        return [(name, sheet) for name, sheet in sheets if sheet is not None]
+
+    names = [name for name in digests if not any(x in name for x in PLANNING_IGNORED_SHEETS)]
+    prepared = {}
+    with _planning_sheet_cache_lock:
+        for name in names:
+            key = (name, digests[name])
+            if key in _planning_sheet_cache:
+                _planning_sheet_cache.move_to_end(key)
+                prepared[name] = _planning_sheet_cache[key]
+
+    missing = [name for name in names if name not in prepared]
+    if missing:
+        xls = pd.read_excel(source, sheet_name=missing, engine='openpyxl')
+        for name in missing:
+            prepared[name] = prepare_planning_sheet(xls[name])
+        with _planning_sheet_cache_lock:
+            for name in missing:
+                _planning_sheet_cache[(name, digests[name])] = prepared[name]
+            while len(_planning_sheet_cache) > PLANNING_SHEET_CACHE_SIZE:
+                _planning_sheet_cache.popitem(last=False)
+    app.logger.info("Planning : %d onglet(s) relu(s), %d repris du cache", len(missing), len(names) - len(missing))
+    return [(name, prepared[name]) for name in names if prepared[name] is not None]
+
+def process_excel(filepath, limit_date=None, daily=None, report=None, max_memory_mb=None):
     """
-    Analyse le fichier Excel de planning pour calculer la consommation par membre.
+    Analyse le fichier Excel de planning (chemin ou flux binaire) pour calculer la consommation par membre.
     Retourne un dictionnaire : { nom_membre: { 'YYYY-MM': nb_jours } }
+    Si `daily` est fourni, il est complété avec le détail journalier :
+    { nom_membre: { 'YYYY-MM': [jours consommés du 1er au 31] } }
+    Si `report` est fourni (cf. new_planning_report), il est complété avec les anomalies
+    du planning (cf. validate_planning_sheet).
+    Les onglets inchangés depuis un import précédent ne sont pas relus (cf. read_planning_sheets).
+    Si `max_memory_mb` est fourni, l'analyse est interrompue (MemoryBudgetExceeded) dès que la
+    mémoire résidente du processus a augmenté de plus de `max_memory_mb` Mo.
     """
+    rss_start = current_rss_mb() if max_memory_mb else None
     try:
-        xls = pd.read_excel(filepath, sheet_name=None, engine='openpyxl')
         consumption = {}
-        ignored = ["Paramètres_Equipe", "Parametres", "Config"]
 
         if limit_date:
             limit_dt = pd.to_datetime(limit_date).date()
         else:
             limit_dt = None
 
-        for sheet, df in xls.items():
-            if any(x in sheet for x in ignored): continue
-            df.columns = df.columns.astype(str).str.strip()
-            if "Date" not in df.columns: continue
+        if report is not None:
+            known_members = get_team_model().members
+            month_sheets = {}
 
-            if df['Date'].isnull().all(): continue
-            if pd.isna(df['Date'].iloc[0]):
-                first_valid_idx = df['Date'].first_valid_index()
-                if first_valid_idx is not None:
-                    df.loc[0:first_valid_idx, 'Date'] = df['Date'].loc[first_valid_idx]
-
-            df['Date'] = df['Date'].ffill()
-            df['Date_dt'] = pd.to_datetime(df['Date']).dt.date
+        for sheet, prepared in read_planning_sheets(filepath):
+            check_memory_budget(rss_start, max_memory_mb)
+            df, cols, cells, is_x = prepared["df"], prepared["cols"], prepared["cells"], prepared["is_x"]
 
             # Filtrage par date si demandé
             if limit_dt:
-                df = df[df['Date_dt'] <= limit_dt]
-
-            df['Month'] = df['Date_dt'].apply(lambda x: x.strftime('%Y-%m'))
+                rows = df['Date_dt'] <= limit_dt
+                df, cells, is_x = df[rows], cells[rows], is_x[rows]
 
-            cols = [c for c in df.columns if c not in ["Date", "Période", "Date_dt", "Month"] and "Unnamed" not in c]
             months_in_sheet = df['Month'].unique()
 
-            for member in cols:
-                if member not in consumption: consumption[member] = {}
-
+            if report is not None:
+                report["feuilles"] += 1
+                validate_planning_sheet(report, sheet, df, cols, cells, is_x, months_in_sheet, known_members, month_sheets)
+
+            # Demi-journées marquées 'X' par jour et par membre (une ligne par jour), puis par mois
+            days, day_index = np.unique(df['Date_dt'].to_numpy(), return_inverse=True)
+            per_day = np.zeros((len(days), len(cols)))
+            np.add.at(per_day, day_index.ravel(), is_x.to_numpy() * 0.5)
+            day_months = [d.strftime('%Y-%m') for d in days]
+            month_keys, month_index = np.unique(day_months, return_inverse=True)
+            per_month = np.zeros((len(month_keys), len(cols)))
+            np.add.at(per_month, month_index.ravel(), per_day)
+
+            for j, member in enumerate(cols):
+                member_conso = consumption.setdefault(member, {})
                 # Initialisation des mois présents dans cette feuille à 0 si pas déjà vus
                 for m_key in months_in_sheet:
-                    if m_key not in consumption[member]:
-                        consumption[member][m_key] = 0.0
-
-                # Groupement par mois pour ce membre sur cet onglet
-                sub_df = df[df[member].astype(str).str.upper().str.strip() == 'X']
-                monthly_counts = sub_df.groupby('Month').size() * 0.5
-
-                for m_key, val in monthly_counts.items():
-                    consumption[member][m_key] += val
-
+                    member_conso.setdefault(m_key, 0.0)
+                for m_key, val in zip(month_keys.tolist(), per_month[:, j].tolist()):
+                    member_conso[m_key] += val
+
+                if daily is not None:
+                    member_days = daily.setdefault(member, {})
+                    for m_key in months_in_sheet:
+                        member_days.setdefault(m_key, [0.0] * 31)
+                    for i in np.flatnonzero(per_day[:, j]).tolist():
+                        member_days[day_months[i]][days[i].day - 1] += float(per_day[i, j])
+
+        check_memory_budget(rss_start, max_memory_mb)
         return consumption
+    except MemoryBudgetExceeded:
+        raise
     except Exception as e:
         print(f"Erreur process: {e}")
         return {}
 
+# --- IMPORT DES PLANNINGS ---
+
+def open_planning_upload(file):
+    """
+    Prépare un planning reçu pour l'analyse directe depuis son flux (sans copie sur disque).
+    Vérifie qu'il s'agit d'un classeur .xlsx dont la taille décompressée reste sous
+    UPLOAD_MAX_UNCOMPRESSED. Retourne le flux, ou lève ValueError.
+    """
+    stream = file.stream
+    stream.seek(0)
+    if not zipfile.is_zipfile(stream):
+        raise ValueError("Le fichier n'est pas un classeur Excel (.xlsx) valide.")
+    stream.seek(0)
+    with zipfile.ZipFile(stream) as archive:
+        uncompressed = sum(info.file_size for info in archive.infolist())
+    if uncompressed > UPLOAD_MAX_UNCOMPRESSED:
+        raise ValueError(f"Classeur trop volumineux une fois décompressé ({uncompressed // (1024 * 1024)} Mo, "
+                         f"maximum {UPLOAD_MAX_UNCOMPRESSED // (1024 * 1024)} Mo).")
+    stream.seek(0)
+    return stream
+
+def peak_rss_mb():
+    """Pic de mémoire résidente du processus en Mo (None si non mesurable)."""
+    if resource is None:
+        return None
+    # ru_maxrss est en Ko sous Linux, en octets sous macOS
+    scale = 1024 * 1024 if os.uname().sysname == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+def current_rss_mb():
+    """Mémoire résidente actuelle du processus en Mo (Linux), à défaut son pic (None si non mesurable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return peak_rss_mb()
+
+class MemoryBudgetExceeded(ValueError):
+    """Import interrompu : hausse de la mémoire au-delà du budget (cf. UPLOAD_MAX_MEMORY_MB)."""
+
+def check_memory_budget(rss_start, max_memory_mb):
+    """Lève MemoryBudgetExceeded si la mémoire a augmenté de plus de `max_memory_mb` Mo depuis `rss_start`."""
+    if rss_start is None or not max_memory_mb:
+        return
+    growth = (current_rss_mb() or rss_start) - rss_start
+    if growth > max_memory_mb:
+        raise MemoryBudgetExceeded(f"Import interrompu : l'analyse du planning dépasse le budget mémoire "
+                                   f"(+{growth:.0f} Mo, maximum {max_memory_mb} Mo). Rien n'a été importé.")
+
+def purge_stale_uploads():
+    """Politique de rétention : supprime les copies d'imports plus anciennes que UPLOAD_RETENTION_HOURS."""
+    limit = time.time() - UPLOAD_RETENTION_HOURS * 3600
+    for path in glob.glob(os.path.join(app.config['UPLOAD_FOLDER'], "planning_*.xlsx")):
+        try:
+            if os.path.getmtime(path) < limit:
+                os.remove(path)
+        except OSError:
+            pass
+
+def import_planning(source, analysis_date, max_memory_mb=None):
+    """
+    Importe un planning (chemin ou flux binaire) dans l'historique de consommation : les mois
+    du planning écrasent ceux de l'historique. Une analyse rétrospective (date passée) ne tronque
+    pas l'historique : la consommation à date est calculée à part (cf. consumption_at).
+    Retourne le rapport de validation du planning, dépassements de BC compris. Lève
+    MemoryBudgetExceeded, sans rien enregistrer, si l'analyse dépasse `max_memory_mb`.
+    """
+    history_limit = max(analysis_date, date.today().strftime("%Y-%m-%d"))
+    daily = {}
+    report = new_planning_report()
+    new_conso = process_excel(source, limit_date=history_limit, daily=daily, report=report,
+                              max_memory_mb=max_memory_mb)
+    history = load_consumption()
+    daily_history = load_daily_consumption()
+
+    for member, monthly_data in new_conso.items():
+        if member not in history:
+            history[member] = {}
+        for m_key, val in monthly_data.items():
+            history[member][m_key] = val # Écrase le mois avec les nouvelles données
+        daily_history.setdefault(member, {}).update(daily.get(member, {}))
+
+    save_consumption(history)
+    save_daily_consumption(daily_history)
+    validate_consumption_capacity(report, history, get_team_model())
+    return report
+
+def record_analysis(analysis_date):
+    """
+    Rapport de suivi à la date d'analyse, calculé sur la consommation à date, et enregistrement
+    de son instantané (cf. save_snapshot). Retourne le rapport (DataFrame, vide sans BC).
+    """
+    conso_map = consumption_at(analysis_date)
+    model = get_team_model()
+    df = generate_report_dataframe(conso_map, model.members, analysis_date=analysis_date)
+    if not df.empty:
+        save_snapshot(analysis_date, conso_map, df, report_inputs_version(model))
+    return df
+
+# --- VALIDATION DU PLANNING ---
+
+PLANNING_REPORT_MAX_ANOMALIES = 1000
+EMPTY_CELL_VALUES = ['', 'NAN', 'NONE', 'NAT']
+ANOMALY_LABELS = {
+    "feuille_dupliquee": "Onglets couvrant le même mois",
+    "membre_inconnu": "Membres absents de l'équipe",
+    "jour_non_ouvre": "X sur un week-end ou un jour férié",
+    "valeur_inconnue": "Cellules autres que 'X'",
+    "depassement_bc": "Consommation au-delà des jours commandés"
+}
+
+def new_planning_report():
+    """Rapport de validation d'un planning : compteurs par type d'anomalie et détail (borné)."""
+    return {"feuilles": 0, "compteurs": {}, "anomalies": [], "tronque": False}
+
+def add_anomaly(report, kind, **details):
+    report["compteurs"][kind] = report["compteurs"].get(kind, 0) + 1
+    if len(report["anomalies"]) < PLANNING_REPORT_MAX_ANOMALIES:
+        report["anomalies"].append({"type": kind, **details})
+    else:
+        report["tronque"] = True
+
+def add_cell_anomalies(report, kind, mask, make_details):
+    """Ajoute les anomalies des cellules d'un masque (compteur complet, détail dans la limite du rapport)."""
+    rows, cols = np.nonzero(mask)
+    if not len(rows):
+        return
+    report["compteurs"][kind] = report["compteurs"].get(kind, 0) + len(rows)
+    room = max(0, PLANNING_REPORT_MAX_ANOMALIES - len(report["anomalies"]))
+    report["anomalies"].extend({"type": kind, **make_details(r, c)} for r, c in zip(rows[:room], cols[:room]))
+    if len(rows) > room:
+        report["tronque"] = True
+
+def validate_planning_sheet(report, sheet, df, cols, cells, is_x, months_in_sheet, known_members, month_sheets):
+    """
+    Contrôles vectorisés d'un onglet du planning (réutilise les cellules normalisées de process_excel) :
+    mois déjà couverts par un autre onglet, colonnes ne correspondant à aucun membre de l'équipe,
+    'X' sur un jour non ouvré (calendrier des demi-journées) et cellules autres que 'X'.
+    """
+    for m_key in months_in_sheet:
+        first_sheet = month_sheets.setdefault(m_key, sheet)
+        if first_sheet != sheet:
+            add_anomaly(report, "feuille_dupliquee", feuille=sheet, mois=m_key,
+                        detail=f"Mois {m_key} déjà couvert par l'onglet {first_sheet}.")
+
+    for member in cols:
+        # Même rapprochement que la consommation (cf. match_member_conso) : "Nom Prénom" est reconnu
+        if not any(member_name_matches(m, member) for m in known_members):
+            add_anomaly(report, "membre_inconnu", feuille=sheet, membre=member,
+                        detail=f"La colonne {member} ne correspond à aucun membre de l'équipe.")
+
+    if not cols or df.empty:
+        return
+
+    days = df['Date_dt'].to_numpy().astype('datetime64[D]')
+    cal = calendar_for_dates(days)
+    open_rows = cal.open_days[(days - cal.origin).astype(np.int64)]
+    moments = df['Période'].astype(str).to_numpy() if 'Période' in df.columns else [''] * len(df)
+
+    marks = is_x.to_numpy()
+    add_cell_anomalies(report, "jour_non_ouvre", marks & ~open_rows[:, None], lambda r, c: {
+        "feuille": sheet, "membre": cols[c], "date": str(days[r]), "moment": moments[r],
+        "detail": f"X le {days[r]} pour {cols[c]} (week-end ou jour férié)."
+    })
+
+    unknown = ~marks & ~(cells.isna() | cells.isin(EMPTY_CELL_VALUES)).to_numpy()
+    values = df[cols].to_numpy()
+    add_cell_anomalies(report, "valeur_inconnue", unknown, lambda r, c: {
+        "feuille": sheet, "membre": cols[c], "date": str(days[r]), "moment": moments[r], "valeur": str(values[r, c]),
+        "detail": f"Valeur « {values[r, c]} » ignorée le {days[r]} pour {cols[c]}."
+    })
+
+def validate_consumption_capacity(report, conso_map, model):
+    """Signale les prestataires dont la consommation dépasse le total des jours commandés de leurs BCs."""
+    for p in model.prestataires:
+        consumed = member_consumed_total(p, conso_map)
+        ordered = sum(bc.jours_commandes for bc in p.bons_commande)
+        if consumed is not None and consumed > ordered:
+            add_anomaly(report, "depassement_bc", membre=p.nom_complet, consomme=consumed, commande=ordered,
+                        detail=f"{p.nom_complet} : {consumed} j consommés pour {ordered} j commandés.")
+
+def planning_report_summary(report):
+    """Résumé lisible du rapport de validation (None s'il n'y a aucune anomalie)."""
+    if not report["compteurs"]:
+        return None
+    return " ; ".join(f"{ANOMALY_LABELS.get(kind, kind)} : {count}" for kind, count in report["compteurs"].items())
+
+def member_consumed_total(member, conso_map):
+    """
+    Consommation totale d'un membre (mois du planning + consommation initiale), colonnes
+    rattachées par member_name_matches. Retourne None si le membre n'a pas de nom.
+    """
+    if not member.nom.strip() and not member.prenom.strip():
+        return None
+
+    total_consumed = 0
+    for excel_name, val_monthly in conso_map.items():
+        if member_name_matches(member, excel_name):
+            # On cumule les mois ET la valeur initiale
+            total_consumed += sum(v for k, v in val_monthly.items() if k != "__initial__")
+            total_consumed += val_monthly.get("__initial__", 0)
+            # On n'arrête pas la boucle pour pouvoir cumuler si le nom apparaît sous plusieurs formes
+    return total_consumed
+
+def build_member_rows(p, total_consumed, ref_date, next_day, projections, chain_key):
+    """
+    Construit les lignes du rapport de suivi pour les BCs d'un prestataire.
+    - total_consumed : jours consommés par le prestataire (cf. member_consumed_total)
+    - projections : liste complétée avec les BCs dont la fin doit être projetée,
+      sous la forme (ligne, BC, date début, moment, jours restants, % présence, clé de chaînage)
+    La colonne "Fin Estimée" des BCs projetés est remplie par apply_projections.
+    """
+    report_data = []
+
+    # Nom complet (Format "NOM Prénom")
+    nom_complet_display = p.nom_affichage
+    societe = p.societe
+    pct_presence = p.presence_pct
+   
+    # Gestion des BCs (déjà triés par date de début)
+    bcs = p.bons_commande
+   
+    consumed_buffer = total_consumed
+   
+    for bc in bcs:
+        days_ordered = bc.jours_commandes
+        tjm = bc.tjm_ht
+        start_date = bc.date_debut
+        start_moment = bc.moment_debut
+       
+        # Calcul du montant total du BC en K€ (HT)
+        montant_k = (days_ordered * tjm) / 1000.0
+       
+        # Logique de consommation (Bucket)
+        if consumed_buffer >= days_ordered:
+            conso_bc = days_ordered
+            etat = "Terminé"
+            consumed_buffer -= days_ordered
+            fin_estimee = "Clôturé"
+            projection = None
+        elif consumed_buffer > 0:
+            conso_bc = consumed_buffer
+            etat = "En cours"
+            consumed_buffer = 0
+            # Projection à partir du lendemain de la date d'analyse (Matin)
+            fin_estimee = None
+            projection = (next_day, "Matin", days_ordered - conso_bc)
+        else:
+            conso_bc = 0
+            etat = "Futur"
+            # Pour un BC futur, on commence soit à la date de début du BC,
+            # soit au lendemain de la date de référence si le BC a théoriquement déjà commencé.
+            # Le chaînage garantit en plus qu'il ne démarre pas avant la fin du BC précédent.
+            fin_estimee = None
+            if start_date > ref_date:
+                projection = (start_date, start_moment, days_ordered)
+            else:
+                projection = (next_day, "Matin", days_ordered)
+       
+        # Détail des UOs pour affichage
+        uos = bc.source.get('uos', [])
+        uo_summary = " + ".join([f"{uo['quantite']} {uo['code']}" for uo in uos]) if uos else "-"
+
+        # Construction de la ligne selon vos propriétés demandées
+        row = {
+            "État": etat, # Pour le filtre
+            "n°Bon de Commande CHORUS": bc.chorus_id,
+            "Composition UO": uo_summary,
+            "Prestataire": societe,
+            "Montant BC (K€ HT)": f"{montant_k:.2f}", # Format K€
+            "N° commande IBIS": bc.ibis_id,
+            "Jours Commandés": days_ordered,
+            "NOM Prénom": nom_complet_display,
+            "TJM (HT) €": f"{tjm:.2f}",
+            "Date début": f"{start_date} ({start_moment})",
+            "Jours Consommés": conso_bc,
+            "Jours Restants": days_ordered - conso_bc,
+            "Fin Estimée": fin_estimee
+        }
+        report_data.append(row)
+        if projection:
+            projections.append((row, bc) + projection + (pct_presence, chain_key))
+    return report_data
+
+def build_report_rows(team, consumed_totals, ref_date, projections):
+    """
+    Construit les lignes du rapport de suivi (une par BC de prestataire).
+    - consumed_totals : { id_membre: jours consommés } (cf. member_consumed_total)
+    Les BCs d'un même prestataire sont chaînés lors de la projection.
+    """
+    report_data = []
+    prestataires = [p for p in team if p.type == 'prestataire']
+    next_day = (datetime.strptime(ref_date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    for p_idx, p in enumerate(prestataires):
+        total_consumed = consumed_totals.get(p.id)
+        if total_consumed is None:
+            continue
+        report_data.extend(build_member_rows(p, total_consumed, ref_date, next_day, projections, p_idx))
+    return report_data
+
+def apply_projections(projections):
+    """
+    Projette toutes les fins estimées en une seule passe et remplit la colonne "Fin Estimée".
+    Retourne le résultat de project_slots (réutilisable par forecast_projection_costs).
+    """
+    if not projections:
+        return None
+    rows, _, starts, moments, remaining, pcts, chains = zip(*projections)
+    projected = project_slots(starts, moments, remaining, pcts, chain_keys=chains)
+    for row, fin in zip(rows, format_end_slots(projected[0], projected[2])):
+        row["Fin Estimée"] = fin
+    return projected
+
 def generate_report_dataframe(conso_map, team, analysis_date=None):
     """
     Génère un DataFrame Pandas contenant le rapport de suivi des prestataires.
     Associe les données de consommation issues de l'Excel aux informations des BC
-    définies dans l'équipe.
+    définies dans l'équipe (liste de Member, ou dictionnaires issus de equipe.json).
     analysis_date: Date de référence pour le calcul de la fin estimée.
     """
-    report_data = []
-    prestataires = [p for p in team if p.get('type') == 'prestataire']
     ref_date = analysis_date if analysis_date else date.today().strftime("%Y-%m-%d")
-   
-    for p in prestataires:
-        # Nom complet (Format "NOM Prénom")
-        nom_complet_display = f"{p['nom'].upper()} {p['prenom']}"
-        societe = p.get('societe', '-')
-       
-        # Consommation Totale - Matching amélioré pour éviter les ambiguïtés
-        total_consumed = 0
-        p_nom = p.get('nom', '').lower().strip()
-        p_prenom = p.get('prenom', '').lower().strip()
+    team = as_members(team)
+    consumed_totals = {p.id: member_consumed_total(p, conso_map) for p in team if p.type == 'prestataire'}
 
-        if not p_nom and not p_prenom:
-            continue
+    projections = []
+    report_data = build_report_rows(team, consumed_totals, ref_date, projections)
+    apply_projections(projections)
 
-        for excel_name, val_monthly in conso_map.items():
-            en_lower = str(excel_name).lower().strip()
-            # Matching exact (dans les deux sens) ou présence des deux parties du nom
-            if en_lower == f"{p_prenom} {p_nom}" or \
-               en_lower == f"{p_nom} {p_prenom}" or \
-               (p_nom in en_lower and p_prenom in en_lower):
-                # On cumule les mois ET la valeur initiale
-                total_consumed += sum(v for k, v in val_monthly.items() if k != "__initial__")
-                total_consumed += val_monthly.get("__initial__", 0)
-                # On n'arrête pas la boucle pour pouvoir cumuler si le nom apparaît sous plusieurs formes
-       
-        pct_presence = float(p.get('presence_pct', 100))
-       
-        # Gestion des BCs
-        bcs = p.get('bons_commande', [])
-        bcs.sort(key=lambda x: x.get('date_debut') or '9999-99-99')
-       
-        consumed_buffer = total_consumed
-       
-        for bc in bcs:
-            days_ordered = float(bc.get('jours_commandes', 0))
-            tjm = float(bc.get('tjm_ht', 0))
-            start_date = bc.get('date_debut', date.today().strftime("%Y-%m-%d"))
-            start_moment = bc.get('moment_debut', 'Matin')
-           
-            # Calcul du montant total du BC en K€ (HT)
-            montant_k = (days_ordered * tjm) / 1000.0
-           
-            # Logique de consommation (Bucket)
-            if consumed_buffer >= days_ordered:
-                conso_bc = days_ordered
-                etat = "Terminé"
-                consumed_buffer -= days_ordered
-                fin_estimee = "Clôturé"
-            elif consumed_buffer > 0:
-                conso_bc = consumed_buffer
-                etat = "En cours"
-                consumed_buffer = 0
-                # Calcul de la fin estimée à partir de la date de référence
-                remaining_days = days_ordered - conso_bc
-                # On commence le calcul au lendemain de la date d'analyse (Matin)
-                start_calc_dt = datetime.strptime(ref_date, "%Y-%m-%d") + timedelta(days=1)
-                fin_estimee = calculate_end_date(start_calc_dt.strftime("%Y-%m-%d"), "Matin", remaining_days, pct_presence)
-            else:
-                conso_bc = 0
-                etat = "Futur"
-                # Pour un BC futur, on commence soit à la date de début du BC,
-                # soit au lendemain de la date de référence si le BC a théoriquement déjà commencé
-                if start_date > ref_date:
-                    fin_estimee = calculate_end_date(start_date, start_moment, days_ordered, pct_presence)
-                else:
-                    start_calc_dt = datetime.strptime(ref_date, "%Y-%m-%d") + timedelta(days=1)
-                    fin_estimee = calculate_end_date(start_calc_dt.strftime("%Y-%m-%d"), "Matin", days_ordered, pct_presence)
-           
-            # Détail des UOs pour affichage
-            uos = bc.get('uos', [])
-            uo_summary = " + ".join([f"{uo['quantite']} {uo['code']}" for uo in uos]) if uos else "-"
-
-            # Construction de la ligne selon vos propriétés demandées
-            report_data.append({
-                "État": etat, # Pour le filtre
-                "n°Bon de Commande CHORUS": bc.get('chorus_id', '-'),
-                "Composition UO": uo_summary,
-                "Prestataire": societe,
-                "Montant BC (K€ HT)": f"{montant_k:.2f}", # Format K€
-                "N° commande IBIS": bc.get('ibis_id', '-'),
-                "Jours Commandés": days_ordered,
-                "NOM Prénom": nom_complet_display,
-                "TJM (HT) €": f"{tjm:.2f}",
-                "Date début": f"{start_date} ({start_moment})",
-                "Jours Consommés": conso_bc,
-                "Jours Restants": days_ordered - conso_bc,
-                "Fin Estimée": fin_estimee
-            })
-           
     df = pd.DataFrame(report_data)
     return df
 
+# --- HISTORIQUE À DATE ET INSTANTANÉS ---
+
+SNAPSHOT_FULL_EVERY = 20
+
+def load_daily_consumption(readonly=False):
+    """Charge le détail journalier de la consommation { membre: { 'YYYY-MM': [31 valeurs] } }."""
+    return read_json(tenant_path(CONSO_DAYS_FILE), dict, readonly)
+
+def save_daily_consumption(data):
+    write_json(tenant_path(CONSO_DAYS_FILE), data)
+
+def consumption_at(ref_date, history=None, daily=None):
+    """
+    Consommation connue à une date : mois antérieurs complets, mois de la date limité aux jours
+    <= date (somme préfixe du détail journalier, à défaut le total du mois), mois suivants ignorés.
+    """
+    history = load_consumption(readonly=True) if history is None else history
+    daily = load_daily_consumption(readonly=True) if daily is None else daily
+    ref = to_date(ref_date) or date.today()
+    ref_month = ref.strftime('%Y-%m')
+
+    conso_map = {}
+    for member, months in history.items():
+        state = {}
+        member_days = daily.get(member, {})
+        for m_key, val in months.items():
+            if m_key == "__initial__" or m_key < ref_month:
+                state[m_key] = val
+            elif m_key == ref_month:
+                days = member_days.get(m_key)
+                state[m_key] = float(sum(days[:ref.day])) if days else val
+        conso_map[member] = state
+    return conso_map
+
+def report_inputs_version(model):
+    """Version des données (hors consommation) dont dépend le rapport : équipe et catalogue UO."""
+    return fingerprint([[m.version for m in model.members], model.uo_catalog, model.tva_rate])
+
+def snapshot_path(*parts):
+    return os.path.join(tenant_path(SNAPSHOTS_DIR), *parts)
+
+def load_snapshot_index(readonly=False):
+    """Index des instantanés : { 'head': dernier instantané, 'dates': { date: identifiant } }."""
+    return read_json(snapshot_path("index.json"), lambda: {"head": None, "dates": {}}, readonly)
+
+def diff_consumption(previous, current):
+    """Delta entre deux états de consommation (None : membre ou mois supprimé)."""
+    delta = {}
+    for member, months in current.items():
+        prev_months = previous.get(member)
+        if prev_months is None:
+            delta[member] = dict(months)
+            continue
+        changes = {k: v for k, v in months.items() if prev_months.get(k) != v}
+        changes.update({k: None for k in prev_months if k not in months})
+        if changes:
+            delta[member] = changes
+    delta.update({member: None for member in previous if member not in current})
+    return delta
+
+def apply_consumption_delta(previous, delta):
+    state = dict(previous)
+    for member, changes in delta.items():
+        if changes is None:
+            state.pop(member, None)
+            continue
+        months = dict(state.get(member, {}))
+        for k, v in changes.items():
+            if v is None:
+                months.pop(k, None)
+            else:
+                months[k] = v
+        state[member] = months
+    return state
+
+def load_snapshot(snapshot_id):
+    """
+    État complet d'un instantané (date, entrées, consommation, rapport), reconstitué en appliquant
+    les deltas depuis le dernier instantané complet. Les états chargés restent en cache.
+    """
+    cache = tenant_cache().setdefault('snapshots', {})
+    chain = []
+    current = snapshot_id
+    while current and current not in cache:
+        try:
+            with open(snapshot_path("objets", f"{current}.json"), 'r') as f:
+                obj = json.load(f)
+        except (OSError, ValueError):
+            return None
+        chain.append((current, obj))
+        current = obj.get("parent")
+
+    state = cache.get(current) if current else None
+    for obj_id, obj in reversed(chain):
+        state = {
+            "date": obj["date"],
+            "entrees": obj["entrees"],
+            "consommation": apply_consumption_delta(state["consommation"], obj["consommation"]) if state else obj["consommation"],
+            "rapport": obj["rapport"] if "rapport" in obj else state["rapport"],
+            "profondeur": obj.get("profondeur", 0)
+        }
+        cache[obj_id] = state
+    return state
+
+def save_snapshot(ref_date, conso_map, report_df, inputs_version):
+    """
+    Enregistre l'instantané de la consommation et du rapport à une date. Les instantanés sont
+    immuables et identifiés par l'empreinte de leur contenu ; chacun est stocké comme delta
+    du précédent (un instantané complet tous les SNAPSHOT_FULL_EVERY). Retourne son identifiant.
+    """
+    report = {"columns": list(report_df.columns), "rows": report_df.values.tolist()}
+    content = {"date": ref_date, "entrees": inputs_version, "consommation": conso_map, "rapport": report}
+    snapshot_id = hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    index = load_snapshot_index()
+    os.makedirs(snapshot_path("objets"), exist_ok=True)
+    if not os.path.exists(snapshot_path("objets", f"{snapshot_id}.json")):
+        parent = load_snapshot(index["head"]) if index.get("head") else None
+        if parent and parent["profondeur"] + 1 < SNAPSHOT_FULL_EVERY:
+            obj = {
+                "parent": index["head"],
+                "profondeur": parent["profondeur"] + 1,
+                "date": ref_date,
+                "entrees": inputs_version,
+                "consommation": diff_consumption(parent["consommation"], conso_map)
+            }
+            if parent["rapport"] != report:
+                obj["rapport"] = report
+        else:
+            obj = {"parent": None, "profondeur": 0, **content}
+        write_json(snapshot_path("objets", f"{snapshot_id}.json"), obj)
+        index["head"] = snapshot_id
+
+    index["dates"][ref_date] = snapshot_id
+    write_json(snapshot_path("index.json"), index)
+    return snapshot_id
+
+def report_at(analysis_date):
+    """
+    Rapport à une date d'analyse, sans relire de planning Excel : servi directement depuis
+    l'instantané de cette date si l'équipe, le marché et la consommation à date n'ont pas changé
+    depuis, sinon recalculé à partir de la consommation à date.
+    """
+    model = get_team_model()
+    conso_map = consumption_at(analysis_date)
+    snapshot_id = load_snapshot_index(readonly=True)["dates"].get(analysis_date)
+    state = load_snapshot(snapshot_id) if snapshot_id else None
+    if state is not None and state["entrees"] == report_inputs_version(model) \
+            and state["consommation"] == conso_map:
+        return pd.DataFrame(state["rapport"]["rows"], columns=state["rapport"]["columns"])
+    return generate_report_dataframe(conso_map, model.members, analysis_date=analysis_date)
+
+# --- RENDU HTML (CACHE DE FRAGMENTS, COMPRESSION) ---
+
+FRAGMENT_CACHE_SIZE = 4096
+FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+CSRF_PLACEHOLDER = "__csrf_token_placeholder__"
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json', 'text/csv'}
+_fragment_cache = OrderedDict()
+_fragment_cache_bytes = 0
+_fragment_lock = threading.Lock()
+
+def render_fragment(template, key, version, **context):
+    """
+    Rendu d'un fragment de template, mis en cache par (équipe, template, clé) tant que `version`
+    ne change pas (cache LRU borné en nombre d'entrées et en taille). Le jeton CSRF, propre à chaque session, est remplacé
+    dans le fragment par un marqueur substitué par render_page.
+    """
+    global _fragment_cache_bytes
+    cache_key = (current_tenant(), template, key)
+    with _fragment_lock:
+        entry = _fragment_cache.get(cache_key)
+        if entry and entry[0] == version:
+            _fragment_cache.move_to_end(cache_key)
+            return entry[1]
+
+    html = render_template(template, csrf_token=lambda: CSRF_PLACEHOLDER, **context)
+    with _fragment_lock:
+        previous = _fragment_cache.pop(cache_key, None)
+        if previous:
+            _fragment_cache_bytes -= len(previous[1])
+        _fragment_cache[cache_key] = (version, html)
+        _fragment_cache_bytes += len(html)
+        while len(_fragment_cache) > FRAGMENT_CACHE_SIZE or _fragment_cache_bytes > FRAGMENT_CACHE_MAX_BYTES:
+            _, (_, evicted) = _fragment_cache.popitem(last=False)
+            _fragment_cache_bytes -= len(evicted)
+    return html
+
+def render_page(template, **context):
+    """render_template pour une page assemblée à partir de fragments mis en cache."""
+    return render_template(template, **context).replace(CSRF_PLACEHOLDER, generate_csrf())
+
+def page_etag(page, analysis_date):
+    """
+    ETag d'une page HTML calculé avant le rendu : version des données (cf. live_version), équipe,
+    date d'analyse et jeton CSRF de la session. Le jeton signé inséré dans la page change à chaque
+    rendu, l'ETag change donc aussi par période de WTF_CSRF_TIME_LIMIT / 2 pour qu'une page
+    reprise du cache du navigateur porte toujours un jeton valide. None si des messages flash
+    sont en attente (ils doivent être affichés).
+    """
+    if session.get('_flashes'):
+        return None
+    generate_csrf()
+    csrf_field = app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+    time_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    period = int(time.time() // max(1, time_limit // 2)) if time_limit else 0
+    key = (page, live_version(), current_tenant(), list_tenants(), analysis_date, date.today().isoformat(),
+           session.get(csrf_field), period)
+    g.page_etag = hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+    return g.page_etag
+
+def not_modified(etag):
+    """Réponse 304, sans rendu, si le navigateur possède déjà la page `etag` dans l'encodage qu'il accepte."""
+    if etag is None:
+        return None
+    encoding = preferred_encoding()
+    etag += f"-{encoding}" if encoding else ""
+    if not request.if_none_match.contains(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+def preferred_encoding():
+    """Compression acceptée par le client : Brotli (si disponible), gzip ou None."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    """
+    Pages HTML et réponses JSON : ETag (réponse 304 si inchangé) puis compression Brotli
+    (si disponible) ou gzip selon l'en-tête Accept-Encoding. L'ETag est celui calculé avant
+    le rendu (cf. page_etag), sinon une empreinte du contenu.
+    """
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers:
+        return response
+
+    data = response.get_data()
+    encoding = preferred_encoding() if len(data) >= 500 else None
+
+    response.vary.add('Accept-Encoding')
+    etag = (g.get('page_etag') or hashlib.sha1(data).hexdigest()[:20]) + (f"-{encoding}" if encoding else "")
+    response.set_etag(etag)
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        response.set_data(b'')
+        response.headers.pop('Content-Length', None)
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=5))
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(data, compresslevel=6))
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
 # --- ROUTES ---
 
 @app.route('/', methods=['GET', 'POST'])
@@ -299,55 +1623,43 @@ def index():
             analysis_date = date.today().strftime("%Y-%m-%d")
 
         if file:
-            # Sécurité : Nom de fichier unique pour éviter les collisions
-            filename = f"planning_{uuid.uuid4().hex}.xlsx"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            session['last_filepath'] = filepath
+            # Analyse directe du flux reçu : aucune copie du planning n'est écrite sur disque
+            purge_stale_uploads()
+            try:
+                stream = open_planning_upload(file)
+            except ValueError as e:
+                flash(str(e), "danger")
+                return redirect(url_for('index'))
+            rss_before = peak_rss_mb()
+            try:
+                report = import_planning(stream, analysis_date, max_memory_mb=UPLOAD_MAX_MEMORY_MB)
+            except MemoryBudgetExceeded as e:
+                app.logger.warning("%s", e)
+                flash(str(e), "danger")
+                return redirect(url_for('index'))
             session['analysis_date'] = analysis_date
-           
-            # Nouveau traitement : fusion avec l'historique
-            new_conso = process_excel(filepath, limit_date=analysis_date)
-            history = load_consumption()
-
-            for member, monthly_data in new_conso.items():
-                if member not in history:
-                    history[member] = {}
-                for m_key, val in monthly_data.items():
-                    history[member][m_key] = val # Écrase le mois avec les nouvelles données
-
-            save_consumption(history)
+            if rss_before is not None:
+                app.logger.info("Import planning : %.1f Mo reçus, pic mémoire %.0f Mo (+%.0f Mo)",
+                                (request.content_length or 0) / (1024 * 1024), peak_rss_mb(), peak_rss_mb() - rss_before)
 
-            conso_map = history
-            team = load_team()
+            summary = planning_report_summary(report)
+            if summary:
+                flash(f"Anomalies détectées dans le planning : {summary}.", "warning")
 
-            prestataires = [p for p in team if p.get('type') == 'prestataire']
-            if not prestataires:
+            if not get_team_model().prestataires:
                 flash("Attention : Aucun prestataire n'est défini dans la base équipe. Veuillez d'abord ajouter des membres de type 'prestataire'.", "warning")
                 return redirect(url_for('equipe_index'))
 
-            df = generate_report_dataframe(conso_map, team, analysis_date=analysis_date)
+            version = live_version()
+            df = record_analysis(analysis_date)
            
             if df.empty:
                 flash("Aucune donnée de bon de commande trouvée pour les prestataires définis.", "info")
                 return redirect(url_for('index'))
 
-            df_web = df.copy()
-            if not df_web.empty:
-                # Ordre des colonnes pour l'affichage Web
-                cols = [
-                    "n°Bon de Commande CHORUS", "Prestataire", "Composition UO", "Montant BC (K€ HT)",
-                    "N° commande IBIS", "Jours Commandés", "NOM Prénom",
-                    "TJM (HT) €", "Date début", "Jours Consommés",
-                    "Jours Restants", "Fin Estimée", "État"
-                ]
-                existing_cols = [c for c in cols if c in df_web.columns]
-                df_web = df_web[existing_cols]
-
-            table_html = df_web.to_html(classes="table table-striped table-bordered align-middle table-hover", index=False)
-            return render_template('dashboard.html', table=table_html)
+            return render_dashboard(df, analysis_date, version)
 
-    history = load_consumption()
+    history = load_consumption(readonly=True)
     history_summary = []
     for member, months in history.items():
         if months:
@@ -358,40 +1670,86 @@ def index():
                 "count": len([m for m in months.keys() if m != "__initial__"])
             })
 
-    return render_template('index.html', today=date.today().strftime("%Y-%m-%d"), history_summary=history_summary)
+    snapshot_dates = sorted(load_snapshot_index(readonly=True)["dates"], reverse=True)
+    return render_template('index.html', today=date.today().strftime("%Y-%m-%d"), history_summary=history_summary,
+                           snapshot_dates=snapshot_dates)
+
+@app.route('/planning/valider', methods=['POST'])
+def planning_validate():
+    """Valide un planning sans l'importer et retourne le rapport d'anomalies (JSON)."""
+    file = request.files.get('file')
+    if not file:
+        return jsonify({"error": "Aucun fichier fourni."}), 400
+
+    try:
+        stream = open_planning_upload(file)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    report = new_planning_report()
+    new_conso = process_excel(stream, report=report)
+
+    # Dépassements évalués sur l'historique tel qu'il serait après import
+    history = load_consumption()
+    for member, monthly_data in new_conso.items():
+        history.setdefault(member, {}).update(monthly_data)
+    validate_consumption_capacity(report, history, get_team_model())
+    return jsonify(report)
 
 @app.route('/dashboard')
 def dashboard_view():
-    analysis_date = session.get('analysis_date')
+    analysis_date = request.args.get('date') or session.get('analysis_date')
     if not analysis_date:
         analysis_date = date.today().strftime("%Y-%m-%d")
+    if not to_date(analysis_date):
+        flash("Date d'analyse invalide (format attendu AAAA-MM-JJ).", "danger")
+        return redirect(url_for('index'))
 
-    conso_map = load_consumption()
-    team = load_team()
+    cached = not_modified(page_etag('dashboard', analysis_date))
+    if cached is not None:
+        return cached
 
-    df = generate_report_dataframe(conso_map, team, analysis_date=analysis_date)
+    version = live_version()
+    df = report_at(analysis_date)
 
     if df.empty:
         flash("Aucune donnée de consommation enregistrée. Veuillez importer un planning.", "info")
         return redirect(url_for('index'))
 
-    df_web = df.copy()
-    cols = [
-        "n°Bon de Commande CHORUS", "Prestataire", "Composition UO", "Montant BC (K€ HT)",
-        "N° commande IBIS", "Jours Commandés", "NOM Prénom",
-        "TJM (HT) €", "Date début", "Jours Consommés",
-        "Jours Restants", "Fin Estimée", "État"
-    ]
-    existing_cols = [c for c in cols if c in df_web.columns]
-    df_web = df_web[existing_cols]
+    return render_dashboard(df, analysis_date, version)
 
-    table_html = df_web.to_html(classes="table table-striped table-bordered align-middle table-hover", index=False)
-    return render_template('dashboard.html', table=table_html)
+DASHBOARD_COLUMNS = [
+    "n°Bon de Commande CHORUS", "Prestataire", "Composition UO", "Montant BC (K€ HT)",
+    "N° commande IBIS", "Jours Commandés", "NOM Prénom",
+    "TJM (HT) €", "Date début", "Jours Consommés",
+    "Jours Restants", "Fin Estimée", "État"
+]
+
+def report_table(df):
+    """
+    Colonnes affichées du rapport (ordre de l'affichage Web) et cellules formatées en texte :
+    même rendu pour le tableau HTML et pour les mises à jour en direct (cf. live_delta).
+    """
+    columns = [c for c in DASHBOARD_COLUMNS if c in df.columns]
+    rows = [[str(value) for value in row] for row in df[columns].itertuples(index=False, name=None)]
+    return columns, rows
+
+def render_dashboard(df, analysis_date, version):
+    """Tableau de bord du rapport ; `version` (cf. live_version) sert de point de départ au flux des mises à jour."""
+    columns, rows = report_table(df)
+    remember_live_state('dashboard', analysis_date, version, {"columns": columns, "rows": rows})
+    table_html = pd.DataFrame(rows, columns=columns).to_html(
+        classes="table table-striped table-bordered align-middle table-hover", index=False, table_id="rapport")
+    return render_template('dashboard.html', table=table_html, analysis_date=analysis_date,
+                           live_url=live_stream_url('dashboard', analysis_date, version))
 
 @app.route('/history/clear', methods=['POST'])
 def clear_history():
-    if os.path.exists(CONSO_FILE):
-        os.remove(CONSO_FILE)
+    for filename in (CONSO_FILE, CONSO_DAYS_FILE):
+        if os.path.exists(tenant_path(filename)):
+            os.remove(tenant_path(filename))
+    # Les instantanés contiennent la consommation effacée
+    shutil.rmtree(tenant_path(SNAPSHOTS_DIR), ignore_errors=True)
+    tenant_cache().pop('snapshots', None)
     flash("Historique de consommation effacé.", "warning")
     return redirect(url_for('index'))
 
@@ -401,10 +1759,11 @@ def export_excel():
     if not analysis_date:
         analysis_date = date.today().strftime("%Y-%m-%d")
    
-    conso_map = load_consumption()
-    team = load_team()
-    df = generate_report_dataframe(conso_map, team, analysis_date=analysis_date)
-   
+    df = report_at(analysis_date)
+    return send_file(build_report_excel(df), download_name=f"Suivi_Prestataires_{datetime.now().strftime('%Y-%m-%d')}.xlsx", as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+def build_report_excel(df):
+    """Classeur Excel du rapport de suivi (cf. generate_report_dataframe). Retourne un BytesIO."""
     # Nettoyage de la colonne 'État' pour l'export Excel (optionnel)
     if 'État' in df.columns:
         # On peut vouloir garder l'état ou le supprimer selon le besoin du fichier ODS final
@@ -422,13 +1781,17 @@ def export_excel():
             worksheet.column_dimensions[column_cells[0].column_letter].width = length + 2
 
     output.seek(0)
-    return send_file(output, download_name=f"Suivi_Prestataires_{datetime.now().strftime('%Y-%m-%d')}.xlsx", as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return output
 
 @app.route('/equipe')
 def equipe_index():
-    team = load_team()
-    marche = load_marche()
-    history = load_consumption()
+    cached = not_modified(page_etag('team', None))
+    if cached is not None:
+        return cached
+
+    team = load_team(readonly=True)
+    marche = load_marche(readonly=True)
+    history = load_consumption(readonly=True)
 
     # Préparer un mapping pour l'affichage de la conso initiale
     initial_conso_map = {}
@@ -436,7 +1799,28 @@ def equipe_index():
         if "__initial__" in months:
             initial_conso_map[member_name] = months["__initial__"]
 
-    return render_template('team.html', team=team, marche=marche, initial_conso=initial_conso_map)
+    team_rows = []
+    for m in get_team_model().members:
+        initial = initial_conso_map.get(m.nom_complet)
+        team_rows.append(render_fragment('_team_row.html', m.id, (m.version, initial),
+                                         m=m.source, initial_conso=initial_conso_map))
+
+    return render_page('team.html', team=team, marche=marche, initial_conso=initial_conso_map, team_rows=team_rows)
+
+@app.route('/equipe/selection', methods=['POST'])
+def equipe_selection():
+    """Choix de l'équipe de travail (mémorisé en session)."""
+    tenant = request.form.get('equipe', '')
+    if tenant and not is_valid_tenant(tenant):
+        flash("Équipe inconnue.", "danger")
+    elif tenant:
+        session['tenant'] = tenant
+    else:
+        session.pop('tenant', None)
+    # Retour à la page d'origine, sans son ?equipe= qui masquerait le nouveau choix
+    target = urlsplit(request.referrer or url_for('index', equipe=None))
+    query = urlencode([(k, v) for k, v in parse_qsl(target.query, keep_blank_values=True) if k != 'equipe'])
+    return redirect(urlunsplit(target._replace(query=query)))
 
 @app.route('/equipe/save', methods=['POST'])
 def equipe_save():
@@ -498,6 +1882,19 @@ def equipe_save():
                 })
         new_member['bons_commande'] = bcs
 
+        # Les N° CHORUS / IBIS identifient les BCs (paiements, recherche) : ils doivent être uniques
+        used_ids = set()
+        for m in team:
+            if str(m.get('id')) == str(member_id): continue
+            for bc in m.get('bons_commande', []):
+                used_ids.update(x for x in (bc.get('chorus_id'), bc.get('ibis_id')) if x)
+        for bc in bcs:
+            for bc_id in (bc['chorus_id'], bc['ibis_id']):
+                if bc_id and bc_id in used_ids:
+                    flash(f"Erreur : Le numéro de BC {bc_id} est déjà utilisé.", "danger")
+                    return redirect(url_for('equipe_index'))
+                if bc_id: used_ids.add(bc_id)
+
     if member_id:
         for i, m in enumerate(team):
             if str(m.get('id')) == str(member_id):
@@ -535,92 +1932,238 @@ def equipe_delete(id):
 
 # --- BUDGET ---
 
+def member_name_matches(member, excel_name):
+    """
+    Une colonne du planning (ou clé de l'historique) désigne-t-elle ce membre ?
+    "Prénom Nom", "Nom Prénom", ou nom et prénom contenus dans le libellé (sans casse).
+    """
+    p_nom = member.nom.lower().strip()
+    p_prenom = member.prenom.lower().strip()
+    if not p_nom and not p_prenom: return False
+    en_lower = str(excel_name).lower().strip()
+    return en_lower == f"{p_prenom} {p_nom}" or \
+        en_lower == f"{p_nom} {p_prenom}" or \
+        (p_nom in en_lower and p_prenom in en_lower)
+
 def match_member_conso(member, conso_map):
     """Retrouve la consommation mensuelle d'un membre dans la map issue de l'Excel."""
-    p_nom = member.get('nom', '').lower().strip()
-    p_prenom = member.get('prenom', '').lower().strip()
-    if not p_nom and not p_prenom: return {}
-
     total_conso_monthly = {}
     for excel_name, val_monthly in conso_map.items():
-        en_lower = str(excel_name).lower().strip()
-        if en_lower == f"{p_prenom} {p_nom}" or \
-           en_lower == f"{p_nom} {p_prenom}" or \
-           (p_nom in en_lower and p_prenom in en_lower):
+        if member_name_matches(member, excel_name):
             for m_key, val in val_monthly.items():
                 if m_key != "__initial__":
                     total_conso_monthly[m_key] = total_conso_monthly.get(m_key, 0) + val
 
     return total_conso_monthly
 
-def get_budget_data_context():
-    team = load_team()
-    marche = load_marche()
-    tva_rate = marche.get('annexe_financiere', {}).get('tva_taux_percent', 20)
-
-    # --- 1. CALCULS MENSUELS BASÉS SUR L'HISTORIQUE ---
-    conso_map = load_consumption()
+def build_uo_catalog(marche):
+    """Construction du catalogue UO { code: prix unitaire HT } pour accès rapide aux prix."""
+    uo_catalog = {}
+    for cat in marche.get('annexe_financiere', {}).get('lots_expertises', []):
+        for item in cat.get('items', []):
+            uo_catalog[item['code_uo']] = item['prix_unitaire_ht_eur']
+    return uo_catalog
 
+def distribute_member_consumption(bcs, member_conso_monthly):
+    """
+    Répartit la consommation mensuelle d'un prestataire sur ses BCs (triés par date de début).
+    Retourne { 'YYYY-MM': [(BC, coût HT)] } : portions de chaque mois valorisées au TJM du BC
+    consommé. Au-delà du dernier BC, le TJM du dernier BC est utilisé (BC None s'il n'y en a aucun).
+    """
+    portions = {}
+    cumulative_days_distributed = 0
+
+    for m_key in sorted(member_conso_monthly.keys()):
+        days_to_distribute = member_conso_monthly[m_key]
+        month_portions = portions[m_key] = []
+
+        while days_to_distribute > 0.0001:
+            current_bc = None
+            bc_start_cumul = 0
+            for bc in bcs:
+                bc_limit = bc_start_cumul + bc.jours_commandes
+                if cumulative_days_distributed < bc_limit - 0.0001:
+                    current_bc = bc
+                    available_in_bc = bc_limit - cumulative_days_distributed
+                    portion = min(days_to_distribute, available_in_bc)
+
+                    month_portions.append((bc, portion * bc.tjm_ht))
+                    cumulative_days_distributed += portion
+                    days_to_distribute -= portion
+                    break
+                bc_start_cumul = bc_limit
+
+            if not current_bc:
+                # Plus de BC disponible : on utilise le TJM du dernier BC par défaut
+                fallback_tjm = bcs[-1].tjm_ht if bcs else 0
+                month_portions.append((bcs[-1] if bcs else None, days_to_distribute * fallback_tjm))
+                cumulative_days_distributed += days_to_distribute
+                days_to_distribute = 0
+    return portions
+
+def compute_monthly_costs(team, member_conso_map):
+    """
+    Répartit la consommation mensuelle de chaque prestataire sur ses BCs (triés par date
+    de début) et valorise chaque mois au TJM du BC consommé (cf. distribute_member_consumption).
+    - member_conso_map : { id_membre: { 'YYYY-MM': jours } } (cf. match_member_conso)
+    Retourne (coûts par membre et par mois, coûts globaux par mois, liste triée des mois).
+    """
     monthly_costs_per_member = {}
     global_monthly_costs = {}
     all_months = set()
 
     for p in team:
-        if p.get('type') != 'prestataire': continue
-        member_name = f"{p['prenom']} {p['nom']}"
-        member_conso_monthly = match_member_conso(p, conso_map)
+        if p.type != 'prestataire': continue
+        member_name = p.nom_complet
+        member_conso_monthly = member_conso_map.get(p.id)
 
         if not member_conso_monthly: continue
 
-        sorted_months = sorted(member_conso_monthly.keys())
-        all_months.update(sorted_months)
-
-        p_bcs = p.get('bons_commande', [])
-        # On trie les BCs par date de début pour la répartition
-        sorted_p_bcs = sorted(p_bcs, key=lambda x: x.get('date_debut') or '9999-99-99')
-
-        cumulative_days_distributed = 0
+        all_months.update(member_conso_monthly.keys())
         monthly_costs_per_member[member_name] = {}
 
-        for m_key in sorted_months:
-            days_to_distribute = member_conso_monthly[m_key]
-            cost_this_month = 0
-
-            while days_to_distribute > 0.0001:
-                current_bc = None
-                bc_start_cumul = 0
-                for bc in sorted_p_bcs:
-                    bc_limit = bc_start_cumul + bc.get('jours_commandes', 0)
-                    if cumulative_days_distributed < bc_limit - 0.0001:
-                        current_bc = bc
-                        available_in_bc = bc_limit - cumulative_days_distributed
-                        portion = min(days_to_distribute, available_in_bc)
-
-                        cost_this_month += portion * bc.get('tjm_ht', 0)
-                        cumulative_days_distributed += portion
-                        days_to_distribute -= portion
-                        break
-                    bc_start_cumul = bc_limit
-
-                if not current_bc:
-                    # Plus de BC disponible : on utilise le TJM du dernier BC par défaut
-                    fallback_tjm = sorted_p_bcs[-1].get('tjm_ht', 0) if sorted_p_bcs else 0
-                    cost_this_month += days_to_distribute * fallback_tjm
-                    cumulative_days_distributed += days_to_distribute
-                    days_to_distribute = 0
-
+        for m_key, month_portions in distribute_member_consumption(p.bons_commande, member_conso_monthly).items():
+            cost_this_month = sum(cost for _, cost in month_portions)
             monthly_costs_per_member[member_name][m_key] = cost_this_month
             global_monthly_costs[m_key] = global_monthly_costs.get(m_key, 0) + cost_this_month
 
-    sorted_all_months = sorted(list(all_months))
+    return monthly_costs_per_member, global_monthly_costs, sorted(list(all_months))
 
-    # --- 2. CALCULS DES TOTAUX PAR BC ---
-    # Construction du catalogue UO pour accès rapide aux prix
-    uo_catalog = {}
-    for cat in marche.get('annexe_financiere', {}).get('lots_expertises', []):
-        for item in cat.get('items', []):
-            uo_catalog[item['code_uo']] = item['prix_unitaire_ht_eur']
+def compute_bc_budget(bc, tva_rate):
+    """
+    Calcule les montants d'un BC : total commandé (à partir du catalogue UO),
+    montant déjà payé, reste à payer (HT/TTC) et statut par UO (Commandé vs Payé).
+    """
+    # 1. Montant Total du BC
+    bc_total_ht = bc.total_ht
+    bc_total_ttc = bc_total_ht * (1 + tva_rate / 100)
+
+    # 2. Montants Déjà Payés (totaux maintenus à chaque paiement)
+    bc_paid_ht = bc.paid_ht
+    paid_uos_totals = bc.paid_uos # Tracking par code UO
+
+    bc_paid_ttc = bc_paid_ht * (1 + tva_rate / 100)
+
+    # 3. Restants
+    bc_rem_ht = max(0, bc_total_ht - bc_paid_ht)
+    bc_rem_ttc = max(0, bc_total_ttc - bc_paid_ttc)
+
+    # Résumé UOs pour affichage (Commandé vs Payé)
+    uo_status = []
+    for uo in bc.uos:
+        uo_status.append({
+            "code": uo.code,
+            "ordered": uo.quantite,
+            "paid": paid_uos_totals.get(uo.code, 0),
+            "remaining": max(0, uo.quantite - paid_uos_totals.get(uo.code, 0))
+        })
+
+    return {
+        "total_ht": bc_total_ht,
+        "total_ttc": bc_total_ttc,
+        "paid_ht": bc_paid_ht,
+        "paid_ttc": bc_paid_ttc,
+        "remaining_ht": bc_rem_ht,
+        "remaining_ttc": bc_rem_ttc,
+        "uo_status": uo_status
+    }
+
+def forecast_projection_costs(projections, projected=None):
+    """
+    Prévision des coûts futurs des BCs projetés (cf. build_member_rows) : chaque BC est
+    consommé entre sa demi-journée de début effective et sa fin projetée, au rythme du
+    % de présence sur les demi-journées ouvrées, jusqu'à épuisement des jours restants.
+    Les jours de chaque mois sont valorisés au TJM du BC.
+    Le calcul est vectorisé sur (BCs x mois) à partir des bornes mensuelles du calendrier.
+    Retourne { clé de chaînage: { 'YYYY-MM': coût HT } }.
+    """
+    if not projections:
+        return {}
+    _, bcs, starts, moments, remaining, pcts, chains = zip(*projections)
+    if projected is None:
+        projected = project_slots(starts, moments, remaining, pcts, chain_keys=chains)
+    cal, start_slots, end_slots = projected
+
+    idx = np.nonzero(end_slots >= 0)[0]
+    if not len(idx):
+        return {}
+    s, e = start_slots[idx], end_slots[idx]
+    burn = np.asarray(pcts, dtype=float)[idx] / 100.0 / 2.0
+    remaining = np.asarray(remaining, dtype=float)[idx]
+    tjm = np.array([bcs[i].tjm_ht for i in idx])
+
+    # Mois couverts par l'ensemble des projections
+    first_m = int(np.searchsorted(cal.month_bounds, s.min(), side='right')) - 1
+    last_m = int(np.searchsorted(cal.month_bounds, e.max(), side='right')) - 1
+    month_ends = cal.month_bounds[first_m + 1:last_m + 2]
+
+    # Demi-journées ouvrées consommées cumulées à la fin de chaque mois, puis jours par mois
+    upto = np.clip(month_ends[None, :], s[:, None], e[:, None] + 1)
+    open_cum = cal.cum_before[upto] - cal.cum_before[s][:, None]
+    days_cum = np.minimum(open_cum * burn[:, None], remaining[:, None])
+    costs = np.diff(days_cum, axis=1, prepend=0) * tjm[:, None]
+
+    month_keys = cal.month_keys[first_m:last_m + 1]
+    forecast = {}
+    for row_costs, i in zip(costs.tolist(), idx.tolist()):
+        member_forecast = forecast.setdefault(chains[i], {})
+        for m_key, cost in zip(month_keys, row_costs):
+            if cost > 0:
+                member_forecast[m_key] = member_forecast.get(m_key, 0) + cost
+    return forecast
+
+def forecast_monthly_costs(team, consumed_totals, ref_date):
+    """
+    Prévision des coûts mensuels à partir du lendemain de la date de référence.
+    Retourne (coûts prévus par membre et par mois, coûts prévus globaux par mois).
+    """
+    prestataires = [p for p in team if p.type == 'prestataire']
+    projections = []
+    build_report_rows(team, consumed_totals, ref_date, projections)
+
+    forecast_per_member = {}
+    global_forecast = {}
+    for p_idx, member_forecast in forecast_projection_costs(projections).items():
+        p = prestataires[p_idx]
+        forecast_per_member[p.nom_complet] = member_forecast
+        for m_key, cost in member_forecast.items():
+            global_forecast[m_key] = global_forecast.get(m_key, 0) + cost
+    return forecast_per_member, global_forecast
+
+def build_cost_curve(global_actual, global_forecast, tva_rate):
+    """Fusionne coûts réels et prévus en une courbe mensuelle (HT/TTC, avec cumul)."""
+    curve = []
+    cumul_ht = 0
+    for m_key in sorted(set(global_actual) | set(global_forecast)):
+        actual = global_actual.get(m_key, 0)
+        forecast = global_forecast.get(m_key, 0)
+        cumul_ht += actual + forecast
+        curve.append({
+            "month": m_key,
+            "actual_ht": actual,
+            "forecast_ht": forecast,
+            "total_ht": actual + forecast,
+            "total_ttc": (actual + forecast) * (1 + tva_rate / 100),
+            "cumul_ht": cumul_ht,
+            "cumul_ttc": cumul_ht * (1 + tva_rate / 100)
+        })
+    return curve
 
+def get_budget_data_context(analysis_date=None):
+    model = get_team_model()
+    team = model.members
+    marche = load_marche(readonly=True)
+    tva_rate = model.tva_rate
+
+    # --- 1. CALCULS MENSUELS BASÉS SUR L'HISTORIQUE ---
+    # Seule la consommation connue à la date de référence est comptée en réel : la prévision
+    # démarre le lendemain, les mêmes jours ne sont jamais comptés deux fois.
+    ref_date = analysis_date if analysis_date else date.today().strftime("%Y-%m-%d")
+    conso_map = consumption_at(ref_date)
+    member_conso_map = {p.id: match_member_conso(p, conso_map) for p in model.prestataires}
+    monthly_costs_per_member, global_monthly_costs, sorted_all_months = compute_monthly_costs(team, member_conso_map)
+
+    # --- 2. CALCULS DES TOTAUX PAR BC ---
     budget_data = []
     global_summary = {
         "total_ht": 0,
@@ -631,73 +2174,30 @@ def get_budget_data_context():
         "remaining_ttc": 0
     }
 
-    for p in team:
-        if p.get('type') != 'prestataire': continue
-
-        for idx, bc in enumerate(p.get('bons_commande', [])):
-            # 1. Montant Total du BC
-            bc_total_ht = 0
-            ordered_uos = bc.get('uos', [])
-            for uo in ordered_uos:
-                price = uo_catalog.get(uo['code'], 0)
-                bc_total_ht += price * uo['quantite']
-
-            bc_total_ttc = bc_total_ht * (1 + tva_rate / 100)
-
-            # 2. Montants Déjà Payés
-            bc_paid_ht = 0
-            paid_uos_totals = {} # Tracking par code UO
-
-            payments = bc.get('paiements', [])
-            for pay in payments:
-                if pay['type'] == 'uo':
-                    for uo_p in pay.get('uos', []):
-                        price = uo_catalog.get(uo_p['code'], 0)
-                        bc_paid_ht += price * uo_p['quantite']
-                        paid_uos_totals[uo_p['code']] = paid_uos_totals.get(uo_p['code'], 0) + uo_p['quantite']
-                elif pay['type'] == 'percentage':
-                    bc_paid_ht += (pay['percentage'] / 100.0) * bc_total_ht
-
-            bc_paid_ttc = bc_paid_ht * (1 + tva_rate / 100)
-
-            # 3. Restants
-            bc_rem_ht = max(0, bc_total_ht - bc_paid_ht)
-            bc_rem_ttc = max(0, bc_total_ttc - bc_paid_ttc)
-
-            # Résumé UOs pour affichage (Commandé vs Payé)
-            uo_status = []
-            for uo in ordered_uos:
-                uo_status.append({
-                    "code": uo['code'],
-                    "ordered": uo['quantite'],
-                    "paid": paid_uos_totals.get(uo['code'], 0),
-                    "remaining": max(0, uo['quantite'] - paid_uos_totals.get(uo['code'], 0))
-                })
+    for p in model.prestataires:
+        for bc in p.bons_commande:
+            amounts = compute_bc_budget(bc, tva_rate)
 
             bc_data = {
-                "member_id": p['id'],
-                "member_name": f"{p['prenom']} {p['nom']}",
-                "bc_index": idx,
-                "chorus_id": bc.get('chorus_id', '-'),
-                "ibis_id": bc.get('ibis_id', '-'),
-                "total_ht": bc_total_ht,
-                "total_ttc": bc_total_ttc,
-                "paid_ht": bc_paid_ht,
-                "paid_ttc": bc_paid_ttc,
-                "remaining_ht": bc_rem_ht,
-                "remaining_ttc": bc_rem_ttc,
-                "uo_status": uo_status,
-                "payments": payments
+                "member_id": p.id,
+                "member_name": p.nom_complet,
+                "bc_index": bc.index,
+                "bc_id": bc.key,
+                "chorus_id": bc.chorus_id,
+                "ibis_id": bc.ibis_id,
+                **amounts,
+                "payments": bc.source.get('paiements', []),
+                "version": f"{p.id}:{p.nom_complet}:{bc.index}:{bc.version}:{tva_rate}"
             }
             budget_data.append(bc_data)
 
             # Global
-            global_summary["total_ht"] += bc_total_ht
-            global_summary["total_ttc"] += bc_total_ttc
-            global_summary["paid_ht"] += bc_paid_ht
-            global_summary["paid_ttc"] += bc_paid_ttc
-            global_summary["remaining_ht"] += bc_rem_ht
-            global_summary["remaining_ttc"] += bc_rem_ttc
+            for key in global_summary:
+                global_summary[key] += amounts[key]
+
+    # --- 3. PRÉVISIONS DES COÛTS FUTURS ---
+    consumed_totals = {p.id: member_consumed_total(p, conso_map) for p in model.prestataires}
+    forecast_per_member, global_forecast = forecast_monthly_costs(team, consumed_totals, ref_date)
 
     return {
         "budget": budget_data,
@@ -706,18 +2206,56 @@ def get_budget_data_context():
         "today": date.today().strftime("%Y-%m-%d"),
         "monthly_costs": monthly_costs_per_member,
         "global_monthly": global_monthly_costs,
-        "months": sorted_all_months
+        "months": sorted_all_months,
+        "data_version": f"{model.version}:{file_version(tenant_path(CONSO_FILE))}",
+        "forecast_date": ref_date,
+        "forecast_monthly": forecast_per_member,
+        "global_forecast": global_forecast,
+        "cost_curve": build_cost_curve(global_monthly_costs, global_forecast, tva_rate)
     }
 
 @app.route('/budget')
 def budget_index():
-    ctx = get_budget_data_context()
-    return render_template('budget.html', **ctx)
+    cached = not_modified(page_etag('budget', session.get('analysis_date')))
+    if cached is not None:
+        return cached
+
+    version = live_version()
+    ctx = get_budget_data_context(session.get('analysis_date'))
+    remember_live_state('budget', ctx['forecast_date'], version, budget_live_state(ctx))
+
+    # Fragments mis en cache : une carte par BC (un paiement ne re-rend que la carte concernée),
+    # le récapitulatif mensuel tant que la consommation ne change pas.
+    ctx['monthly_html'] = render_budget_monthly(ctx)
+    ctx['forecast_html'] = render_budget_forecast(ctx)
+    ctx['bc_cards'] = [(bc_card_key(item), render_bc_card(item)) for item in ctx['budget']]
+    ctx['live_url'] = live_stream_url('budget', ctx['forecast_date'], version)
+    return render_page('budget.html', **ctx)
+
+def render_budget_monthly(ctx):
+    return render_fragment(
+        '_budget_monthly.html', 'monthly', (ctx['data_version'], ctx['forecast_date']),
+        months=ctx['months'], monthly_costs=ctx['monthly_costs'], global_monthly=ctx['global_monthly'])
+
+def render_budget_forecast(ctx):
+    return render_fragment(
+        '_budget_forecast.html', 'forecast', (ctx['data_version'], ctx['forecast_date']),
+        cost_curve=ctx['cost_curve'], forecast_date=ctx['forecast_date'])
+
+def bc_card_key(item):
+    """Identifiant de la carte d'un BC dans la page (attribut data-bc)."""
+    return item['bc_id'] or f"{item['member_id']}:{item['bc_index']}"
+
+def render_bc_card(item):
+    return render_fragment('_budget_bc_card.html', item['bc_id'] or (item['member_id'], item['bc_index']),
+                           item['version'], item=item)
 
 class BudgetPDF(FPDF):
+    report_title = 'Rapport de Budget et Paiements'
+
     def header(self):
         self.set_font('helvetica', 'B', 15)
-        self.cell(0, 10, 'Rapport de Budget et Paiements', align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        self.cell(0, 10, self.report_title, align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         self.set_font('helvetica', 'I', 10)
         self.cell(0, 10, f'Généré le {datetime.now().strftime("%d/%m/%Y %H:%M")}', align='R', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         self.ln(5)
@@ -729,8 +2267,14 @@ class BudgetPDF(FPDF):
 
 @app.route('/budget/export/pdf')
 def budget_export_pdf():
-    ctx = get_budget_data_context()
+    ctx = get_budget_data_context(session.get('analysis_date'))
+    return send_file(BytesIO(build_budget_pdf(ctx)), download_name=f"Budget_Export_{datetime.now().strftime('%Y-%m-%d')}.pdf", as_attachment=True, mimetype='application/pdf')
+
+def build_budget_pdf(ctx, title=None):
+    """Rapport PDF du budget (cf. get_budget_data_context). Retourne le contenu du PDF."""
     pdf = BudgetPDF(orientation='L', unit='mm', format='A4')
+    if title:
+        pdf.report_title = title
     pdf.alias_nb_pages()
     pdf.add_page()
 
@@ -835,12 +2379,15 @@ def budget_export_pdf():
         if pdf.get_y() > 170:
             pdf.add_page()
 
-    output = pdf.output()
-    return send_file(BytesIO(output), download_name=f"Budget_Export_{datetime.now().strftime('%Y-%m-%d')}.pdf", as_attachment=True, mimetype='application/pdf')
+    return bytes(pdf.output())
 
 @app.route('/budget/export/excel')
 def budget_export_excel():
-    ctx = get_budget_data_context()
+    ctx = get_budget_data_context(session.get('analysis_date'))
+    return send_file(build_budget_excel(ctx), download_name=f"Budget_Export_{datetime.now().strftime('%Y-%m-%d')}.xlsx", as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+def build_budget_excel(ctx):
+    """Classeur Excel du budget (cf. get_budget_data_context). Retourne un BytesIO."""
     output = BytesIO()
 
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
@@ -876,6 +2423,18 @@ def budget_export_excel():
         df_global.to_excel(writer, index=False, sheet_name='Coûts Mensuels', startrow=0)
         df_detailed.to_excel(writer, index=False, sheet_name='Coûts Mensuels', startrow=len(df_global) + 3)
 
+        # Tab 2 bis: Prévisions (réel + prévu)
+        df_curve = pd.DataFrame([{
+            "Mois": point['month'],
+            "Réel HT (€)": point['actual_ht'],
+            "Prévu HT (€)": point['forecast_ht'],
+            "Total HT (€)": point['total_ht'],
+            "Total TTC (€)": point['total_ttc'],
+            "Cumul HT (€)": point['cumul_ht'],
+            "Cumul TTC (€)": point['cumul_ttc']
+        } for point in ctx['cost_curve']])
+        df_curve.to_excel(writer, index=False, sheet_name='Prévisions')
+
         # Tab 3: Détails des BC
         bc_rows = []
         for bc in ctx['budget']:
@@ -893,24 +2452,7 @@ def budget_export_excel():
         df_bc.to_excel(writer, index=False, sheet_name='Détails BC')
 
         # Tab 4: Historique des Paiements
-        pay_rows = []
-        for bc in ctx['budget']:
-            for pay in bc['payments']:
-                detail = ""
-                if pay['type'] == 'percentage':
-                    detail = f"{pay['percentage']}%"
-                else:
-                    detail = ", ".join([f"{uo['quantite']} x {uo['code']}" for uo in pay.get('uos', [])])
-
-                pay_rows.append({
-                    "BC Chorus": bc['chorus_id'],
-                    "Prestataire": bc['member_name'],
-                    "Date Demande": pay.get('date_demande', ''),
-                    "Type": pay['type'],
-                    "ID Service Fait": pay.get('service_fait_id', ''),
-                    "Détail": detail
-                })
-        df_pay = pd.DataFrame(pay_rows)
+        df_pay = pd.DataFrame(build_payment_rows(ctx['budget']))
         df_pay.to_excel(writer, index=False, sheet_name='Historique Paiements')
 
         # Auto-ajustement des colonnes
@@ -921,68 +2463,479 @@ def budget_export_excel():
                 worksheet.column_dimensions[column_cells[0].column_letter].width = length + 2
 
     output.seek(0)
-    return send_file(output, download_name=f"Budget_Export_{datetime.now().strftime('%Y-%m-%d')}.xlsx", as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return output
+
+def build_payment_rows(budget):
+    """Historique des paiements (une ligne par paiement) à partir des BC de get_budget_data_context."""
+    pay_rows = []
+    for bc in budget:
+        for pay in bc['payments']:
+            detail = ""
+            if pay['type'] == 'percentage':
+                detail = f"{pay['percentage']}%"
+            else:
+                detail = ", ".join([f"{uo['quantite']} x {uo['code']}" for uo in pay.get('uos', [])])
+
+            pay_rows.append({
+                "BC Chorus": bc['chorus_id'],
+                "Prestataire": bc['member_name'],
+                "Date Demande": pay.get('date_demande', ''),
+                "Type": pay['type'],
+                "ID Service Fait": pay.get('service_fait_id', ''),
+                "Détail": detail
+            })
+    return pay_rows
+
+# --- RELEVÉS PDF PAR PRESTATAIRE / SOCIÉTÉ ---
+
+PDF_BUNDLE_GROUPS = ('prestataire', 'societe')
+PDF_BUNDLE_WORKERS = int(os.environ.get('PDF_BUNDLE_WORKERS', os.cpu_count() or 1))
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+_pdf_cache = OrderedDict()
+_pdf_cache_bytes = 0
+_pdf_pools = {}
+_pdf_lock = threading.Lock()
+
+def budget_context_subset(ctx, member_names):
+    """Contexte budgétaire (cf. get_budget_data_context) restreint à des prestataires, pour build_budget_pdf."""
+    names = set(member_names)
+    budget = [bc for bc in ctx['budget'] if bc['member_name'] in names]
+    monthly_costs = {name: costs for name, costs in ctx['monthly_costs'].items() if name in names}
+    months = sorted({m_key for costs in monthly_costs.values() for m_key in costs})
+    return {
+        "budget": budget,
+        "summary": {key: sum(bc[key] for bc in budget) for key in ctx['summary']},
+        "months": months,
+        "global_monthly": {m_key: sum(costs.get(m_key, 0) for costs in monthly_costs.values()) for m_key in months},
+        "monthly_costs": monthly_costs
+    }
+
+def pdf_bundle_documents(ctx, group_by):
+    """
+    Relevés à produire : [(nom du groupe, titre, contexte restreint)], un par prestataire
+    (ayant au moins un BC ou une consommation) ou par société.
+    """
+    groups = {}
+    for p in get_team_model().prestataires:
+        if not p.bons_commande and p.nom_complet not in ctx['monthly_costs']:
+            continue
+        group = p.nom_affichage if group_by == 'prestataire' else (p.societe or '-')
+        groups.setdefault(group, []).append(p.nom_complet)
+    label = "Prestataire" if group_by == 'prestataire' else "Société"
+    return [(group, f"Relevé Budget et Paiements - {label} : {group}", budget_context_subset(ctx, names))
+            for group, names in sorted(groups.items())]
+
+def render_budget_pdf(document):
+    """Rendu d'un relevé (exécuté dans un processus du pool) : (titre, contexte) -> contenu du PDF."""
+    title, sub_ctx = document
+    return build_budget_pdf(sub_ctx, title=title)
+
+def pdf_pool(workers):
+    """
+    Pool de processus de rendu PDF, créé à la première utilisation et conservé.
+    Les processus sont lancés en mode 'spawn' : un fork d'un serveur multi-thread pourrait
+    hériter de verrous tenus par d'autres threads.
+    """
+    with _pdf_lock:
+        pool = _pdf_pools.get(workers)
+        if pool is None:
+            pool = _pdf_pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return pool
+
+def build_pdf_bundle(ctx, group_by, workers=None):
+    """
+    Relevés PDF (un par prestataire ou par société) : { nom du groupe: contenu du PDF }.
+    Chaque relevé est mis en cache par (équipe, regroupement, groupe) avec l'empreinte de ses
+    données : seuls les relevés modifiés sont rendus, en parallèle sur `workers` processus
+    (PDF_BUNDLE_WORKERS par défaut ; rendu dans le processus courant s'il n'y en a qu'un).
+    """
+    global _pdf_cache_bytes
+    workers = workers or PDF_BUNDLE_WORKERS
+    tenant = current_tenant()
+    documents = pdf_bundle_documents(ctx, group_by)
+
+    bundle = {}
+    missing = []
+    with _pdf_lock:
+        for group, title, sub_ctx in documents:
+            version = fingerprint([title, sub_ctx])
+            entry = _pdf_cache.get((tenant, group_by, group))
+            if entry and entry[0] == version:
+                _pdf_cache.move_to_end((tenant, group_by, group))
+                bundle[group] = entry[1]
+            else:
+                missing.append((group, version, (title, sub_ctx)))
+
+    if workers > 1 and len(missing) > 1:
+        contents = list(pdf_pool(workers).map(render_budget_pdf, [doc for _, _, doc in missing],
+                                              chunksize=max(1, len(missing) // (workers * 4))))
+    else:
+        contents = [render_budget_pdf(doc) for _, _, doc in missing]
+
+    with _pdf_lock:
+        for (group, version, _), content in zip(missing, contents):
+            bundle[group] = content
+            previous = _pdf_cache.pop((tenant, group_by, group), None)
+            if previous:
+                _pdf_cache_bytes -= len(previous[1])
+            _pdf_cache[(tenant, group_by, group)] = (version, content)
+            _pdf_cache_bytes += len(content)
+        while _pdf_cache and _pdf_cache_bytes > PDF_CACHE_MAX_BYTES:
+            _, (_, evicted) = _pdf_cache.popitem(last=False)
+            _pdf_cache_bytes -= len(evicted)
+    return {group: bundle[group] for group, _, _ in documents}
+
+def write_pdf_bundle(bundle, group_by, day):
+    """Archive ZIP des relevés (un fichier par groupe). Retourne un BytesIO."""
+    output = BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for group, content in bundle.items():
+            name = secure_filename(group) or 'groupe'
+            archive.writestr(f"Releve_{group_by}_{name}_{day}.pdf", content)
+    output.seek(0)
+    return output
+
+@app.route('/budget/export/pdf/<group_by>')
+def budget_export_pdf_bundle(group_by):
+    """Relevés PDF individuels, par prestataire ou par société, dans une archive ZIP."""
+    if group_by not in PDF_BUNDLE_GROUPS:
+        flash("Regroupement inconnu.", "danger")
+        return redirect(url_for('budget_index'))
+    ctx = get_budget_data_context(session.get('analysis_date'))
+    day = datetime.now().strftime('%Y-%m-%d')
+    bundle = build_pdf_bundle(ctx, group_by)
+    return send_file(write_pdf_bundle(bundle, group_by, day), download_name=f"Releves_{group_by}_{day}.zip",
+                     as_attachment=True, mimetype='application/zip')
+
+# --- EXPORTS ANALYTIQUES (CSV / PARQUET / ARROW) ---
+
+EXPORT_DATASETS = ('rapport', 'couts-mensuels', 'paiements')
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file'
+}
+CSV_CHUNK_ROWS = 5000
+
+def build_export_dataframe(dataset, analysis_date=None, ctx=None):
+    """
+    Jeu de données brut à exporter, construit à partir des mêmes calculs que les exports Excel :
+    - 'rapport' : rapport à la date d'analyse (cf. report_at), une ligne par BC / interne
+    - 'couts-mensuels' : coûts réels et prévus par prestataire et par mois (format long)
+    - 'paiements' : historique des paiements
+    `ctx` : contexte budgétaire déjà calculé (cf. get_budget_data_context), à défaut recalculé.
+    """
+    if dataset == 'rapport':
+        ref_date = analysis_date if analysis_date else date.today().strftime("%Y-%m-%d")
+        return report_at(ref_date)
+
+    if ctx is None:
+        ctx = get_budget_data_context(analysis_date)
+    if dataset == 'paiements':
+        return pd.DataFrame(build_payment_rows(ctx['budget']),
+                            columns=["BC Chorus", "Prestataire", "Date Demande", "Type", "ID Service Fait", "Détail"])
+
+    rows = []
+    for name in sorted(set(ctx['monthly_costs']) | set(ctx['forecast_monthly'])):
+        actual = ctx['monthly_costs'].get(name, {})
+        forecast = ctx['forecast_monthly'].get(name, {})
+        for m_key in sorted(set(actual) | set(forecast)):
+            rows.append({
+                "Prestataire": name,
+                "Mois": m_key,
+                "Réel HT (€)": float(actual.get(m_key, 0)),
+                "Prévu HT (€)": float(forecast.get(m_key, 0))
+            })
+    return pd.DataFrame(rows, columns=["Prestataire", "Mois", "Réel HT (€)", "Prévu HT (€)"])
+
+def iter_csv(df, chunk_rows=CSV_CHUNK_ROWS):
+    """Génère le CSV (séparateur ';', BOM UTF-8 pour Excel) par blocs de lignes."""
+    yield '\ufeff' + df.iloc[:0].to_csv(index=False, sep=';')
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(index=False, header=False, sep=';')
+
+def to_arrow_table(df):
+    """Table Arrow d'un DataFrame du rapport (colonnes mixtes texte/nombre converties en texte)."""
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].map(lambda v: None if v is None or (isinstance(v, float) and np.isnan(v)) else str(v))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+def write_columnar(df, fmt):
+    """Sérialise un DataFrame en Parquet ou Arrow IPC (nécessite pyarrow). Retourne un BytesIO."""
+    output = BytesIO()
+    table = to_arrow_table(df)
+    if fmt == 'parquet':
+        pq.write_table(table, output, compression='zstd')
+    else:
+        feather.write_feather(table, output, compression='zstd')
+    output.seek(0)
+    return output
+
+@app.route('/export/<dataset>.<fmt>')
+def export_dataset(dataset, fmt):
+    if dataset not in EXPORT_DATASETS or fmt not in EXPORT_FORMATS:
+        flash("Export inconnu.", "danger")
+        return redirect(url_for('budget_index'))
+    if fmt != 'csv' and pa is None:
+        flash("L'export Parquet / Arrow nécessite la bibliothèque 'pyarrow' (pip install pyarrow).", "danger")
+        return redirect(url_for('budget_index'))
+
+    df = build_export_dataframe(dataset, session.get('analysis_date'))
+    download_name = f"{dataset}_{datetime.now().strftime('%Y-%m-%d')}.{fmt}"
+
+    if fmt == 'csv':
+        # Réponse en flux : le fichier n'est jamais construit entièrement en mémoire
+        return Response(iter_csv(df), mimetype=EXPORT_FORMATS['csv'], # charset=utf-8 ajouté par Werkzeug
+                        headers={'Content-Disposition': f'attachment; filename="{download_name}"'})
+
+    return send_file(write_columnar(df, fmt), download_name=download_name, as_attachment=True, mimetype=EXPORT_FORMATS[fmt])
+
+def check_payment(bc, payment, totals):
+    """
+    Vérifie un paiement contre les quantités commandées (UO) ou le plafond de 100 % (pourcentage),
+    à partir des totaux déjà payés du BC (cf. bc_paid_totals).
+    Retourne le message d'erreur, ou None si le paiement est valide.
+    """
+    if payment['type'] == 'uo':
+        ordered_by_code = {u['code']: u['quantite'] for u in bc.get('uos', [])}
+        pending = {}
+        for up in payment['uos']:
+            code, qty = up['code'], up['quantite']
+            ordered = ordered_by_code.get(code, 0)
+            already_paid = totals["uos"].get(code, 0) + pending.get(code, 0)
+            if already_paid + qty > ordered:
+                return f"Quantité payée ({already_paid + qty}) supérieure à commandée ({ordered}) pour {code}."
+            pending[code] = pending.get(code, 0) + qty
+
+    elif payment['type'] == 'percentage':
+        pct = payment['percentage']
+        if pct <= 0:
+            return "Pourcentage invalide."
+        if totals["percentage"] + pct > 100.1: # 100.1 pour tolérance flottante
+            return f"Le total payé dépasse 100% ({totals['percentage'] + pct}%)."
+
+    else:
+        return "Type de paiement invalide (uo ou percentage)."
+    return None
+
+BULK_PAYMENT_COLUMNS = ["bc_id", "type", "date_demande", "service_fait_id", "code", "quantite", "percentage"]
+
+def read_bulk_payments(req):
+    """
+    Lit un lot de paiements : corps JSON (liste, ou {"paiements": [...]}) ou fichier CSV
+    (champ 'file', séparateur ';' ou ',', colonnes BULK_PAYMENT_COLUMNS, une UO par ligne,
+    cf. group_bulk_csv_rows). Retourne la liste des paiements bruts (numéro de ligne, dictionnaire).
+    Lève ValueError si illisible.
+    """
+    if req.is_json:
+        data = req.get_json(silent=True)
+        if isinstance(data, dict):
+            data = data.get('paiements')
+        if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+            raise ValueError("Corps JSON invalide : liste de paiements attendue.")
+        return list(enumerate(data, start=1))
+
+    file = req.files.get('file')
+    if not file or not file.filename:
+        raise ValueError("Aucun fichier CSV fourni.")
+    try:
+        text = file.read().decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError("Le fichier CSV doit être encodé en UTF-8.")
+    first_line = text.split('\n', 1)[0]
+    reader = csv.DictReader(StringIO(text), delimiter=';' if ';' in first_line else ',')
+    missing = {"bc_id", "type"} - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(f"Colonnes manquantes dans le CSV : {', '.join(sorted(missing))}.")
+    return group_bulk_csv_rows([{k.strip(): (v or '').strip() for k, v in row.items() if k} for row in reader])
+
+def group_bulk_csv_rows(rows):
+    """
+    Regroupe les lignes CSV d'UO d'un même service fait (même bc_id, service_fait_id et
+    date_demande) en un seul paiement à plusieurs UO ("uos"), identifié par sa première ligne.
+    Retourne la liste des paiements (numéro de ligne, dictionnaire).
+    """
+    payments = []
+    by_service = {}
+    for line, row in enumerate(rows, start=1):
+        if row.get('type') == 'uo' and row.get('bc_id'):
+            uo = {"code": row.get('code'), "quantite": row.get('quantite')}
+            key = (row['bc_id'], row.get('service_fait_id', ''), row.get('date_demande', ''))
+            if key in by_service:
+                by_service[key]["uos"].append(uo)
+                continue
+            row = by_service[key] = dict(row, uos=[uo])
+        payments.append((line, row))
+    return payments
+
+def parse_bulk_payment(row):
+    """
+    Convertit une ligne de lot en (référence du BC, paiement).
+    Retourne (None, message d'erreur) si la ligne est invalide.
+    """
+    bc_ref = {"bc_id": str(row['bc_id']).strip()} if row.get('bc_id') else parse_bc_reference(row)
+    if not bc_ref:
+        return None, "Référence du BC manquante (bc_id)."
+    date_demande = str(row.get('date_demande') or '').strip()
+    if not to_date(date_demande):
+        return None, f"Date de demande invalide ({date_demande or 'vide'}), format attendu AAAA-MM-JJ."
+
+    payment = {
+        "type": row.get('type'),
+        "date_demande": date_demande,
+        "service_fait_id": str(row.get('service_fait_id') or '')
+    }
+    if row.get('type') == 'uo':
+        uos = row.get('uos') if isinstance(row.get('uos'), list) else [{"code": row.get('code'), "quantite": row.get('quantite')}]
+        pay_uos = []
+        for up in uos:
+            qty = to_float(up.get('quantite') if isinstance(up, dict) else None, None)
+            code = str(up.get('code') or '').strip() if isinstance(up, dict) else ''
+            if not code or qty is None or qty <= 0:
+                return None, "UO invalide : code et quantité positive attendus."
+            pay_uos.append({"code": code, "quantite": qty})
+        if not pay_uos:
+            return None, "Aucune UO dans le paiement."
+        payment["uos"] = pay_uos
+    elif row.get('type') == 'percentage':
+        pct = to_float(row.get('percentage'), None)
+        if pct is None:
+            return None, "Pourcentage invalide."
+        payment["percentage"] = pct
+    else:
+        return None, "Type de paiement invalide (uo ou percentage)."
+    return bc_ref, payment
+
+def record_bulk_payments(rows):
+    """
+    Valide un lot de paiements (cf. read_bulk_payments) en une passe (totaux payés de chaque BC
+    mis à jour au fil du lot) et l'enregistre en une seule écriture atomique si aucune ligne
+    n'est en erreur. Retourne (nombre de paiements enregistrés, erreurs [{ligne, bc_id, erreur}]).
+    """
+    team = load_team()
+    recorded = 0
+    errors = []
+
+    for line, row in rows:
+        bc_ref, payment = parse_bulk_payment(row)
+        if bc_ref is None:
+            errors.append({"ligne": line, "bc_id": row.get('bc_id'), "erreur": payment})
+            continue
+        member, bc = locate_bc(team, **bc_ref)
+        if not bc:
+            errors.append({"ligne": line, "bc_id": row.get('bc_id'), "erreur": "BC introuvable."})
+            continue
+
+        totals = bc_paid_totals(bc)
+        error = check_payment(bc, payment, totals)
+        if error:
+            errors.append({"ligne": line, "bc_id": row.get('bc_id'), "erreur": error})
+            continue
+        apply_payment(bc, payment, totals)
+        recorded += 1
+
+    # Tout ou rien : les modifications en mémoire sont abandonnées si une ligne est en erreur
+    if errors or not recorded:
+        return 0, errors
+    save_team_json(team)
+    return recorded, errors
+
+def verify_paid_totals(team):
+    """
+    Contrôle de cohérence : compare les totaux payés enregistrés de chaque BC à ceux
+    recalculés depuis l'historique des paiements. Retourne la liste des écarts.
+    """
+    issues = []
+    for member in team:
+        for bc in member.get('bons_commande', []):
+            if not bc.get('paiements') and PAID_TOTALS_KEY not in bc:
+                continue
+            stored = bc.get(PAID_TOTALS_KEY)
+            rebuilt = rebuild_paid_totals(bc)
+            consistent = isinstance(stored, dict) \
+                and {k: stored.get(k) for k in ("nb", "sans_sf")} == {k: rebuilt[k] for k in ("nb", "sans_sf")} \
+                and abs(to_float(stored.get("percentage")) - rebuilt["percentage"]) < 1e-6 \
+                and isinstance(stored.get("uos"), dict) \
+                and set(stored["uos"]) == set(rebuilt["uos"]) \
+                and all(abs(to_float(stored["uos"][c]) - q) < 1e-6 for c, q in rebuilt["uos"].items())
+            if not consistent:
+                issues.append({
+                    "membre": f"{member.get('prenom', '')} {member.get('nom', '')}".strip(),
+                    "bc_id": bc.get('chorus_id') or bc.get('ibis_id'),
+                    "enregistre": stored,
+                    "recalcule": rebuilt
+                })
+    return issues
+
+@app.route('/budget/totaux')
+def budget_totals_check():
+    """Rapport de cohérence des totaux payés (JSON)."""
+    team = load_team(readonly=True)
+    issues = verify_paid_totals(team)
+    return jsonify({"bcs": sum(len(m.get('bons_commande', [])) for m in team), "incoherences": issues})
+
+@app.route('/budget/totaux/reconstruire', methods=['POST'])
+def budget_totals_rebuild():
+    """Recalcule les totaux payés de tous les BC depuis l'historique des paiements."""
+    team = load_team()
+    issues = verify_paid_totals(team)
+    for member in team:
+        for bc in member.get('bons_commande', []):
+            if bc.get('paiements') or PAID_TOTALS_KEY in bc:
+                bc[PAID_TOTALS_KEY] = rebuild_paid_totals(bc)
+    save_team_json(team)
+    if request.is_json:
+        return jsonify({"corriges": len(issues)})
+    flash(f"Totaux payés recalculés ({len(issues)} BC corrigé(s)).", "success")
+    return redirect(url_for('budget_index'))
+
+def parse_bc_reference(form):
+    """
+    Lit la référence d'un BC dans un formulaire : identifiant CHORUS/IBIS (bc_id),
+    ou à défaut le couple (member_id, bc_index). Retourne None si elle est invalide.
+    """
+    if form.get('bc_id'):
+        return {"bc_id": form.get('bc_id')}
+    try:
+        return {"member_id": int(form.get('member_id')), "bc_index": int(form.get('bc_index'))}
+    except (TypeError, ValueError):
+        return None
 
 @app.route('/budget/payer', methods=['POST'])
 def budget_payer():
     team = load_team()
-    marche = load_marche()
 
-    member_id = int(request.form.get('member_id'))
-    bc_index = int(request.form.get('bc_index'))
+    bc_ref = parse_bc_reference(request.form)
     pay_type = request.form.get('pay_type') # 'uo' or 'percentage'
     date_demande = request.form.get('date_demande')
     sf_id = request.form.get('service_fait_id', '')
 
-    # Catalogue UO pour validation
-    uo_catalog = {}
-    for cat in marche.get('annexe_financiere', {}).get('lots_expertises', []):
-        for item in cat.get('items', []):
-            uo_catalog[item['code_uo']] = item['prix_unitaire_ht_eur']
-
-    member = next((m for m in team if m['id'] == member_id), None)
-    if not member or 'bons_commande' not in member or bc_index >= len(member['bons_commande']):
+    member, bc = locate_bc(team, **bc_ref) if bc_ref else (None, None)
+    if not bc:
         flash("BC Introuvable.", "danger")
         return redirect(url_for('budget_index'))
 
-    bc = member['bons_commande'][bc_index]
     if 'paiements' not in bc: bc['paiements'] = []
 
+    payment = None
     if pay_type == 'uo':
         codes = request.form.getlist('pay_uo_code[]')
         qtys = request.form.getlist('pay_uo_qty[]')
-        pay_uos = []
-
-        # Validation des quantités
-        paid_totals = {}
-        for p in bc['paiements']:
-            if p['type'] == 'uo':
-                for up in p.get('uos', []):
-                    paid_totals[up['code']] = paid_totals.get(up['code'], 0) + up['quantite']
-
-        for i in range(len(codes)):
-            if codes[i] and qtys[i]:
-                code = codes[i]
-                qty = float(qtys[i])
-                ordered = next((u['quantite'] for u in bc['uos'] if u['code'] == code), 0)
-                already_paid = paid_totals.get(code, 0)
-
-                if already_paid + qty > ordered:
-                    flash(f"Erreur: Quantité payée ({already_paid + qty}) supérieure à commandée ({ordered}) pour {code}.", "danger")
-                    return redirect(url_for('budget_index'))
-
-                pay_uos.append({"code": code, "quantite": qty})
+        pay_uos = [{"code": codes[i], "quantite": float(qtys[i])}
+                   for i in range(len(codes)) if codes[i] and qtys[i]]
 
         if not pay_uos:
             flash("Aucune UO sélectionnée.", "warning")
             return redirect(url_for('budget_index'))
 
-        bc['paiements'].append({
+        payment = {
             "type": "uo",
             "date_demande": date_demande,
             "service_fait_id": sf_id,
             "uos": pay_uos
-        })
+        }
 
     elif pay_type == 'percentage':
         try:
@@ -991,36 +2944,69 @@ def budget_payer():
             flash("Pourcentage invalide.", "danger")
             return redirect(url_for('budget_index'))
 
-        # Validation (Somme des % < 100% ? Optionnel mais prudent)
-        total_pct = sum(p['percentage'] for p in bc['paiements'] if p['type'] == 'percentage')
-        if total_pct + pct > 100.1: # 100.1 pour tolérance flottante
-            flash(f"Erreur: Le total payé dépasse 100% ({total_pct + pct}%).", "danger")
-            return redirect(url_for('budget_index'))
-
-        bc['paiements'].append({
+        payment = {
             "type": "percentage",
             "date_demande": date_demande,
             "service_fait_id": sf_id,
             "percentage": pct
-        })
+        }
+
+    if payment:
+        totals = bc_paid_totals(bc)
+        error = check_payment(bc, payment, totals)
+        if error:
+            flash(f"Erreur: {error}", "danger")
+            return redirect(url_for('budget_index'))
+        apply_payment(bc, payment, totals)
 
     save_team_json(team)
     flash("Paiement enregistré.", "success")
     return redirect(url_for('budget_index'))
 
+@app.route('/budget/payer/lot', methods=['POST'])
+def budget_payer_bulk():
+    """
+    Enregistrement d'un lot de paiements (JSON ou CSV). Tout ou rien : si une ligne est
+    en erreur, aucun paiement n'est enregistré et le rapport d'erreurs par ligne est retourné.
+    """
+    try:
+        rows = read_bulk_payments(request)
+    except ValueError as e:
+        if request.is_json:
+            return jsonify({"error": str(e)}), 400
+        flash(str(e), "danger")
+        return redirect(url_for('budget_index'))
+
+    recorded, errors = record_bulk_payments(rows)
+
+    if request.is_json:
+        return jsonify({"enregistres": recorded, "erreurs": errors}), (422 if errors else 200)
+
+    if errors:
+        details = " ; ".join(f"ligne {e['ligne']} : {e['erreur']}" for e in errors[:10])
+        more = f" (+{len(errors) - 10} autres)" if len(errors) > 10 else ""
+        flash(f"Lot refusé, {len(errors)} ligne(s) en erreur : {details}{more}", "danger")
+    elif recorded:
+        flash(f"{recorded} paiement(s) enregistré(s).", "success")
+    else:
+        flash("Aucun paiement dans le fichier.", "warning")
+    return redirect(url_for('budget_index'))
+
 @app.route('/budget/update_sf', methods=['POST'])
 def budget_update_sf():
     team = load_team()
-    member_id = int(request.form.get('member_id'))
-    bc_index = int(request.form.get('bc_index'))
+    bc_ref = parse_bc_reference(request.form)
     pay_index = int(request.form.get('pay_index'))
     sf_id = request.form.get('service_fait_id')
 
-    member = next((m for m in team if m['id'] == member_id), None)
-    if member and bc_index < len(member['bons_commande']):
-        bc = member['bons_commande'][bc_index]
+    member, bc = locate_bc(team, **bc_ref) if bc_ref else (None, None)
+    if bc:
         if 'paiements' in bc and pay_index < len(bc['paiements']):
-            bc['paiements'][pay_index]['service_fait_id'] = sf_id
+            totals = bc_paid_totals(bc)
+            payment = bc['paiements'][pay_index]
+            totals["sans_sf"] += int(not sf_id) - int(not payment.get('service_fait_id'))
+            payment['service_fait_id'] = sf_id
+            bc[PAID_TOTALS_KEY] = totals
             save_team_json(team)
             flash("Identifiant Service Fait mis à jour.", "success")
         else:
@@ -1030,7 +3016,877 @@ def budget_update_sf():
 
     return redirect(url_for('budget_index'))
 
+@app.route('/search')
+def search():
+    """Recherche par préfixe : /search?q=EJ-2026&type=bc&limit=20"""
+    try:
+        limit = min(int(request.args.get('limit', 50)), 500)
+    except ValueError:
+        limit = 50
+    results = get_search_index().search(request.args.get('q', ''), limit=limit, doc_type=request.args.get('type'))
+    return jsonify({"query": request.args.get('q', ''), "count": len(results), "results": results})
+
+# --- SIMULATIONS (WHAT-IF) ---
+
+SCENARIO_MEMBER_FIELDS = ['presence_pct']
+SCENARIO_BC_FIELDS = ['jours_commandes', 'date_debut', 'moment_debut', 'tjm_ht', 'uos']
+
+def parse_scenario_bc(values):
+    """Valide et convertit les champs de BC d'une modification de scénario."""
+    bc = {}
+    for field in SCENARIO_BC_FIELDS:
+        if field not in values: continue
+        value = values[field]
+        if field in ('jours_commandes', 'tjm_ht'):
+            value = float(value)
+            if value < 0: raise ValueError(f"{field} doit être positif.")
+        elif field == 'date_debut':
+            datetime.strptime(str(value), "%Y-%m-%d")
+        elif field == 'moment_debut':
+            if value not in MOMENTS: raise ValueError(f"Moment invalide : {value}")
+        elif field == 'uos':
+            value = [{"code": str(uo['code']), "quantite": float(uo['quantite'])} for uo in value]
+        bc[field] = value
+    return bc
+
+def apply_scenario(team, overrides, uo_catalog):
+    """
+    Applique une liste de modifications à l'équipe (liste de Member) sans la modifier ni la
+    sauvegarder. Seuls les membres modifiés sont reconstruits, les autres sont partagés avec
+    l'équipe d'origine.
+    Chaque modification est de la forme :
+    - {"member_id": 2, "presence_pct": 80}
+    - {"member_id": 2, "bc_id": "EJ-2026-001", "jours_commandes": 30, "date_debut": "2026-03-01"}
+      (ou "bc_index" : position du BC dans equipe.json)
+    - {"member_id": 2, "add_bc": {"chorus_id": "SIMU", "jours_commandes": 40, ...}}
+    Lève ValueError si une modification est invalide.
+    """
+    positions = {m.id: i for i, m in enumerate(team)}
+    new_team = list(team)
+    sources = {}
+
+    if not isinstance(overrides, list):
+        raise ValueError("Les modifications d'un scénario doivent être une liste.")
+    for override in overrides:
+        if not isinstance(override, dict):
+            raise ValueError(f"Modification invalide : {override}")
+        try:
+            member_id = int(override.get('member_id'))
+        except (TypeError, ValueError):
+            raise ValueError(f"Identifiant de membre invalide : {override.get('member_id')}")
+        if member_id not in positions:
+            raise ValueError(f"Membre introuvable : {member_id}")
+
+        i = positions[member_id]
+        if i not in sources:
+            member = dict(team[i].source)
+            member['bons_commande'] = list(member.get('bons_commande', []))
+            sources[i] = member
+        member = sources[i]
+
+        for field in SCENARIO_MEMBER_FIELDS:
+            if field in override:
+                member[field] = float(override[field])
+                if field == 'presence_pct' and not 0 <= member[field] <= 100:
+                    raise ValueError(f"presence_pct doit être compris entre 0 et 100 : {override[field]}")
+
+        bc_values = parse_scenario_bc(override)
+        if 'bc_id' in override:
+            entry = next((i for i, bc in enumerate(member['bons_commande'])
+                          if override['bc_id'] in (bc.get('chorus_id'), bc.get('ibis_id'))), None)
+            if entry is None:
+                raise ValueError(f"BC introuvable : {override['bc_id']}")
+            member['bons_commande'][entry] = {**member['bons_commande'][entry], **bc_values}
+        elif 'bc_index' in override:
+            bc_index = int(override['bc_index'])
+            if not 0 <= bc_index < len(member['bons_commande']):
+                raise ValueError(f"BC introuvable : {member_id}/{bc_index}")
+            member['bons_commande'][bc_index] = {**member['bons_commande'][bc_index], **bc_values}
+        elif bc_values:
+            raise ValueError("bc_id ou bc_index est requis pour modifier un BC.")
+
+        if 'add_bc' in override:
+            if not isinstance(override['add_bc'], dict):
+                raise ValueError(f"add_bc invalide : {override['add_bc']}")
+            new_bc = parse_scenario_bc(override['add_bc'])
+            new_bc.setdefault('date_debut', date.today().strftime("%Y-%m-%d"))
+            new_bc['chorus_id'] = str(override['add_bc'].get('chorus_id', 'SIMULATION'))
+            new_bc['ibis_id'] = str(override['add_bc'].get('ibis_id', '-'))
+            member['bons_commande'].append(new_bc)
+
+    for i, member in sources.items():
+        new_team[i] = build_member(member, uo_catalog)
+    return new_team
+
+def evaluate_scenarios(scenarios, analysis_date=None, team=None, conso_map=None, marche=None):
+    """
+    Évalue en lot une liste de scénarios [{"name": ..., "overrides": [...]}] (cf. apply_scenario)
+    sans rien sauvegarder. Le scénario de référence (équipe actuelle) est évalué en premier.
+    La consommation rapprochée par membre et le catalogue UO sont calculés une seule fois,
+    les fins estimées de tous les scénarios sont projetées en une seule passe, et les calculs
+    par membre / par BC sont réutilisés pour tout ce qu'un scénario ne modifie pas.
+    Retourne pour chaque scénario les fins estimées par BC, les coûts mensuels (réels issus de
+    l'historique + prévus, cf. forecast_projection_costs) et les restes à payer, avec l'écart
+    par rapport à la référence.
+    """
+    if team is None:
+        model = get_team_model()
+    else:
+        model = build_team_model(team, load_marche(readonly=True) if marche is None else marche)
+    ref_date = analysis_date if analysis_date else date.today().strftime("%Y-%m-%d")
+    # Réel limité à la consommation connue à la date de référence (cf. get_budget_data_context)
+    conso_map = consumption_at(ref_date) if conso_map is None else conso_map
+    tva_rate = model.tva_rate
+    team = model.members
+
+    prestataires = model.prestataires
+    consumed_totals = {p.id: member_consumed_total(p, conso_map) for p in prestataires}
+    member_conso_map = {p.id: match_member_conso(p, conso_map) for p in prestataires}
+
+    if not isinstance(scenarios, list):
+        raise ValueError("scenarios doit être une liste.")
+    variants = [("Référence", team)]
+    for i, scenario in enumerate(scenarios, 1):
+        if not isinstance(scenario, dict):
+            raise ValueError(f"Scénario invalide : {scenario}")
+        variants.append((scenario.get('name') or f"Scénario {i}", apply_scenario(team, scenario.get('overrides', []), model.uo_catalog)))
+
+    # Caches par objet : un membre / BC non modifié est partagé entre scénarios,
+    # ses lignes de rapport (et donc sa projection) sont calculées une seule fois.
+    next_day = (datetime.strptime(ref_date, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    member_rows_cache = {}
+    member_costs_cache = {}
+    bc_budget_cache = {}
+    projections = []
+    results = []
+
+    for name, s_team in variants:
+        rows = []
+        member_keys = []
+        global_monthly = {}
+        summary = dict.fromkeys(["total_ht", "total_ttc", "paid_ht", "paid_ttc", "remaining_ht", "remaining_ttc"], 0)
+        for p in s_team:
+            if p.type != 'prestataire': continue
+            if consumed_totals.get(p.id) is not None:
+                if id(p) not in member_rows_cache:
+                    member_rows_cache[id(p)] = build_member_rows(p, consumed_totals[p.id], ref_date, next_day, projections, id(p))
+                rows.extend(member_rows_cache[id(p)])
+                member_keys.append(id(p))
+
+            if id(p) not in member_costs_cache:
+                member_costs_cache[id(p)] = compute_monthly_costs([p], member_conso_map)[1]
+            for m_key, cost in member_costs_cache[id(p)].items():
+                global_monthly[m_key] = global_monthly.get(m_key, 0) + cost
+
+            for bc in p.bons_commande:
+                if id(bc) not in bc_budget_cache:
+                    bc_budget_cache[id(bc)] = compute_bc_budget(bc, tva_rate)
+                for key in summary:
+                    summary[key] += bc_budget_cache[id(bc)][key]
+
+        results.append({
+            "name": name,
+            "rows": rows,
+            "member_keys": member_keys,
+            "actual": global_monthly,
+            "summary": summary
+        })
+
+    # Fins estimées et prévisions de tous les scénarios en une seule projection
+    forecasts = forecast_projection_costs(projections, apply_projections(projections))
+
+    reference = results[0]["summary"]
+    for result in results:
+        global_forecast = {}
+        for key in result.pop("member_keys"):
+            for m_key, cost in forecasts.get(key, {}).items():
+                global_forecast[m_key] = global_forecast.get(m_key, 0) + cost
+        curve = build_cost_curve(result.pop("actual"), global_forecast, tva_rate)
+        result["monthly_costs_ht"] = {point["month"]: point["total_ht"] for point in curve}
+        result["monthly_costs_ttc"] = {point["month"]: point["total_ttc"] for point in curve}
+        result["forecast_costs_ht"] = {point["month"]: point["forecast_ht"] for point in curve if point["forecast_ht"]}
+        result["bcs"] = [{
+            "member_name": row["NOM Prénom"],
+            "chorus_id": row["n°Bon de Commande CHORUS"],
+            "etat": row["État"],
+            "jours_restants": row["Jours Restants"],
+            "fin_estimee": row["Fin Estimée"]
+        } for row in result.pop("rows")]
+        result["delta"] = {key: result["summary"][key] - reference[key] for key in reference}
+    return results
+
+@app.route('/budget/scenarios', methods=['POST'])
+def budget_scenarios():
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return jsonify({"error": "Corps JSON attendu : {\"scenarios\": [...]}."}), 400
+    analysis_date = payload.get('analysis_date') or session.get('analysis_date')
+    try:
+        results = evaluate_scenarios(payload.get('scenarios', []), analysis_date=analysis_date)
+    except (ValueError, TypeError, KeyError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"analysis_date": analysis_date, "scenarios": results})
+
+# --- AGRÉGATS BUDGÉTAIRES (MATÉRIALISÉS) ---
+
+ROLLUP_TABLES = ('societes', 'categories', 'uo')
+ROLLUP_NO_CATEGORY = "Hors catalogue"
+ROLLUP_NO_DATE = "-"
+
+def build_uo_categories(marche):
+    """Catégorie du marché de chaque code UO : { code: lots_expertises[*].categorie }."""
+    return {item['code_uo']: cat.get('categorie', ROLLUP_NO_CATEGORY)
+            for cat in marche.get('annexe_financiere', {}).get('lots_expertises', [])
+            for item in cat.get('items', [])}
+
+def add_rollup(table, contribution, sign=1):
+    """Ajoute (sign=1) ou retire (sign=-1) une contribution imbriquée { clé: ... { champ: montant } } à une table."""
+    for key, value in contribution.items():
+        if isinstance(value, dict):
+            add_rollup(table.setdefault(key, {}), value, sign)
+            if not table[key]:
+                del table[key]
+        else:
+            total = round(table.get(key, 0) + sign * value, 6)
+            if abs(total) < 1e-6:
+                table.pop(key, None)
+            else:
+                table[key] = total
+
+def bc_category_shares(bc, categories):
+    """Répartition d'un BC entre les catégories du marché, au prorata de la valeur de ses UOs."""
+    weights = {}
+    use_amounts = bc.total_ht > 0
+    for uo in bc.uos:
+        category = categories.get(uo.code, ROLLUP_NO_CATEGORY)
+        weights[category] = weights.get(category, 0) + (uo.montant_ht if use_amounts else uo.quantite)
+    total = sum(weights.values())
+    if not total:
+        return {ROLLUP_NO_CATEGORY: 1.0}
+    return {category: weight / total for category, weight in weights.items()}
+
+def member_rollup_contributions(p, member_conso_monthly, categories):
+    """
+    Contribution d'un prestataire aux tables d'agrégats :
+    - societes : { société: { 'YYYY-MM': { consomme_ht, paye_ht } } }
+    - categories : { catégorie: { 'YYYY-MM': { consomme_ht, paye_ht } } }
+    - uo : { code: { commande, paye, commande_ht, paye_ht } }
+    La consommation est valorisée comme dans compute_monthly_costs, les paiements au mois de
+    leur demande. Un paiement en pourcentage paie ce pourcentage de chaque UO du BC.
+    """
+    societe = p.societe or '-'
+    by_month = {}
+    by_category = {}
+    by_uo = {}
+
+    def add(category, m_key, field, amount):
+        if not amount:
+            return
+        cell = by_month.setdefault(m_key, {})
+        cell[field] = cell.get(field, 0) + amount
+        cell = by_category.setdefault(category, {}).setdefault(m_key, {})
+        cell[field] = cell.get(field, 0) + amount
+
+    def add_uo(code, **amounts):
+        cell = by_uo.setdefault(code, {})
+        for field, amount in amounts.items():
+            cell[field] = cell.get(field, 0) + amount
+
+    shares = {}
+    for bc in p.bons_commande:
+        shares[bc.index] = bc_category_shares(bc, categories)
+        for uo in bc.uos:
+            paid_qty = uo.quantite * bc.paid_percentage / 100.0
+            add_uo(uo.code, commande=uo.quantite, commande_ht=uo.montant_ht, paye=paid_qty, paye_ht=paid_qty * uo.prix_unitaire_ht)
+
+        for payment in bc.paiements:
+            m_key = (payment.date_demande or '')[:7] or ROLLUP_NO_DATE
+            if payment.type == 'uo':
+                for uo in payment.uos:
+                    add(categories.get(uo.code, ROLLUP_NO_CATEGORY), m_key, "paye_ht", uo.montant_ht)
+                    add_uo(uo.code, paye=uo.quantite, paye_ht=uo.montant_ht)
+            elif payment.type == 'percentage':
+                amount = payment.percentage / 100.0 * bc.total_ht
+                for category, share in shares[bc.index].items():
+                    add(category, m_key, "paye_ht", amount * share)
+
+    for m_key, month_portions in distribute_member_consumption(p.bons_commande, member_conso_monthly).items():
+        for bc, cost in month_portions:
+            for category, share in (shares[bc.index] if bc else {ROLLUP_NO_CATEGORY: 1.0}).items():
+                add(category, m_key, "consomme_ht", cost * share)
+
+    return {"societes": {societe: by_month} if by_month else {}, "categories": by_category, "uo": by_uo}
+
+def rollup_sources():
+    """Versions des fichiers dont dépendent les agrégats (équipe, marché, consommation)."""
+    return [list(v) if v else None for v in (file_version(tenant_path(JSON_FILE)), file_version(tenant_path(MARCHE_FILE)),
+                                              file_version(tenant_path(CONSO_FILE)))]
+
+def refresh_budget_rollups():
+    """
+    Met à jour les tables d'agrégats enregistrées dans agregats.json. La contribution de chaque
+    prestataire y est conservée avec les empreintes de ses données (equipe.json) et de sa
+    consommation : seules les contributions des prestataires modifiés (paiement, BC, consommation)
+    sont retirées des tables puis recalculées. Un changement du catalogue UO reconstruit tout.
+    La mise à jour est exclusive (cf. file_lock) : agregats.json est relu et complété par un seul
+    worker à la fois, à partir des fichiers déjà enregistrés. Retourne les agrégats à jour.
+    """
+    with file_lock(tenant_path(ROLLUPS_FILE)):
+        sources = rollup_sources()
+        model = get_team_model()
+        marche = load_marche(readonly=True)
+        categories = build_uo_categories(marche)
+        catalog_version = fingerprint([model.uo_catalog, categories])
+
+        rollups = read_json(tenant_path(ROLLUPS_FILE), dict)
+        if rollups.get("catalogue") != catalog_version:
+            rollups = {"catalogue": catalog_version, "membres": {}, "tables": {name: {} for name in ROLLUP_TABLES}}
+        stored = rollups["membres"]
+        tables = rollups["tables"]
+        conso_changed = rollups.get("sources", [None] * 3)[2] != sources[2]
+        conso_map = load_consumption(readonly=True) if conso_changed or not stored else None
+
+        current_ids = set()
+        for p in model.prestataires:
+            member_key = str(p.id)
+            current_ids.add(member_key)
+            entry = stored.get(member_key)
+            if entry and entry["equipe"] == p.version and not conso_changed:
+                continue
+            if conso_map is None:
+                conso_map = load_consumption(readonly=True)
+            member_conso_monthly = match_member_conso(p, conso_map)
+            conso_version = fingerprint(member_conso_monthly)
+            if entry and entry["equipe"] == p.version and entry["conso"] == conso_version:
+                continue
+            if entry:
+                for name in ROLLUP_TABLES:
+                    add_rollup(tables[name], entry["contributions"][name], -1)
+            contributions = member_rollup_contributions(p, member_conso_monthly, categories)
+            for name in ROLLUP_TABLES:
+                add_rollup(tables[name], contributions[name])
+            stored[member_key] = {"equipe": p.version, "conso": conso_version, "contributions": contributions}
+
+        # Prestataires supprimés (ou devenus internes)
+        for member_key in set(stored) - current_ids:
+            for name in ROLLUP_TABLES:
+                add_rollup(tables[name], stored[member_key]["contributions"][name], -1)
+            del stored[member_key]
+
+        rollups["sources"] = sources
+        write_json(tenant_path(ROLLUPS_FILE), rollups)
+    return rollups
+
+def get_budget_rollups():
+    """Tables d'agrégats, lues directement tant que les fichiers sources n'ont pas changé."""
+    rollups = read_json(tenant_path(ROLLUPS_FILE), dict, readonly=True)
+    if rollups.get("sources") != rollup_sources():
+        rollups = refresh_budget_rollups()
+    return rollups["tables"]
+
+def query_budget_rollup(table, start=None, end=None, key=None):
+    """
+    Lignes d'une table d'agrégats, filtrées par clé (société, catégorie ou code UO) et,
+    pour les tables mensuelles, par mois "YYYY-MM" (bornes incluses).
+    Retourne (lignes, totaux).
+    """
+    data = get_budget_rollups()[table]
+    rows = []
+    if table == 'uo':
+        categories = build_uo_categories(load_marche(readonly=True))
+        fields = ("commande", "paye", "restant", "commande_ht", "paye_ht", "restant_ht")
+        for code in sorted(data):
+            if key and code != key: continue
+            cell = data[code]
+            ordered, paid = cell.get("commande", 0), cell.get("paye", 0)
+            ordered_ht, paid_ht = cell.get("commande_ht", 0), cell.get("paye_ht", 0)
+            rows.append({"code": code, "categorie": categories.get(code, ROLLUP_NO_CATEGORY),
+                         "commande": ordered, "paye": paid, "restant": max(0, ordered - paid),
+                         "commande_ht": ordered_ht, "paye_ht": paid_ht, "restant_ht": max(0, ordered_ht - paid_ht)})
+    else:
+        label = "societe" if table == 'societes' else "categorie"
+        fields = ("consomme_ht", "paye_ht")
+        for name in sorted(data):
+            if key and name != key: continue
+            for m_key in sorted(data[name]):
+                if m_key != ROLLUP_NO_DATE and ((start and m_key < start) or (end and m_key > end)): continue
+                cell = data[name][m_key]
+                rows.append({label: name, "mois": m_key, "consomme_ht": cell.get("consomme_ht", 0), "paye_ht": cell.get("paye_ht", 0)})
+
+    for row in rows:
+        for field in fields:
+            row[field] = round(row[field], 2)
+    totals = {field: round(sum(row[field] for row in rows), 2) for field in fields}
+    return rows, totals
+
+@app.route('/budget/agregats/<table>')
+def budget_rollups(table):
+    """
+    Agrégats budgétaires (JSON) : table 'societes' (société × mois), 'categories' (catégorie du
+    marché × mois) ou 'uo' (code UO × commandé / payé / restant).
+    Paramètres facultatifs : ?cle=<société, catégorie ou code>, ?debut=YYYY-MM&fin=YYYY-MM.
+    """
+    if table not in ROLLUP_TABLES:
+        abort(404)
+    start = request.args.get('debut') or None
+    end = request.args.get('fin') or None
+    for value in (start, end):
+        if value and not re.fullmatch(r"\d{4}-\d{2}", value):
+            return jsonify({"error": f"Mois invalide : {value} (format attendu : YYYY-MM)."}), 400
+    rows, totals = query_budget_rollup(table, start, end, request.args.get('cle') or None)
+    return jsonify({"table": table, "lignes": rows, "totaux": totals})
+
+# --- OCCUPATION DE L'ÉQUIPE ---
+
+OCCUPANCY_PERIODS = ('jour', 'semaine', 'mois')
+
+class OccupancyMatrix:
+    """
+    Matrice d'occupation membres × jours ouvrés construite à partir du détail journalier du
+    planning (cf. load_daily_consumption), internes compris.
+    - `names`, `types`, `presence` : une entrée par ligne (membres de l'équipe, puis colonnes
+      du planning ne correspondant à aucun membre, de type None)
+    - `days` : jours ouvrés couverts (datetime64[D], triés)
+    - `planned` : jours planifiés par membre et par jour ouvré (0, 0.5 ou 1)
+    - `off_days` / `off_planned` : idem pour les jours non ouvrés (week-ends et jours fériés)
+    """
+    def __init__(self, members, daily):
+        self.names = [m.nom_complet for m in members]
+        self.types = [m.type for m in members]
+        self.presence = [m.presence_pct for m in members]
+        rows = {}
+        for position, member in enumerate(members):
+            rows.setdefault(member.nom_complet.lower().strip(), position)
+            rows.setdefault(f"{member.nom} {member.prenom}".lower().strip(), position)
+
+        # Rattachement des colonnes du planning aux membres (member_name_matches, comme à l'import) :
+        # `rows` indexe les libellés exacts, les autres sont comparés à chaque membre
+        sources = []
+        for excel_name, months in daily.items():
+            key = str(excel_name).lower().strip()
+            row = rows.get(key)
+            if row is None:
+                row = next((i for i, m in enumerate(members) if member_name_matches(m, excel_name)), None)
+            if row is None:
+                row = rows[key] = len(self.names)
+                self.names.append(str(excel_name))
+                self.types.append(None)
+                self.presence.append(100.0)
+            sources.append((row, months))
+
+        month_keys = sorted({m_key for _, months in sources for m_key in months})
+        first_year = int(month_keys[0][:4]) if month_keys else date.today().year
+        last_year = int(month_keys[-1][:4]) if month_keys else date.today().year
+        cal = get_business_calendar(first_year, last_year)
+
+        # Matrice sur tous les jours du calendrier, puis restriction aux jours ouvrés
+        all_days = np.zeros((len(self.names), len(cal.days)), dtype=np.float32)
+        for row, months in sources:
+            for m_key, values in months.items():
+                month = np.datetime64(m_key, 'M')
+                start = int((month.astype('datetime64[D]') - cal.origin).astype(np.int64))
+                length = int(((month + 1).astype('datetime64[D]') - month.astype('datetime64[D]')).astype(np.int64))
+                all_days[row, start:start + length] += np.asarray(values[:length], dtype=np.float32)
+
+        self.days = cal.days[cal.open_days]
+        self.planned = all_days[:, cal.open_days]
+        self.off_days = cal.days[~cal.open_days]
+        self.off_planned = all_days[:, ~cal.open_days]
+        self.presence = np.asarray(self.presence, dtype=np.float32) / 100.0
+
+    @staticmethod
+    def columns(days, start=None, end=None):
+        """Tranche [première colonne, dernière colonne + 1) des jours (triés) entre deux dates incluses."""
+        first = np.searchsorted(days, np.datetime64(start, 'D')) if start else 0
+        last = np.searchsorted(days, np.datetime64(end, 'D'), side='right') if end else len(days)
+        return int(first), int(max(first, last))
+
+    def summary(self, start=None, end=None, period='mois', types=None):
+        """
+        Indicateurs d'occupation entre deux dates incluses (chaînes "YYYY-MM-DD" ou None),
+        globaux et par période ('jour', 'semaine' ISO ou 'mois'), par membre et pour l'équipe :
+        - capacité : jours ouvrés × % de présence
+        - planifié : jours marqués 'X' dans le planning
+        - taux d'occupation : planifié / capacité
+        - absences : jours ouvrés sans aucune demi-journée planifiée
+        - surcharge : planifié au-delà de la capacité, période par période
+        """
+        first, last = self.columns(self.days, start, end)
+        off_first, off_last = self.columns(self.off_days, start, end)
+        rows = np.array([i for i, t in enumerate(self.types) if types is None or t in types], dtype=np.int64)
+        days = self.days[first:last]
+        planned = self.planned[np.ix_(rows, np.arange(first, last))] if len(rows) else np.zeros((0, len(days)), dtype=np.float32)
+        presence = self.presence[rows] if len(rows) else np.zeros(0, dtype=np.float32)
+        off_planned = self.off_planned[rows, off_first:off_last].sum(axis=1) if len(rows) else np.zeros(0)
+
+        # Les jours ouvrés sont triés : chaque période forme un bloc contigu de colonnes
+        if period == 'jour':
+            labels = [str(d) for d in days]
+            bounds = np.arange(len(days))
+        else:
+            if period == 'semaine':
+                # Lundi de chaque jour (le 1970-01-01 était un jeudi)
+                keys = days - ((days.astype(np.int64) + 3) % 7).astype('timedelta64[D]')
+            else:
+                keys = days.astype('datetime64[M]')
+            unique_keys, bounds = np.unique(keys, return_index=True)
+            if period == 'semaine':
+                labels = ["%d-S%02d" % k.astype(date).isocalendar()[:2] for k in unique_keys]
+            else:
+                labels = [str(k) for k in unique_keys]
+
+        if len(days):
+            planned_p = np.add.reduceat(planned, bounds, axis=1)
+            open_p = np.diff(np.append(bounds, len(days)))
+            absent_p = np.add.reduceat(planned == 0, bounds, axis=1)
+        else:
+            planned_p = np.zeros((len(rows), 0), dtype=np.float32)
+            open_p = np.zeros(0, dtype=np.int64)
+            absent_p = np.zeros((len(rows), 0), dtype=np.int64)
+        capacity_p = presence[:, None] * open_p[None, :]
+        overload_p = np.maximum(planned_p - capacity_p, 0)
+
+        def rate(planned_days, capacity):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.where(capacity > 0, np.round(planned_days / np.where(capacity > 0, capacity, 1) * 100, 1), 0.0)
+
+        def values(array):
+            return np.round(array, 2).tolist()
+
+        planned_total = planned_p.sum(axis=1)
+        capacity_total = capacity_p.sum(axis=1)
+        members = []
+        for i, row in enumerate(rows.tolist()):
+            members.append({
+                "nom": self.names[row],
+                "type": self.types[row],
+                "presence_pct": round(float(self.presence[row]) * 100, 2),
+                "capacite": round(float(capacity_total[i]), 2),
+                "planifie": round(float(planned_total[i]), 2),
+                "taux_occupation": float(rate(planned_total[i], capacity_total[i])),
+                "absences": int(absent_p[i].sum()),
+                "surcharge": round(float(overload_p[i].sum()), 2),
+                "jours_non_ouvres": round(float(off_planned[i]), 2),
+                "periodes": {
+                    "capacite": values(capacity_p[i]),
+                    "planifie": values(planned_p[i]),
+                    "taux_occupation": rate(planned_p[i], capacity_p[i]).tolist(),
+                    "absences": absent_p[i].tolist(),
+                    "surcharge": values(overload_p[i])
+                }
+            })
+
+        team_planned = planned_p.sum(axis=0)
+        team_capacity = capacity_p.sum(axis=0)
+        return {
+            "debut": str(days[0]) if len(days) else None,
+            "fin": str(days[-1]) if len(days) else None,
+            "periode": period,
+            "jours_ouvres": int(len(days)),
+            "periodes": labels,
+            "membres": members,
+            "equipe": {
+                "capacite": values(team_capacity),
+                "planifie": values(team_planned),
+                "taux_occupation": rate(team_planned, team_capacity).tolist(),
+                "absences": absent_p.sum(axis=0).tolist(),
+                "surcharge": values(overload_p.sum(axis=0))
+            }
+        }
+
+def get_occupancy_matrix():
+    """
+    Matrice d'occupation de l'équipe courante, reconstruite uniquement lorsque l'équipe,
+    le marché ou le détail journalier de la consommation ont changé.
+    """
+    cache = tenant_cache()
+    model = get_team_model()
+    version = (model.version, file_version(tenant_path(CONSO_DAYS_FILE)))
+    entry = cache.get('occupancy')
+    if entry is None or entry[0] != version:
+        entry = cache['occupancy'] = (version, OccupancyMatrix(model.members, load_daily_consumption(readonly=True)))
+    return entry[1]
+
+@app.route('/equipe/occupation')
+def team_occupancy():
+    """
+    Occupation de l'équipe (JSON) : ?debut=YYYY-MM-DD&fin=YYYY-MM-DD (bornes incluses, facultatives),
+    ?periode=jour|semaine|mois (défaut : mois), ?type=interne|prestataire (répétable, défaut : tous).
+    """
+    start = request.args.get('debut') or None
+    end = request.args.get('fin') or None
+    period = request.args.get('periode', 'mois')
+    types = request.args.getlist('type') or None
+    if period not in OCCUPANCY_PERIODS:
+        return jsonify({"error": f"Période inconnue : {period} (attendu : {', '.join(OCCUPANCY_PERIODS)})."}), 400
+    for value in (start, end):
+        if value and not to_date(value):
+            return jsonify({"error": f"Date invalide : {value} (format attendu : YYYY-MM-DD)."}), 400
+    return jsonify(get_occupancy_matrix().summary(start, end, period, types))
+
+# --- MISES À JOUR EN DIRECT (SERVER-SENT EVENTS) ---
+
+LIVE_PAGES = ('dashboard', 'budget')
+LIVE_POLL_INTERVAL = float(os.environ.get('LIVE_POLL_INTERVAL', 2)) # Secondes entre deux contrôles des fichiers
+LIVE_KEEPALIVE = 20 # Commentaire SSE envoyé sans changement, pour les proxys et la détection des déconnexions
+LIVE_STREAM_MAX_AGE = int(os.environ.get('LIVE_STREAM_MAX_AGE', 300)) # Le navigateur se reconnecte ensuite (Last-Event-ID)
+LIVE_MAX_STREAMS = int(os.environ.get('LIVE_MAX_STREAMS', 16)) # Flux simultanés par processus (un thread chacun)
+LIVE_STATES_KEPT = 32 # États récents des pages, toutes équipes confondues
+_live_states = OrderedDict()
+_live_streams = 0
+_live_lock = threading.Lock()
+_live_build_lock = threading.Lock() # Un seul calcul d'état à la fois, partagé par les flux en attente
+
+def live_stream_url(page, analysis_date, version):
+    """URL du flux de mises à jour d'une page, ou None si les flux sont désactivés (LIVE_MAX_STREAMS = 0)."""
+    if LIVE_MAX_STREAMS <= 0:
+        return None
+    return url_for('live_stream', page=page, date=analysis_date, version=version, equipe=current_tenant())
+
+def live_version():
+    """
+    Version des données affichées par /dashboard et /budget : equipe.json et marche.json (modèle),
+    consommation mensuelle et journalière. Un simple stat des fichiers, y compris ceux modifiés par
+    un autre processus (workers, batch.py).
+    """
+    model = get_team_model()
+    return fingerprint([model.version, file_version(tenant_path(CONSO_FILE)), file_version(tenant_path(CONSO_DAYS_FILE))])
+
+def budget_live_state(ctx):
+    """État de la page Budget comparé d'une version à l'autre : synthèse formatée, BCs et fragments."""
+    return {
+        "summary": {key: f"{value:,.2f}".replace(',', ' ') for key, value in ctx['summary'].items()},
+        "cards": {bc_card_key(item): item for item in ctx['budget']},
+        "ctx": {key: ctx[key] for key in ('data_version', 'forecast_date', 'months', 'monthly_costs',
+                                          'global_monthly', 'cost_curve')}
+    }
+
+def build_live_state(page, analysis_date):
+    if page == 'dashboard':
+        columns, rows = report_table(report_at(analysis_date))
+        return {"columns": columns, "rows": rows}
+    return budget_live_state(get_budget_data_context(analysis_date))
+
+def live_state_key(page, analysis_date, version):
+    # Hors de tenant_cache(), vidé à chaque enregistrement de l'équipe : l'état précédent sert de base au delta
+    return (current_tenant(), page, analysis_date, version)
+
+def store_live_state(key, state):
+    _live_states[key] = dict(state, deltas={})
+    while len(_live_states) > LIVE_STATES_KEPT:
+        _live_states.popitem(last=False)
+    return _live_states[key]
+
+def remember_live_state(page, analysis_date, version, state):
+    """Conserve l'état d'une page qui vient d'être rendue : base des mises à jour de ses visiteurs."""
+    key = live_state_key(page, analysis_date, version)
+    with _live_lock:
+        if key not in _live_states:
+            store_live_state(key, state)
+
+def get_live_state(page, analysis_date, version):
+    """État d'une page à une version, calculé une seule fois pour tous les visiteurs connectés."""
+    key = live_state_key(page, analysis_date, version)
+    with _live_build_lock:
+        with _live_lock:
+            state = _live_states.get(key)
+        if state is None:
+            state = build_live_state(page, analysis_date)
+            with _live_lock:
+                state = store_live_state(key, state)
+    with _live_lock:
+        if key in _live_states:
+            _live_states.move_to_end(key)
+    return state
+
+def dashboard_delta(old, new):
+    """Cellules modifiées du rapport : {index de ligne: {colonne: texte}}."""
+    if old['columns'] != new['columns'] or len(old['rows']) != len(new['rows']):
+        return {"reload": True}
+    rows = {}
+    for index, (old_row, new_row) in enumerate(zip(old['rows'], new['rows'])):
+        if old_row != new_row:
+            rows[index] = {column: text for column, previous, text in zip(new['columns'], old_row, new_row)
+                           if previous != text}
+    return {"rows": rows} if rows else {}
+
+def budget_delta(old, new):
+    """
+    Montants de synthèse modifiés, cartes des BCs dont la version a changé et récapitulatifs
+    mensuels si leurs données ont changé (fragments HTML, issus du cache de render_fragment).
+    """
+    if list(old['cards']) != list(new['cards']):
+        return {"reload": True}
+    delta = {}
+    summary = {key: text for key, text in new['summary'].items() if old['summary'].get(key) != text}
+    if summary:
+        delta['summary'] = summary
+    cards = {key: render_bc_card(item) for key, item in new['cards'].items()
+             if old['cards'][key]['version'] != item['version']}
+    if cards:
+        delta['cards'] = cards
+    old_ctx, ctx = old['ctx'], new['ctx']
+    if (old_ctx['months'], old_ctx['monthly_costs'], old_ctx['global_monthly']) != \
+            (ctx['months'], ctx['monthly_costs'], ctx['global_monthly']):
+        delta['monthly'] = render_budget_monthly(ctx)
+    if old_ctx['cost_curve'] != ctx['cost_curve']:
+        delta['forecast'] = render_budget_forecast(ctx)
+    return delta
+
+def live_delta(page, analysis_date, since, version):
+    """
+    Différences entre la version `since` d'une page et la version courante, calculées une fois par
+    couple de versions et partagées par les visiteurs. {"reload": true} si l'ancienne version n'est
+    plus connue ou si la structure de la page a changé (BC ajouté ou supprimé).
+    """
+    state = get_live_state(page, analysis_date, version)
+    with _live_lock:
+        old = _live_states.get(live_state_key(page, analysis_date, since))
+        delta = state['deltas'].get(since)
+    if old is None:
+        return {"reload": True}
+    if delta is None:
+        delta = dashboard_delta(old, state) if page == 'dashboard' else budget_delta(old, state)
+        with _live_lock:
+            state['deltas'][since] = delta
+    return delta
+
+def live_events(page, analysis_date, since, csrf_token):
+    """
+    Flux SSE d'une page : un événement (id = version des données) à chaque changement de equipe.json,
+    marche.json ou de la consommation, avec le delta depuis la version précédente du visiteur.
+    """
+    yield f"retry: {int(LIVE_POLL_INTERVAL * 1000)}\n\n"
+    version = live_version()
+    if since is None or since == version:
+        since = version
+        get_live_state(page, analysis_date, version)
+    deadline = time.monotonic() + LIVE_STREAM_MAX_AGE
+    last_event = time.monotonic()
+    while True:
+        if version != since:
+            delta = live_delta(page, analysis_date, since, version)
+            # Jeton CSRF de la session dans les formulaires des fragments mis en cache
+            data = json.dumps(delta).replace(CSRF_PLACEHOLDER, csrf_token)
+            yield f"id: {version}\ndata: {data}\n\n"
+            since = version
+            last_event = time.monotonic()
+        elif time.monotonic() - last_event >= LIVE_KEEPALIVE:
+            yield ": keepalive\n\n"
+            last_event = time.monotonic()
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(LIVE_POLL_INTERVAL)
+        version = live_version()
+
+@app.route('/live/<page>')
+def live_stream(page):
+    """
+    Mises à jour en direct de /dashboard et /budget (Server-Sent Events) : ?date=YYYY-MM-DD (date
+    d'analyse de la page), ?version= (version des données affichées, remplacée par l'en-tête
+    Last-Event-ID lors des reconnexions automatiques du navigateur).
+    """
+    global _live_streams
+    if page not in LIVE_PAGES:
+        abort(404)
+    analysis_date = request.args.get('date') or date.today().strftime("%Y-%m-%d")
+    if not to_date(analysis_date):
+        return jsonify({"error": f"Date invalide : {analysis_date} (format attendu : YYYY-MM-DD)."}), 400
+    # Place réservée sous le verrou : deux requêtes simultanées ne peuvent pas dépasser la limite
+    with _live_lock:
+        accepted = _live_streams < LIVE_MAX_STREAMS
+        if accepted:
+            _live_streams += 1
+    if not accepted:
+        # La page se reconnecte plus tard ; elle reste utilisable (rechargement manuel)
+        return jsonify({"error": "Trop de mises à jour en direct ouvertes, réessayez plus tard."}), 503, \
+            {"Retry-After": str(LIVE_STREAM_MAX_AGE)}
+
+    def release_stream():
+        global _live_streams
+        with _live_lock:
+            _live_streams -= 1
+
+    since = request.headers.get('Last-Event-ID') or request.args.get('version') or None
+    events = live_events(page, analysis_date, since, generate_csrf())
+    response = Response(stream_with_context(events), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Place libérée à la fermeture de la réponse, même si le flux n'a jamais été lu (client déjà parti)
+    response.call_on_close(release_stream)
+    return response
+
+# --- SERVEUR DE PRODUCTION ---
+
+def preload_shared_data():
+    """
+    Précharge les données partagées en lecture seule (jours fériés, calendriers ouvrés, modèle
+    et catalogue de l'équipe par défaut) : chargées avant la création des workers, elles sont
+    partagées entre processus (copy-on-write) au lieu d'être recalculées par chacun.
+    """
+    today = date.today()
+    for year in range(today.year - 5, today.year + 11):
+        get_holidays(year)
+    calendar_for_dates(np.array([np.datetime64(today, 'D')]))
+    model = get_team_model()
+    get_search_index()
+    return model
+
+def serve_waitress(host, port, threads):
+    try:
+        from waitress import serve
+    except ImportError:
+        raise SystemExit("Le serveur 'waitress' n'est pas installé : pip install waitress")
+    preload_shared_data()
+    serve(app, host=host, port=port, threads=threads, channel_timeout=120)
+
+def serve_gunicorn(host, port, workers, threads):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("Le serveur 'gunicorn' n'est pas installé : pip install gunicorn")
+
+    class GunicornApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{host}:{port}")
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', 'gthread' if threads > 1 else 'sync')
+            self.cfg.set('keepalive', 5)
+            self.cfg.set('graceful_timeout', 30)
+            # Application chargée dans le processus maître, avant la création des workers
+            self.cfg.set('preload_app', True)
+
+        def load(self):
+            preload_shared_data()
+            return app
+
+    GunicornApplication().run()
+
 if __name__ == '__main__':
-    # Sécurité : Pas de debug mode en production par défaut
-    debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
-    app.run(host='0.0.0.0', port=8080, debug=debug_mode)
+    import argparse
+    parser = argparse.ArgumentParser(description="Gestion d'équipe CHORUS / IBIS")
+    parser.add_argument('--server', choices=['dev', 'waitress', 'gunicorn'], default=os.environ.get('APP_SERVER', 'dev'),
+                        help="dev : serveur Flask de développement ; waitress / gunicorn : production")
+    parser.add_argument('--host', default=os.environ.get('APP_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('APP_PORT', 8080)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('APP_WORKERS', (os.cpu_count() or 1) + 1)),
+                        help="Nombre de processus (gunicorn)")
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('APP_THREADS', 4)),
+                        help="Nombre de threads par processus")
+    args = parser.parse_args()
+    if args.server != 'dev' and args.threads <= 1:
+        # Un seul thread par processus (worker gunicorn 'sync') : un flux de plusieurs minutes le bloquerait
+        # au-delà du délai du worker, les mises à jour en direct sont désactivées
+        LIVE_MAX_STREAMS = 0
+    elif args.server != 'dev' and 'LIVE_MAX_STREAMS' not in os.environ:
+        # Chaque flux de mises à jour en direct occupe un thread : au plus la moitié des threads
+        LIVE_MAX_STREAMS = max(1, args.threads // 2)
+
+    if args.server == 'waitress':
+        serve_waitress(args.host, args.port, args.threads)
+    elif args.server == 'gunicorn':
+        serve_gunicorn(args.host, args.port, args.workers, args.threads)
+    else:
+        # Sécurité : Pas de debug mode en production par défaut
+        debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
+        app.run(host=args.host, port=args.port, debug=debug_mode)
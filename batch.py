@@ -0,0 +1,121 @@
+"""
+Traitement par lots (sans serveur web) : import des plannings, mise à jour de l'historique
+(instantané de la date d'analyse) et écriture de tous les exports, pour une ou plusieurs équipes.
+Les données sont calculées une seule fois par équipe ; les fichiers d'export, indépendants,
+sont générés en parallèle dans des processus distincts.
+
+Usage : python batch.py [--planning FICHIER ...] [--date AAAA-MM-JJ] [--sortie DOSSIER]
+                        [--equipe ID ... | --toutes-equipes] [--jobs N] [--formats csv,parquet]
+Exemple (cron) : python batch.py --toutes-equipes --sortie /srv/exports/$(date +%F)
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import app as gestion
+
+EXPORT_BUILDERS = {
+    "report_xlsx": lambda data: gestion.build_report_excel(data).getvalue(),
+    "budget_pdf": gestion.build_budget_pdf,
+    "budget_xlsx": lambda data: gestion.build_budget_excel(data).getvalue(),
+    "csv": lambda data: "".join(gestion.iter_csv(data)).encode('utf-8'),
+    "parquet": lambda data: gestion.write_columnar(data, 'parquet').getvalue(),
+    "arrow": lambda data: gestion.write_columnar(data, 'arrow').getvalue(),
+}
+
+def write_export(task):
+    """Génère un fichier d'export (exécuté dans un processus du pool). Retourne (chemin, taille, durée)."""
+    builder, data, path = task
+    start = time.perf_counter()
+    content = EXPORT_BUILDERS[builder](data)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+    return path, len(content), time.perf_counter() - start
+
+def export_tasks(analysis_date, output_dir, formats):
+    """
+    Calcule une fois le rapport et le contexte budgétaire de l'équipe courante et retourne
+    la liste des exports à générer : (générateur, données, chemin du fichier).
+    """
+    df = gestion.report_at(analysis_date)
+    ctx = gestion.get_budget_data_context(analysis_date)
+    datasets = {name: df if name == 'rapport' else gestion.build_export_dataframe(name, analysis_date, ctx=ctx)
+                for name in gestion.EXPORT_DATASETS}
+
+    tasks = [
+        ("report_xlsx", df, os.path.join(output_dir, f"Suivi_Prestataires_{analysis_date}.xlsx")),
+        ("budget_pdf", ctx, os.path.join(output_dir, f"Budget_Export_{analysis_date}.pdf")),
+        ("budget_xlsx", ctx, os.path.join(output_dir, f"Budget_Export_{analysis_date}.xlsx")),
+    ]
+    for fmt in formats:
+        for name, data in datasets.items():
+            tasks.append((fmt, data, os.path.join(output_dir, f"{name}_{analysis_date}.{fmt}")))
+    return tasks
+
+def run_team(tenant, plannings, analysis_date, output_dir, formats, pool):
+    """Import des plannings, instantané et exports d'une équipe (None : dossier courant)."""
+    label = tenant or "équipe par défaut"
+    with gestion.app.app_context():
+        gestion.g.tenant = tenant
+        for planning in plannings:
+            report = gestion.import_planning(planning, analysis_date)
+            summary = gestion.planning_report_summary(report)
+            print(f"[{label}] Planning importé : {planning}" + (f" (anomalies : {summary})" if summary else ""))
+
+        df = gestion.record_analysis(analysis_date)
+        print(f"[{label}] Rapport au {analysis_date} : {len(df)} ligne(s)")
+        tasks = export_tasks(analysis_date, output_dir, formats)
+
+    results = pool.map(write_export, tasks) if pool else map(write_export, tasks)
+    for path, size, elapsed in results:
+        print(f"[{label}] {path} ({size / 1024:.1f} Ko, {elapsed * 1000:.0f} ms)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--planning', action='append', default=[], help="Planning Excel à importer (répétable)")
+    parser.add_argument('--date', default=date.today().strftime("%Y-%m-%d"), help="Date d'analyse (défaut : aujourd'hui)")
+    parser.add_argument('--sortie', default='exports', help="Dossier des exports (un sous-dossier par équipe)")
+    parser.add_argument('--equipe', action='append', default=[], help="Équipe à traiter (répétable)")
+    parser.add_argument('--toutes-equipes', action='store_true', help="Traiter toutes les équipes de TENANTS_DIR")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help="Processus de génération des exports")
+    parser.add_argument('--formats', default='csv', help="Formats des jeux de données : csv, parquet, arrow")
+    args = parser.parse_args(argv)
+
+    if not gestion.to_date(args.date):
+        parser.error(f"Date invalide : {args.date} (format attendu : AAAA-MM-JJ)")
+    formats = [fmt.strip() for fmt in args.formats.split(',') if fmt.strip()]
+    unknown = [fmt for fmt in formats if fmt not in gestion.EXPORT_FORMATS]
+    if unknown:
+        parser.error(f"Format inconnu : {', '.join(unknown)}")
+    if gestion.pa is None and any(fmt != 'csv' for fmt in formats):
+        parser.error("Les formats Parquet / Arrow nécessitent la bibliothèque 'pyarrow' (pip install pyarrow).")
+
+    tenants = gestion.list_tenants() if args.toutes_equipes else args.equipe or [None]
+    if not tenants:
+        parser.error(f"Aucune équipe dans {gestion.TENANTS_DIR}.")
+    for tenant in tenants:
+        if tenant is not None and not gestion.is_valid_tenant(tenant):
+            parser.error(f"Équipe inconnue : {tenant}")
+    if args.planning and len(tenants) > 1:
+        parser.error("Les plannings ne peuvent être importés que pour une seule équipe à la fois.")
+
+    start = time.perf_counter()
+    pool = ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    try:
+        for tenant in tenants:
+            output_dir = os.path.join(args.sortie, tenant) if tenant else args.sortie
+            os.makedirs(output_dir, exist_ok=True)
+            run_team(tenant, args.planning, args.date, output_dir, formats, pool)
+    finally:
+        if pool:
+            pool.shutdown()
+    print(f"Terminé en {time.perf_counter() - start:.1f} s")
+
+if __name__ == "__main__":
+    sys.exit(main())
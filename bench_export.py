@@ -0,0 +1,114 @@
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+"""
+Banc d'essai des exports : compare la taille et le temps de génération des exports
+Excel (xlsx) avec les exports CSV (en flux) et Parquet / Arrow (si pyarrow est installé),
+sur une équipe synthétique.
+
+Usage : python bench_export.py [nombre_de_prestataires] [nombre_d_annees]
+"""
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def build_dataset(nb_members, nb_years, seed=42):
+    """Équipe, marché et historique de consommation synthétiques."""
+    rng = random.Random(seed)
+    marche = json.load(open(os.path.join(REPO_DIR, 'marche.json'), encoding='utf-8'))
+    uo_codes = [item['code_uo'] for cat in marche['annexe_financiere']['lots_expertises']
+                for item in cat.get('items', [])] or ['UO']
+    first_year = 2026 - nb_years + 1
+
+    team = []
+    conso = {}
+    for i in range(nb_members):
+        prenom, nom = f"Prenom{i}", f"Nom{i}"
+        bcs = []
+        for y in range(first_year, 2027):
+            code = rng.choice(uo_codes)
+            qty = rng.choice([20, 40, 60, 100])
+            bcs.append({
+                "chorus_id": f"EJ-{y}-{i:05d}",
+                "ibis_id": f"IB-{y}-{i:05d}",
+                "jours_commandes": float(qty),
+                "date_debut": f"{y}-01-{rng.randint(2, 20):02d}",
+                "moment_debut": "Matin",
+                "tjm_ht": float(rng.choice([450, 600, 800, 1000])),
+                "uos": [{"code": code, "quantite": qty}],
+                "paiements": [{
+                    "type": "percentage",
+                    "percentage": 25,
+                    "date_demande": f"{y}-03-01",
+                    "service_fait_id": f"SF-{y}-{i:05d}"
+                }]
+            })
+        team.append({
+            "id": i + 1,
+            "type": "prestataire",
+            "nom": nom,
+            "prenom": prenom,
+            "societe": f"Societe{i % 12}",
+            "presence_pct": rng.choice([50, 80, 100]),
+            "bons_commande": bcs
+        })
+        conso[f"{prenom} {nom}"] = {
+            f"{y}-{m:02d}": float(rng.randint(0, 20))
+            for y in range(first_year, 2027) for m in range(1, 13)
+        }
+    return team, marche, conso
+
+def timed_get(client, url):
+    start = time.perf_counter()
+    response = client.get(url)
+    size = len(response.get_data())  # consomme les réponses en flux
+    return response.status_code, size, time.perf_counter() - start
+
+def main():
+    nb_members = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    nb_years = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    work_dir = tempfile.mkdtemp(prefix="bench_export_")
+    team, marche, conso = build_dataset(nb_members, nb_years)
+    for name, data in (("equipe.json", team), ("marche.json", marche), ("consommation.json", conso)):
+        with open(os.path.join(work_dir, name), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    os.chdir(work_dir)
+    sys.path.insert(0, REPO_DIR)
+    import app as gestion
+    gestion.app.config['TESTING'] = True
+    client = gestion.app.test_client()
+    client.get('/budget/export/excel')  # préchauffage (modèle, calendrier)
+
+    cases = [
+        ("Rapport", [("xlsx", "/export_excel"), ("csv", "/export/rapport.csv"),
+                     ("parquet", "/export/rapport.parquet"), ("arrow", "/export/rapport.arrow")]),
+        ("Budget", [("xlsx", "/budget/export/excel"), ("csv", "/export/couts-mensuels.csv"),
+                    ("parquet", "/export/couts-mensuels.parquet")]),
+        ("Paiements", [("csv", "/export/paiements.csv"), ("parquet", "/export/paiements.parquet")]),
+    ]
+
+    print(f"{nb_members} prestataires, {nb_years} an(s) d'historique")
+    if gestion.pa is None:
+        print("(pyarrow non installé : exports Parquet / Arrow ignorés)")
+    print(f"{'Export':<12}{'Format':<10}{'Taille (Ko)':>14}{'Temps (ms)':>14}")
+    for label, formats in cases:
+        for fmt, url in formats:
+            if fmt in ('parquet', 'arrow') and gestion.pa is None:
+                continue
+            status, size, elapsed = timed_get(client, url)
+            if status != 200:
+                print(f"{label:<12}{fmt:<10}{'erreur ' + str(status):>14}")
+                continue
+            print(f"{label:<12}{fmt:<10}{size / 1024:>14.1f}{elapsed * 1000:>14.1f}")
+
+    os.chdir(REPO_DIR)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
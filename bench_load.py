@@ -0,0 +1,72 @@
+import sys
+import threading
+import time
+from collections import Counter
+from http.client import HTTPConnection
+from urllib.parse import urlsplit
+
+"""
+Test de charge : mesure le débit (requêtes/seconde) et la latence de /dashboard et /budget
+sur un serveur déjà démarré (par exemple : python app.py --server waitress).
+
+Usage : python bench_load.py [url_de_base] [durée_en_secondes] [connexions_simultanées]
+"""
+
+PATHS = ["/dashboard", "/budget"]
+
+def worker(host, port, path, deadline, latencies, statuses, lock):
+    """Enchaîne les requêtes sur une connexion persistante (keep-alive) jusqu'à l'échéance."""
+    conn = HTTPConnection(host, port, timeout=30)
+    local_latencies = []
+    local_statuses = Counter()
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request("GET", path, headers={"Accept-Encoding": "gzip"})
+            response = conn.getresponse()
+            response.read()
+            local_statuses[response.status] += 1
+        except (OSError, ConnectionError):
+            local_statuses["erreur"] += 1
+            conn.close()
+            conn = HTTPConnection(host, port, timeout=30)
+            continue
+        local_latencies.append(time.perf_counter() - start)
+    conn.close()
+    with lock:
+        latencies.extend(local_latencies)
+        statuses.update(local_statuses)
+
+def run(base_url, path, duration, concurrency):
+    parts = urlsplit(base_url)
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=worker, args=(parts.hostname, parts.port or 80, path, deadline, latencies, statuses, lock))
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+    return len(latencies) / elapsed, percentile(0.5), percentile(0.95), statuses
+
+def main():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "http://127.0.0.1:8080"
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    print(f"{base_url} - {duration:.0f} s par page, {concurrency} connexions")
+    print(f"{'Page':<14}{'Req/s':>10}{'p50 (ms)':>12}{'p95 (ms)':>12}  Statuts")
+    for path in PATHS:
+        rps, p50, p95, statuses = run(base_url, path, duration, concurrency)
+        print(f"{path:<14}{rps:>10.1f}{p50:>12.1f}{p95:>12.1f}  {dict(statuses)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+"""
+Banc d'essai des relevés PDF individuels (un par prestataire ou par société) : temps de rendu
+selon le nombre de processus du pool, puis temps d'un second export servi par le cache
+(données inchangées), sur une équipe synthétique.
+
+Usage : python bench_pdf.py [nombre_de_prestataires] [regroupement : prestataire|societe] [processus max]
+"""
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def main():
+    nb_members = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    group_by = sys.argv[2] if len(sys.argv) > 2 else 'prestataire'
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count() or 1
+
+    sys.path.insert(0, REPO_DIR)
+    from bench_export import build_dataset
+    work_dir = tempfile.mkdtemp(prefix="bench_pdf_")
+    team, marche, conso = build_dataset(nb_members, 2)
+    for name, data in (("equipe.json", team), ("marche.json", marche), ("consommation.json", conso)):
+        with open(os.path.join(work_dir, name), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    os.chdir(work_dir)
+    import app as gestion
+    counts = [1]
+    while counts[-1] * 2 <= max_workers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_workers:
+        counts.append(max_workers)
+
+    with gestion.app.app_context():
+        gestion.g.tenant = None
+        ctx = gestion.get_budget_data_context()
+        nb_docs = len(gestion.pdf_bundle_documents(ctx, group_by))
+        print(f"{nb_members} prestataires, {nb_docs} relevé(s) par {group_by}, {os.cpu_count()} CPU")
+        print(f"{'Processus':<12}{'Temps (s)':>12}{'Accélération':>14}")
+        reference = None
+        for workers in counts:
+            # Premier passage hors mesure : démarrage des processus du pool (import de l'application,
+            # chargement des polices), puis rendu complet mesuré, cache vidé
+            gestion._pdf_cache.clear()
+            gestion.build_pdf_bundle(ctx, group_by, workers=workers)
+            gestion._pdf_cache.clear()
+            gestion._pdf_cache_bytes = 0
+            start = time.perf_counter()
+            gestion.build_pdf_bundle(ctx, group_by, workers=workers)
+            elapsed = time.perf_counter() - start
+            reference = reference or elapsed
+            print(f"{workers:<12}{elapsed:>12.2f}{reference / elapsed:>13.1f}x")
+
+        start = time.perf_counter()
+        bundle = gestion.build_pdf_bundle(ctx, group_by, workers=max_workers)
+        archive = gestion.write_pdf_bundle(bundle, group_by, 'bench')
+        print(f"Export suivant (cache, zip compris) : {time.perf_counter() - start:.2f} s, "
+              f"archive de {len(archive.getvalue()) / 1024:.0f} Ko")
+
+    for pool in gestion._pdf_pools.values():
+        pool.shutdown()
+    os.chdir(REPO_DIR)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
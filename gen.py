@@ -1,10 +1,11 @@
-
-import pandas as pd
-import numpy as np
+import argparse
+from copy import copy
 from datetime import date
 import calendar
 import json
 import os
+import time
+from openpyxl import Workbook, load_workbook
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import PatternFill, Alignment, Border, Side, Font
 
@@ -12,6 +13,14 @@ from openpyxl.styles import PatternFill, Alignment, Border, Side, Font
 Script de génération du template de planning Excel.
 Ce script crée un fichier Excel avec un onglet par mois, pré-rempli avec les dates
 et les membres de l'équipe, prêt à être utilisé pour la saisie de l'activité.
+
+En mode mise à jour (--maj), il ouvre un planning existant et aligne les colonnes des membres
+de chaque onglet mensuel sur equipe.json (ajout, retrait, réordonnancement) en conservant
+les 'X' déjà saisis, puis ajoute les onglets des mois manquants. Seules les colonnes dont
+le contenu change sont réécrites.
+
+Usage : python gen.py [année ...]
+        python gen.py --maj FICHIER [année ...] [--sortie FICHIER]
 """
 
 # --- CONFIGURATION DE L'ÉQUIPE ---
@@ -34,21 +43,17 @@ def load_team_members():
         "Thomas Petit"
     ]
 
-# Liste des membres à inclure dans le planning
-team_members = load_team_members()
-
-year = 2026
-
 # Configuration des textes
 header_text = "Liste des Collaborateurs"
 footer_text = "Fin de liste des collaborateurs"
 
+sheet_equipe_name = "Paramètres_Equipe"
+
 mois_fr = {
     1: "Janvier", 2: "Février", 3: "Mars", 4: "Avril", 5: "Mai", 6: "Juin",
     7: "Juillet", 8: "Août", 9: "Septembre", 10: "Octobre", 11: "Novembre", 12: "Décembre"
 }
-
-file_path = 'planning_equipe_format_NN_2026.xlsx'
+mois_num = {label: month for month, label in mois_fr.items()}
 
 # --- STYLES ---
 grey_fill = PatternFill(start_color='E0E0E0', end_color='E0E0E0', fill_type='solid') # Week-end
@@ -56,6 +61,7 @@ header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='s
 text_white_bold = Font(color='FFFFFF', bold=True)
 text_italic = Font(italic=True, color='555555')
 center_align_vert = Alignment(vertical='center', horizontal='left')
+day_border = Border(bottom=Side(style='thin', color="DDDDDD"))
 
 # FORMAT DATE SPÉCIFIQUE DEMANDÉ : "NN J MMM AA"
 # Traduction pour Excel/OpenPyXL :
@@ -66,103 +72,252 @@ center_align_vert = Alignment(vertical='center', horizontal='left')
 # yy        = AA (Année 2 chiffres, ex: 26)
 excel_date_format = "[$-fr-FR]ddd d mmm yy;@"
 
-with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-   
-    # =========================================================================
-    # 1. CRÉATION DE L'ONGLET PARAMÈTRES
-    # =========================================================================
+def month_sheet_name(year, month):
+    return f"{mois_fr[month]}_{year}"
+
+def parse_month_sheet_name(name):
+    """(année, mois) d'un onglet mensuel ('Mars_2026'), None pour les autres onglets."""
+    label, _, year = name.rpartition('_')
+    if label in mois_num and year.isdigit():
+        return int(year), mois_num[label]
+    return None
+
+# =========================================================================
+# 1. ONGLET PARAMÈTRES
+# =========================================================================
+def write_parameters_sheet(ws, team_members):
+    """(Ré)écrit la liste des collaborateurs, encadrée par les textes d'entête et de fin."""
     col_data = [header_text] + team_members + [footer_text]
-    df_equipe = pd.DataFrame({"Data": col_data})
-   
-    sheet_equipe_name = "Paramètres_Equipe"
-    df_equipe.to_excel(writer, sheet_name=sheet_equipe_name, index=False, header=False)
-   
-    ws_equipe = writer.sheets[sheet_equipe_name]
-    ws_equipe.column_dimensions['A'].width = 30
-   
-    ws_equipe['A1'].fill = header_fill
-    ws_equipe['A1'].font = text_white_bold
-    ws_equipe['A1'].alignment = Alignment(horizontal='center')
-   
+    for row in range(len(col_data) + 1, ws.max_row + 1):
+        cell = ws.cell(row=row, column=1)
+        cell.value = None
+        cell.style = 'Normal'
+    for row, value in enumerate(col_data, start=1):
+        cell = ws.cell(row=row, column=1)
+        cell.value = value
+        cell.style = 'Normal'
+
+    ws.column_dimensions['A'].width = 30
+
+    ws['A1'].fill = header_fill
+    ws['A1'].font = text_white_bold
+    ws['A1'].alignment = Alignment(horizontal='center')
+
     last_row_param = len(col_data)
-    ws_equipe.cell(row=last_row_param, column=1).font = text_italic
-    ws_equipe.cell(row=last_row_param, column=1).alignment = Alignment(horizontal='center')
-   
-    # =========================================================================
-    # 2. CRÉATION DES ONGLETS MENSUELS
-    # =========================================================================
-   
-    nb_members = len(team_members)
-   
+    ws.cell(row=last_row_param, column=1).font = text_italic
+    ws.cell(row=last_row_param, column=1).alignment = Alignment(horizontal='center')
+
+# =========================================================================
+# 2. ONGLETS MENSUELS
+# =========================================================================
+def write_member_header(ws, col_idx, name):
+    # Noms en dur (C, D, E...) pour compatibilité pandas sans Excel
+    cell = ws.cell(row=1, column=col_idx)
+    cell.value = name
+    cell.fill = header_fill
+    cell.font = text_white_bold
+    cell.alignment = Alignment(horizontal='center')
+    ws.column_dimensions[get_column_letter(col_idx)].width = 15
+
+def build_month_sheet(ws, year, month, team_members):
+    """Remplit un onglet mensuel vide : entêtes, dates, périodes, grisage des week-ends."""
+    num_days = calendar.monthrange(year, month)[1]
+    dates_obj = [date(year, month, day) for day in range(1, num_days + 1)]
+    total_cols = 2 + len(team_members)
+
+    # --- A. LIGNE 1 : ENTÊTES ---
+    ws['A1'] = "Date"
+    ws['B1'] = "Période"
+
+    for cell in [ws['A1'], ws['B1']]:
+        cell.fill = header_fill
+        cell.font = text_white_bold
+
+    for i, name in enumerate(team_members):
+        write_member_header(ws, 3 + i, name)
+
+    # --- B. CORPS DU PLANNING ---
+    ws.freeze_panes = 'C2'
+    ws.column_dimensions['A'].width = 18
+    ws.column_dimensions['B'].width = 12
+
+    for i, current_date in enumerate(dates_obj):
+        row_start = 2 + (i * 2)
+        row_end = row_start + 1
+
+        # 1. Date (Colonne A) avec le format "NN J MMM AA"
+        ws.merge_cells(start_row=row_start, start_column=1, end_row=row_end, end_column=1)
+        cell_date = ws.cell(row=row_start, column=1)
+        cell_date.value = current_date
+
+        # APPLICATION DU FORMAT DATE ICI
+        cell_date.number_format = excel_date_format
+        cell_date.alignment = center_align_vert
+
+        # 2. Période
+        ws.cell(row=row_start, column=2).value = "Matin"
+        ws.cell(row=row_end, column=2).value = "Après-midi"
+
+        # 3. Grisage Week-end
+        if current_date.weekday() >= 5:
+            for r in [row_start, row_end]:
+                for c in range(1, total_cols + 1):
+                    ws.cell(row=r, column=c).fill = grey_fill
+
+        # 4. Bordure
+        for c in range(1, total_cols + 1):
+            ws.cell(row=row_end, column=c).border = day_border
+
+def generate_planning(file_path, year, team_members):
+    """Génère un planning vierge pour l'année : onglet paramètres puis un onglet par mois."""
+    wb = Workbook()
+    ws_equipe = wb.active
+    ws_equipe.title = sheet_equipe_name
+    write_parameters_sheet(ws_equipe, team_members)
     for month in range(1, 13):
-       
-        num_days = calendar.monthrange(year, month)[1]
-        dates_obj = [date(year, month, day) for day in range(1, num_days + 1)]
-       
-        # Structure de base
-        total_cols = 2 + nb_members
-        cols_temp = ["Date", "Moment"] + [f"Staff_{i}" for i in range(nb_members)]
-       
-        # Création DataFrame vide pour la structure
-        df = pd.DataFrame(np.full((num_days * 2, total_cols), ''), columns=cols_temp)
-       
-        sheet_name = f"{mois_fr[month]}_{year}"
-        df.to_excel(writer, sheet_name=sheet_name, index=False)
-       
-        ws = writer.sheets[sheet_name]
-       
-        # --- A. LIGNE 1 : ENTÊTES ---
-        ws['A1'] = "Date"
-        ws['B1'] = "Période"
-       
-        for cell in [ws['A1'], ws['B1']]:
-            cell.fill = header_fill
-            cell.font = text_white_bold
-       
-        # Noms en dur (C, D, E...) pour compatibilité pandas sans Excel
-        for i in range(nb_members):
-            col_idx = 3 + i
-            col_letter = get_column_letter(col_idx)
-           
-            ws.cell(row=1, column=col_idx).value = team_members[i]
-           
-            cell = ws.cell(row=1, column=col_idx)
-            cell.fill = header_fill
-            cell.font = text_white_bold
-            cell.alignment = Alignment(horizontal='center')
-            ws.column_dimensions[col_letter].width = 15
-
-        # --- B. CORPS DU PLANNING ---
-        ws.freeze_panes = 'C2'
-        ws.column_dimensions['A'].width = 18
-        ws.column_dimensions['B'].width = 12
-       
-        for i, current_date in enumerate(dates_obj):
-            row_start = 2 + (i * 2)
-            row_end = row_start + 1
-           
-            # 1. Date (Colonne A) avec le format "NN J MMM AA"
-            ws.merge_cells(start_row=row_start, start_column=1, end_row=row_end, end_column=1)
-            cell_date = ws.cell(row=row_start, column=1)
-            cell_date.value = current_date
-           
-            # APPLICATION DU FORMAT DATE ICI
-            cell_date.number_format = excel_date_format
-            cell_date.alignment = center_align_vert
-           
-            # 2. Période
-            ws.cell(row=row_start, column=2).value = "Matin"
-            ws.cell(row=row_end, column=2).value = "Après-midi"
-           
-            # 3. Grisage Week-end
-            if current_date.weekday() >= 5:
-                for r in [row_start, row_end]:
-                    for c in range(1, total_cols + 1):
-                        ws.cell(row=r, column=c).fill = grey_fill
-           
-            # 4. Bordure
-            for c in range(1, total_cols + 1):
-                ws.cell(row=row_end, column=c).border = Border(bottom=Side(style='thin', color="DDDDDD"))
-
-print(f"Fichier généré avec le format de date 'NN J MMM AA' : {file_path}")
+        build_month_sheet(wb.create_sheet(month_sheet_name(year, month)), year, month, team_members)
+    wb.save(file_path)
+
+# =========================================================================
+# 3. MISE À JOUR D'UN PLANNING EXISTANT
+# =========================================================================
+def sheet_member_names(ws):
+    """Noms des membres de l'entête (ligne 1, à partir de la colonne C, jusqu'à la première cellule vide)."""
+    names = []
+    for (value,) in ws.iter_cols(min_row=1, max_row=1, min_col=3, values_only=True):
+        if value is None or str(value).strip() == '':
+            break
+        names.append(str(value).strip())
+    return names
+
+def update_member_columns(ws, team_members):
+    """
+    Aligne les colonnes des membres d'un onglet mensuel sur team_members, en déplaçant les saisies
+    avec leur membre. Les colonnes déjà à la bonne place ne sont pas touchées ; les nouvelles colonnes
+    reprennent le style de la colonne Période (grisage, bordure) ligne par ligne.
+    Retourne (membres ajoutés, membres retirés, nombre de saisies supprimées avec les membres retirés),
+    ou None si l'onglet est déjà à jour.
+    """
+    old_names = sheet_member_names(ws)
+    if old_names == team_members:
+        return None
+
+    max_row = ws.max_row
+    old_columns = {}
+    for col_idx, name in enumerate(old_names, start=3):
+        old_columns.setdefault(name, col_idx)
+    added = [name for name in team_members if name not in old_columns]
+    removed = [name for name in old_columns if name not in team_members]
+
+    def column_values(col_idx):
+        # Lecture sans créer de cellules vides dans la feuille
+        cells = (ws._cells.get((row, col_idx)) for row in range(2, max_row + 1))
+        return [cell.value if cell is not None else None for cell in cells]
+
+    # Seules les colonnes des membres déplacés (et des membres retirés, pour le décompte) sont lues
+    moved = [name for i, name in enumerate(team_members)
+             if name in old_columns and not (i < len(old_names) and old_names[i] == name)]
+    old_values = {name: column_values(old_columns[name]) for name in moved + removed}
+    dropped = sum(1 for name in removed for v in old_values[name] if v is not None and str(v).strip() != '')
+
+    row_styles = [ws.cell(row=row, column=2)._style for row in range(2, max_row + 1)]
+    empty = (None,) * (max_row - 1)
+    for i, name in enumerate(team_members):
+        if i < len(old_names) and old_names[i] == name:
+            continue
+        col_idx = 3 + i
+        if i >= len(old_names):
+            write_member_header(ws, col_idx, name)
+            for row, style in enumerate(row_styles, start=2):
+                ws.cell(row=row, column=col_idx)._style = copy(style)
+        else:
+            ws.cell(row=1, column=col_idx).value = name
+        for row, value in enumerate(old_values.get(name, empty), start=2):
+            cell = ws.cell(row=row, column=col_idx) if value is not None else ws._cells.get((row, col_idx))
+            if cell is not None:
+                cell.value = value
+
+    if len(old_names) > len(team_members):
+        ws.delete_cols(3 + len(team_members), len(old_names) - len(team_members))
+    return added, removed, dropped
+
+def update_planning(file_path, team_members, years=None, output_path=None):
+    """
+    Met à jour un planning existant : colonnes des membres de chaque onglet mensuel, liste de
+    l'onglet paramètres et onglets des mois manquants (années déjà présentes et années demandées).
+    Retourne (nombre d'onglets mensuels modifiés, noms des onglets ajoutés).
+    """
+    wb = load_workbook(file_path)
+    if sheet_equipe_name in wb.sheetnames:
+        ws_equipe = wb[sheet_equipe_name]
+    else:
+        ws_equipe = wb.create_sheet(sheet_equipe_name, 0)
+    col_data = [header_text] + team_members + [footer_text]
+    changed = [value for (value,) in ws_equipe.iter_rows(min_col=1, max_col=1, values_only=True)] != col_data
+    if changed:
+        write_parameters_sheet(ws_equipe, team_members)
+
+    months = {}
+    for name in wb.sheetnames:
+        key = parse_month_sheet_name(name)
+        if key:
+            months[key] = wb[name]
+
+    updated = 0
+    for (year, month), ws in sorted(months.items()):
+        result = update_member_columns(ws, team_members)
+        if result is None:
+            continue
+        added, removed, dropped = result
+        print(f"{ws.title} : +{len(added)} / -{len(removed)} membre(s)"
+              + (f", {dropped} saisie(s) supprimée(s) avec les membres retirés" if dropped else ""))
+        updated += 1
+
+    created = []
+    for year in sorted(set(years or []) | {year for year, _ in months}):
+        for month in range(1, 13):
+            if (year, month) in months:
+                continue
+            # Insertion à sa place chronologique, après le dernier onglet mensuel antérieur
+            previous = [wb.sheetnames.index(ws.title) for key, ws in months.items() if key < (year, month)]
+            index = max(previous) + 1 if previous else wb.sheetnames.index(sheet_equipe_name) + 1
+            ws = wb.create_sheet(month_sheet_name(year, month), index)
+            build_month_sheet(ws, year, month, team_members)
+            months[(year, month)] = ws
+            created.append(ws.title)
+
+    # Planning déjà à jour : le fichier n'est pas réécrit
+    if changed or updated or created or output_path:
+        wb.save(output_path or file_path)
+    return updated, created
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Génération ou mise à jour du template de planning Excel")
+    parser.add_argument('annees', nargs='*', type=int, metavar='année',
+                        help="Année(s) à générer (défaut : 2026) ; avec --maj, années dont les onglets manquants sont ajoutés")
+    parser.add_argument('--maj', metavar='FICHIER', help="Planning existant à mettre à jour au lieu d'en générer un nouveau")
+    parser.add_argument('--sortie', help="Fichier de sortie de la mise à jour (défaut : le planning lui-même)")
+    args = parser.parse_args(argv)
+    if args.sortie and not args.maj:
+        parser.error("--sortie ne s'utilise qu'avec --maj")
+
+    # Liste des membres à inclure dans le planning
+    team_members = load_team_members()
+
+    if args.maj:
+        if not os.path.exists(args.maj):
+            parser.error(f"Planning introuvable : {args.maj}")
+        start = time.perf_counter()
+        updated, created = update_planning(args.maj, team_members, args.annees, args.sortie)
+        print(f"{updated} onglet(s) mensuel(s) modifié(s), {len(created)} ajouté(s)"
+              + (f" ({', '.join(created)})" if created else "")
+              + f" en {time.perf_counter() - start:.1f} s : {args.sortie or args.maj}")
+        return
+
+    for year in args.annees or [2026]:
+        file_path = f'planning_equipe_format_NN_{year}.xlsx'
+        generate_planning(file_path, year, team_members)
+        print(f"Fichier généré avec le format de date 'NN J MMM AA' : {file_path}")
 
+if __name__ == "__main__":
+    main()